@@ -0,0 +1,7 @@
+// R1を1ずつ減らし続ける、自分自身への無条件ジャンプ
+// @1 / M=M-1;JMP は @X / 0;JMP と同じ形のループだが、destがあるので停止ではない
+// 例: python emulator.py SelfLoop.asm --ram 1=100 --max-cycles 21 --dump 1:2
+//     (21サイクル実行して上限に到達し、RAM[1] = 90 になる)
+    @0
+    @1
+    M=M-1;JMP
@@ -0,0 +1,420 @@
+from datetime import datetime, timezone
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+from complete_version import Code, Instruction, Parser
+
+
+ASSEMBLER_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 同梱の.asmファイル(それぞれ同名の.hackが正解として置かれている)
+CORPUS = ["Add", "Max", "MaxL", "Rect", "RectL", "sum1ToN", "Pong", "PongL"]
+
+# (アセンブラ, モード名, 追加のコマンドライン引数)
+ASSEMBLERS = [
+    ("basic_edition.py", "basic", []),
+    ("complete_version.py", "two-pass", []),
+    ("complete_version.py", "single-pass", ["--single-pass"]),
+    ("complete_version.py", "parallel", ["--processes", "0"]),
+]
+
+# 合成プログラムで使う変数の種類
+SYNTHETIC_VARIABLES = 64
+# 合成プログラムでラベルを宣言するブロック数 (1ブロック14命令なので、ラベルのアドレスは32768未満になる)
+SYNTHETIC_LABEL_BLOCKS = 2000
+# 合成プログラムで使うC命令と、その16bitのバイナリコード
+SYNTHETIC_C_INSTRUCTIONS = {
+    "D=M": "1111110000010000",
+    "D=D-M": "1111010011010000",
+    "D;JGT": "1110001100000001",
+    "M=M+1": "1111110111001000",
+    "0;JMP": "1110101010000111",
+    "D=A": "1110110000010000",
+    "M=D": "1110001100001000",
+}
+
+
+def _legacy_comp(arg: str) -> str:
+    """
+    以前のCode.compと同じく、呼び出しごとに対応表を作り直して変換する
+    """
+    unified_arg = arg.replace("M", "A")
+    comp_map = {
+        "0": "101010",
+        "1": "111111",
+        "-1": "111010",
+        "D": "001100",
+        "A": "110000",
+        "!D": "001101",
+        "!A": "110001",
+        "-D": "001111",
+        "-A": "110011",
+        "D+1": "011111",
+        "A+1": "110111",
+        "D-1": "001110",
+        "A-1": "110010",
+        "D+A": "000010",
+        "D-A": "010011",
+        "A-D": "000111",
+        "D&A": "000000",
+        "D|A": "010101",
+    }
+    return comp_map[unified_arg]
+
+
+def _legacy_jump(arg: str) -> str:
+    """
+    以前のCode.jumpと同じく、呼び出しごとに対応表を作り直して変換する
+    """
+    jump_map = {
+        "null": "000",
+        "JGT": "001",
+        "JEQ": "010",
+        "JGE": "011",
+        "JLT": "100",
+        "JNE": "101",
+        "JLE": "110",
+        "JMP": "111",
+    }
+    return jump_map[arg]
+
+
+def load_instructions(asm_file_path: str) -> tuple:
+    """
+    .asmファイルから、C命令と数値のA命令(空白除去済みの文字列)を取り出す
+    """
+    parser = Parser(asm_file_path=asm_file_path)
+    c_orders = []
+    a_symbols = []
+    while parser.has_more_lines():
+        parser.advance()
+        if parser.order is None:
+            continue
+        instruction_type = parser.instruction_type()
+        if instruction_type == Instruction.C:
+            c_orders.append(parser.order)
+        elif instruction_type == Instruction.A and parser.symbol().isdigit():
+            a_symbols.append(parser.symbol())
+    return c_orders, a_symbols
+
+
+def encode_legacy(c_orders: list, a_symbols: list) -> list:
+    """
+    以前の方法(フィールドごとの文字列処理と連結)で命令を変換する
+    """
+    binary_codes = []
+    for order in c_orders:
+        dest_asm = order.split("=")[0] if "=" in order else "null"
+        comp_asm = order.split("=")[-1].split(";")[0]
+        jump_asm = order.split(";")[-1] if ";" in order else "null"
+        binary_code = "111"
+        binary_code += "1" if "M" in comp_asm else "0"
+        binary_code += _legacy_comp(comp_asm)
+        binary_code += Code.dest(dest_asm)
+        binary_code += _legacy_jump(jump_asm)
+        binary_codes.append(binary_code)
+    for symbol in a_symbols:
+        binary_codes.append(f"{int(symbol):016b}")
+    return binary_codes
+
+
+def encode_table(c_orders: list, a_symbols: list) -> list:
+    """
+    事前計算した対応表とメモ化で命令を変換する
+    """
+    binary_codes = []
+    for order in c_orders:
+        binary_codes.append(Code.to_binary_string(Code.c_instruction(order)))
+    for symbol in a_symbols:
+        binary_codes.append(Code.to_binary_string(Code.a_instruction(symbol)))
+    return binary_codes
+
+
+def bench_code_table(asm_file_path: str, repeat: int) -> None:
+    """
+    命令の変換部分だけを取り出して、以前の方法と対応表による方法を比較する
+    """
+    c_orders, a_symbols = load_instructions(asm_file_path=asm_file_path)
+    assert encode_legacy(c_orders, a_symbols) == encode_table(c_orders, a_symbols)
+
+    legacy_time = min(timeit.repeat(lambda: encode_legacy(c_orders, a_symbols), number=1, repeat=repeat))
+    table_time = min(timeit.repeat(lambda: encode_table(c_orders, a_symbols), number=1, repeat=repeat))
+    n_instructions = len(c_orders) + len(a_symbols)
+    print(f"{os.path.basename(asm_file_path)}: C命令 {len(c_orders)}, 数値のA命令 {len(a_symbols)}")
+    print(f"  legacy: {legacy_time * 1000:8.2f} ms ({n_instructions / legacy_time:12.0f} 命令/s)")
+    print(f"  table : {table_time * 1000:8.2f} ms ({n_instructions / table_time:12.0f} 命令/s)")
+    print(f"  speedup: x{legacy_time / table_time:.2f}")
+
+
+def generate_synthetic(output_dir: str, n_lines: int) -> tuple:
+    """
+    約n_lines行の合成プログラムを作る
+    ラベルと変数を使う版(SynthN.asm)、シンボルを数値に置き換えた版(SynthNL.asm)、
+    正解の.hackをそれぞれ書き出し、(プログラム名のリスト, 正解の.hackのパス)を返す
+    命令の変換はアセンブラを使わずに行うので、正解はアセンブラの実装から独立している
+    A命令の値が15bitに収まるよう、ラベルは先頭のSYNTHETIC_LABEL_BLOCKSブロックだけで宣言し、
+    それ以降のブロックはそれらのラベルへジャンプする
+    """
+    name = f"Synth{n_lines}"
+    c = SYNTHETIC_C_INSTRUCTIONS
+    # 1ブロックは17行(ラベル2行、コメント1行、命令14行)
+    n_blocks = max(1, n_lines // 17)
+    with open(os.path.join(output_dir, f"{name}.asm"), "w") as asm_fp, \
+            open(os.path.join(output_dir, f"{name}L.asm"), "w") as asm_l_fp, \
+            open(os.path.join(output_dir, f"{name}.expected"), "w") as hack_fp:
+        for k in range(n_blocks):
+            label = k % SYNTHETIC_LABEL_BLOCKS
+            base = label * 14
+            variable = k % SYNTHETIC_VARIABLES
+            # 変数は初出順に16から割り当てられる
+            variable_address = 16 + variable
+            # ラベルを宣言しないブロックでは、行数をそろえるため宣言の代わりにコメントを置く
+            declaration = "" if k < SYNTHETIC_LABEL_BLOCKS else "// "
+            block = [
+                (f"{declaration}(LOOP_{label})", None),
+                (f"@v{variable}", variable_address),
+                ("D=M", None),
+                ("@R0", 0),
+                ("D=D-M", None),
+                (f"@END_{label}", base + 10),
+                ("D;JGT", None),
+                (f"@v{variable}", variable_address),
+                ("M=M+1", None),
+                (f"@LOOP_{label}", base),
+                ("0;JMP", None),
+                (f"{declaration}(END_{label})", None),
+                (f"@{k % 32768}", k % 32768),
+                ("D=A", None),
+                ("@SCREEN", 16384),
+                ("M=D", None),
+                (f"// block {k}", None),
+            ]
+            for order, address in block:
+                asm_fp.write(f"{order}\n")
+                if order.startswith("(") or order.startswith("//"):
+                    continue
+                if order.startswith("@"):
+                    asm_l_fp.write(f"@{address}\n")
+                    hack_fp.write(f"{address:016b}\n")
+                else:
+                    asm_l_fp.write(f"{order}\n")
+                    hack_fp.write(f"{c[order]}\n")
+    return [name, f"{name}L"], os.path.join(output_dir, f"{name}.expected")
+
+
+def _count_lines(file_path: str) -> int:
+    with open(file_path, "rb") as fp:
+        return sum(1 for _ in fp)
+
+
+def _files_equal(file_path: str, other_file_path: str) -> bool:
+    with open(file_path, "rb") as fp, open(other_file_path, "rb") as other_fp:
+        while True:
+            block = fp.read(1 << 20)
+            if block != other_fp.read(1 << 20):
+                return False
+            if not block:
+                return True
+
+
+# アセンブラを実行し、終了時にそのプロセスの最大RSS(キロバイト)をファイルへ書き出すラッパー
+# fork/execした子プロセスのru_maxrssには親プロセスのRSSが引き継がれるため、
+# Linuxではexec後のメモリ空間だけを対象とする/proc/self/statusのVmHWMを使う
+RSS_WRAPPER = """
+import atexit, resource, runpy, sys
+
+rss_file_path = sys.argv[1]
+script = sys.argv[2]
+sys.argv = sys.argv[2:]
+
+def report_peak_rss():
+    peak_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    try:
+        with open("/proc/self/status") as fp:
+            for line in fp:
+                if line.startswith("VmHWM:"):
+                    peak_rss_kb = int(line.split()[1])
+    except OSError:
+        pass
+    with open(rss_file_path, "w") as fp:
+        fp.write(str(peak_rss_kb))
+
+atexit.register(report_peak_rss)
+runpy.run_path(script, run_name="__main__")
+"""
+
+
+def run_assembler(work_dir: str, script: str, args: list, program: str, timeout: float) -> dict:
+    """
+    アセンブラを別プロセスで実行し、経過時間と最大RSSを計測する
+    アセンブラは入力と同じ場所に.hackを書き出すので、work_dirで実行する
+    最大RSSはアセンブラのプロセス自身のもの(並列モードのワーカープロセスは含まない)
+    """
+    result = {"seconds": None, "peak_rss_kb": None, "error": None}
+    rss_file_path = os.path.join(work_dir, "peak_rss_kb")
+    command = [
+        sys.executable, "-c", RSS_WRAPPER, rss_file_path,
+        os.path.join(ASSEMBLER_DIR, script), f"{program}.asm",
+    ] + args
+    start = time.perf_counter()
+    try:
+        process = subprocess.run(
+            command, cwd=work_dir, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=timeout
+        )
+    except subprocess.TimeoutExpired:
+        result["error"] = f"timeout ({timeout}s)"
+        return result
+    result["seconds"] = time.perf_counter() - start
+    if process.returncode != 0:
+        stderr_lines = process.stderr.decode(errors="replace").strip().splitlines()
+        result["error"] = stderr_lines[-1] if stderr_lines else f"exit status {process.returncode}"
+        return result
+    with open(rss_file_path) as fp:
+        result["peak_rss_kb"] = int(fp.read())
+    return result
+
+
+def _uses_symbols(asm_file_path: str) -> bool:
+    """
+    ラベルや変数などのシンボルを使うプログラムか判定する(basic_editionはシンボルに対応しない)
+    """
+    parser = Parser(asm_file_path=asm_file_path)
+    while parser.has_more_lines():
+        parser.advance()
+        if parser.order is None:
+            continue
+        instruction_type = parser.instruction_type()
+        if instruction_type == Instruction.L:
+            return True
+        if instruction_type == Instruction.A and not parser.symbol().isdigit():
+            return True
+    return False
+
+
+def run_suite(sizes: list, timeout: float, include_corpus: bool = True) -> dict:
+    """
+    同梱のプログラムと合成プログラムに対して、各アセンブラ(モード)を実行して計測する
+    正解の.hackと一致するかも確認する
+
+    Parameters
+    ----------
+    sizes : list
+        合成プログラムの行数のリスト
+    timeout : float
+        1回の実行の制限時間(秒)
+    include_corpus : bool
+        同梱のプログラムも計測するか
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        # (プログラム名, 正解の.hackのパス)
+        programs = []
+        if include_corpus:
+            for name in CORPUS:
+                shutil.copy(os.path.join(ASSEMBLER_DIR, f"{name}.asm"), work_dir)
+                programs.append((name, os.path.join(ASSEMBLER_DIR, f"{name}.hack")))
+        for n_lines in sizes:
+            names, expected_path = generate_synthetic(output_dir=work_dir, n_lines=n_lines)
+            programs += [(name, expected_path) for name in names]
+
+        for program, expected_path in programs:
+            asm_file_path = os.path.join(work_dir, f"{program}.asm")
+            n_lines = _count_lines(asm_file_path)
+            uses_symbols = _uses_symbols(asm_file_path)
+            for script, mode, args in ASSEMBLERS:
+                if script == "basic_edition.py" and uses_symbols:
+                    continue
+                measurement = run_assembler(
+                    work_dir=work_dir, script=script, args=args, program=program, timeout=timeout
+                )
+                hack_path = os.path.join(work_dir, f"{program}.hack")
+                correct = None
+                if measurement["error"] is None:
+                    correct = _files_equal(hack_path, expected_path)
+                if os.path.exists(hack_path):
+                    os.remove(hack_path)
+                seconds = measurement["seconds"]
+                result = {
+                    "assembler": script,
+                    "mode": mode,
+                    "program": program,
+                    "lines": n_lines,
+                    "seconds": seconds,
+                    "lines_per_second": n_lines / seconds if seconds else None,
+                    "peak_rss_kb": measurement["peak_rss_kb"],
+                    "correct": correct,
+                    "error": measurement["error"],
+                }
+                results.append(result)
+                print(
+                    f"{program:>16} {mode:>12}: "
+                    + (
+                        f"{seconds:8.3f} s {result['lines_per_second']:12.0f} 行/s "
+                        f"{result['peak_rss_kb']:8d} KB correct={correct}"
+                        if result["error"] is None
+                        else f"error: {result['error']}"
+                    ),
+                    file=sys.stderr,
+                )
+
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "results": results,
+    }
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="アセンブラのベンチマーク")
+    subparsers = arg_parser.add_subparsers(dest="command")
+
+    suite_parser = subparsers.add_parser(
+        "suite", help="同梱のプログラムと合成プログラムで各アセンブラを計測し、JSONで出力する"
+    )
+    suite_parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="*",
+        default=[10 ** 5],
+        help="合成プログラムの行数 (例: 100000 1000000 10000000)",
+    )
+    suite_parser.add_argument("--timeout", type=float, default=600, help="1回の実行の制限時間(秒)")
+    suite_parser.add_argument("--no-corpus", action="store_true", help="同梱のプログラムを計測しない")
+    suite_parser.add_argument("--output", default=None, help="結果のJSONの出力先 (デフォルトは標準出力)")
+
+    micro_parser = subparsers.add_parser("micro", help="命令の変換部分だけを計測する")
+    micro_parser.add_argument(
+        "asm_file_path",
+        nargs="?",
+        default=os.path.join(ASSEMBLER_DIR, "Pong.asm"),
+        help="計測に使う.asmファイル (デフォルトはPong.asm)",
+    )
+    micro_parser.add_argument("--repeat", type=int, default=5, help="計測の繰り返し回数")
+    args = arg_parser.parse_args()
+
+    if args.command == "micro":
+        bench_code_table(asm_file_path=args.asm_file_path, repeat=args.repeat)
+    elif args.command == "suite":
+        report = run_suite(sizes=args.sizes, timeout=args.timeout, include_corpus=not args.no_corpus)
+        if args.output is None:
+            json.dump(report, sys.stdout, indent=2)
+            print()
+        else:
+            with open(args.output, "w") as fp:
+                json.dump(report, fp, indent=2)
+    else:
+        arg_parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,18 @@
+from array import array
 from enum import Enum
+from multiprocessing import Pool
+from types import MappingProxyType
+from typing import Iterable, Iterator, Union
+import argparse
+import contextlib
+import functools
+import hashlib
+import itertools
+import json
+import os
 import sys
+import time
+import tracemalloc
 
 
 class Instruction(Enum):
@@ -11,28 +24,57 @@ class Instruction(Enum):
     L = "L_INSTRUCTION"
 
 
+class OutputFormat(Enum):
+    # 1行に1命令を'0'/'1'の文字列で書く(デフォルト)
+    TEXT = "hack"
+    # 1命令を16bitのリトルエンディアンで詰めたROMイメージ
+    BINARY = "hackbin"
+
+
 class Parser:
-    def __init__(self, asm_file_path: str) -> None:
+    def __init__(self, asm_file_path: str = None, lines: Iterable[str] = None) -> None:
         """
         入力ファイルを受け付ける
+        ファイル全体は読み込まず、1行ずつ読み進める(メモリ使用量は入力サイズに依らない)
+
+        Parameters
+        ----------
+        asm_file_path : str
+            入力ファイルのパス
+        lines : Iterable[str]
+            ファイルの代わりに、改行を含まない行を直接与える場合に指定する
         """
-        with open(asm_file_path, "r") as fp:
-            self.asm = fp.read()
-            self.asm = self.asm.split("\n")
+        if lines is not None:
+            self.lines = iter(lines)
+        else:
+            self.lines = self._read_lines(asm_file_path=asm_file_path)
+        # has_more_linesのために、1行だけ先読みしておく
+        self.next_line = next(self.lines, None)
 
         self.order = None
-    
+
+    @staticmethod
+    def _read_lines(asm_file_path: str) -> Iterator[str]:
+        """
+        入力ファイルを1行ずつ返すジェネレータ
+        最後まで読み終えるとファイルは閉じられる
+        """
+        with open(asm_file_path, "r") as fp:
+            for line in fp:
+                yield line.rstrip("\n")
+
     def has_more_lines(self) -> bool:
         """
         入力にまだ行があるか判断する
         """
-        return True if self.asm else False
+        return self.next_line is not None
 
     def advance(self) -> None:
         """
         入力から次の命令を読み込み、それを現在の命令にする
         """
-        self.order = self.asm.pop(0)
+        self.order = self.next_line
+        self.next_line = next(self.lines, None)
         self.order = self.order.replace(" ", "")
         if self.order.startswith("//") or self.order == "":
             self.order = None
@@ -88,6 +130,44 @@ class Parser:
             return "null"
 
 
+COMP_MAP = {
+    "0": "101010",
+    "1": "111111",
+    "-1": "111010",
+    "D": "001100",
+    "A": "110000",
+    "!D": "001101",
+    "!A": "110001",
+    "-D": "001111",
+    "-A": "110011",
+    "D+1": "011111",
+    "A+1": "110111",
+    "D-1": "001110",
+    "A-1": "110010",
+    "D+A": "000010",
+    "D-A": "010011",
+    "A-D": "000111",
+    "D&A": "000000",
+    "D|A": "010101",
+}
+
+
+JUMP_MAP = {
+    "null": "000",
+    "JGT": "001",
+    "JEQ": "010",
+    "JGE": "011",
+    "JLT": "100",
+    "JNE": "101",
+    "JLE": "110",
+    "JMP": "111",
+}
+
+
+# A命令のメモ化に使うキャッシュの上限
+A_INSTRUCTION_CACHE_SIZE = 4096
+
+
 class Code:
     @classmethod
     def dest(self, arg: str) -> str:
@@ -105,115 +185,623 @@ class Code:
         compニーモニックのバイナリーコード(7ビット)を返す
         """
         unified_arg = arg.replace("M", "A")
-        comp_map = {
-            "0": "101010",
-            "1": "111111",
-            "-1": "111010",
-            "D": "001100",
-            "A": "110000",
-            "!D": "001101",
-            "!A": "110001",
-            "-D": "001111",
-            "-A": "110011",
-            "D+1": "011111",
-            "A+1": "110111",
-            "D-1": "001110",
-            "A-1": "110010",
-            "D+A": "000010",
-            "D-A": "010011",
-            "A-D": "000111",
-            "D&A": "000000",
-            "D|A": "010101",
-        }
-        return comp_map[unified_arg]    
+        return COMP_MAP[unified_arg]
 
     @classmethod
     def jump(self, arg: str) -> str:
         """
         jumpニーモニックのバイナリーコード(3ビット)を返す
         """
-        jump_map = {
-            "null": "000",
-            "JGT": "001",
-            "JEQ": "010",
-            "JGE": "011",
-            "JLT": "100",
-            "JNE": "101",
-            "JLE": "110",
-            "JMP": "111",
-        }
-        return jump_map[arg]
-    
-    
+        return JUMP_MAP[arg]
+
+    @classmethod
+    def build_c_instruction_table(self) -> dict:
+        """
+        すべてのdest/comp/jumpの組み合わせについて、
+        空白を除いたC命令の文字列から16bitの整数への対応表を作る
+        """
+        # destはA/D/Mの順不同の組み合わせ(AMDもMDAも同じ)を受け付ける
+        dest_list = ["null"]
+        for size in range(1, 4):
+            for registers in itertools.permutations("ADM", size):
+                dest_list.append("".join(registers))
+        # compはAの代わりにMを使う版も含める
+        comp_list = list(COMP_MAP) + [comp.replace("A", "M") for comp in COMP_MAP if "A" in comp]
+        # 可換な演算は、オペランドを入れ替えた書き方(M+D, A&Dなど)も同じ命令として受け付ける
+        comp_aliases = {comp: comp for comp in comp_list}
+        for comp in comp_list:
+            if len(comp) == 3 and comp[1] in "+&|" and "1" not in comp:
+                comp_aliases[comp[2] + comp[1] + comp[0]] = comp
+
+        table = {}
+        for comp, canonical_comp in comp_aliases.items():
+            is_a = "1" if "M" in comp else "0"
+            comp_binary = is_a + self.comp(canonical_comp)
+            for dest in dest_list:
+                dest_binary = self.dest(dest)
+                for jump in JUMP_MAP:
+                    order = comp if dest == "null" else f"{dest}={comp}"
+                    if jump != "null":
+                        order += f";{jump}"
+                    table[order] = int("111" + comp_binary + dest_binary + self.jump(jump), 2)
+        return table
+
+    @classmethod
+    def c_instruction(self, order: str) -> int:
+        """
+        C命令(空白を除いた文字列)を、事前計算した表から16bitの整数へ変換する
+        """
+        return C_INSTRUCTION_TABLE[order]
+
+    @staticmethod
+    @functools.lru_cache(maxsize=A_INSTRUCTION_CACHE_SIZE)
+    def a_instruction(symbol: str) -> int:
+        """
+        数値のA命令(@xxx のxxx)を16bitの整数へ変換する
+        同じ定数は何度も現れるので、結果をメモ化しておく
+        """
+        return int(symbol)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=A_INSTRUCTION_CACHE_SIZE)
+    def to_binary_string(word: int) -> str:
+        """
+        16bitの整数を0埋めの'0'/'1'の文字列へ変換する
+        """
+        return f"{word:016b}"
+
+
+# import時に一度だけ作る、C命令の文字列から16bitの整数への対応表
+C_INSTRUCTION_TABLE = Code.build_c_instruction_table()
+
+
+# 定義済みシンボル。すべてのSymbolTableで共有し、変更できないようにしておく
+PREDEFINED_SYMBOLS = MappingProxyType({
+    "R0": 0,
+    "R1": 1,
+    "R2": 2,
+    "R3": 3,
+    "R4": 4,
+    "R5": 5,
+    "R6": 6,
+    "R7": 7,
+    "R8": 8,
+    "R9": 9,
+    "R10": 10,
+    "R11": 11,
+    "R12": 12,
+    "R13": 13,
+    "R14": 14,
+    "R15": 15,
+    "SP": 0,
+    "LCL": 1,
+    "ARG": 2,
+    "THIS": 3,
+    "THAT": 4,
+    "SCREEN": 16384,
+    "KBD": 24576,
+})
+
+
 class SymbolTable:
     def __init__(self):
+        """
+        定義済みシンボル(PREDEFINED_SYMBOLS)の層と、プログラムごとの層からなるシンボルテーブル
+        プログラムごとの層(table)には、ラベルと変数、参照された定義済みシンボルだけが入る
+        キーはsys.internし、パーサーが作る同じ文字列と共有する
+        """
         self.table = {}
-        self.table["R0"] = 0
-        self.table["R1"] = 1
-        self.table["R2"] = 2
-        self.table["R3"] = 3
-        self.table["R4"] = 4
-        self.table["R5"] = 5
-        self.table["R6"] = 6
-        self.table["R7"] = 7
-        self.table["R8"] = 8
-        self.table["R9"] = 9
-        self.table["R10"] = 10
-        self.table["R11"] = 11
-        self.table["R12"] = 12
-        self.table["R13"] = 13
-        self.table["R14"] = 14
-        self.table["R15"] = 15
-        self.table["SP"] = 0
-        self.table["LCL"] = 1
-        self.table["ARG"] = 2
-        self.table["THIS"] = 3
-        self.table["THAT"] = 4
-        self.table["SCREEN"] = 16384
-        self.table["KBD"] = 24576
-        
+        # 次に割り当てる変数のアドレス
+        self.next_variable_address = 16
+
     def addEntry(self, symbol: str, address: int):
-        self.table[symbol] = address
+        self.table[sys.intern(symbol)] = address
     
     def contains(self, symbol: str) -> bool:
-        return True if symbol in self.table else False
+        return symbol in self.table or symbol in PREDEFINED_SYMBOLS
     
     def getAddress(self, symbol: str) -> int:
-        return self.table[symbol]
+        address = self.table.get(symbol)
+        if address is None:
+            return PREDEFINED_SYMBOLS[symbol]
+        return address
+
+    def get_or_allocate(self, symbol: str) -> int:
+        """
+        シンボルのアドレスを返す。テーブルになければ変数として次のアドレスを割り当てる
+        定義済みシンボルも一度参照されるとプログラムごとの層に入るので、
+        2回目以降は辞書を1回引くだけで済む
+        """
+        address = self.table.get(symbol)
+        if address is not None:
+            return address
+        address = PREDEFINED_SYMBOLS.get(symbol)
+        if address is None:
+            address = self.next_variable_address
+            self.next_variable_address += 1
+        self.table[sys.intern(symbol)] = address
+        return address
+
+
+class HackWriter:
+    # まとめて書き込むまでに溜める命令数
+    BUFFER_SIZE = 4096
+
+    def __init__(self, hack_file_path: str, output_format: OutputFormat = OutputFormat.TEXT) -> None:
+        """
+        出力ファイルを作成する
+        命令ごとにファイルを開き直さず、バッファに溜めてまとめて書き込む
+
+        Parameters
+        ----------
+        hack_file_path : str
+            出力ファイルのパス
+        output_format : OutputFormat
+            TEXTなら.hack、BINARYなら.hackbin(16bitリトルエンディアンのROMイメージ)
+        """
+        self.output_format = output_format
+        if self.output_format == OutputFormat.TEXT:
+            self.fp = open(hack_file_path, "w")
+            self.buffer = []
+        else:
+            self.fp = open(hack_file_path, "wb")
+            self.buffer = array("H")
+
+    def write(self, word: int) -> None:
+        """
+        16bitの命令を1つ書き込む
+        """
+        if self.output_format == OutputFormat.TEXT:
+            self.buffer.append(Code.to_binary_string(word))
+        else:
+            self.buffer.append(word)
+        if len(self.buffer) >= self.BUFFER_SIZE:
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        バッファに溜まった命令をファイルへ書き込む
+        """
+        if not self.buffer:
+            return
+        if self.output_format == OutputFormat.TEXT:
+            self.fp.write("\n".join(self.buffer))
+            self.fp.write("\n")
+            self.buffer = []
+        else:
+            if sys.byteorder == "big":
+                self.buffer.byteswap()
+            self.fp.write(self.buffer.tobytes())
+            self.buffer = array("H")
+
+    def write_words(self, words: Iterable[int]) -> None:
+        """
+        複数の命令をまとめて書き込む
+        """
+        if self.output_format == OutputFormat.TEXT:
+            self.buffer.extend(map(Code.to_binary_string, words))
+        else:
+            self.buffer.extend(words)
+        if len(self.buffer) >= self.BUFFER_SIZE:
+            self.flush()
+
+    def close(self) -> None:
+        """
+        残りを書き込んで出力ファイルを閉じる
+        """
+        self.flush()
+        self.fp.close()
+
+
+def _split_into_chunks(asm_file_path: str, n_chunks: int) -> list:
+    """
+    入力ファイルを行の境界でおおよそn_chunks個に分割し、(開始, 終了)のバイト位置のリストを返す
+    """
+    file_size = os.path.getsize(asm_file_path)
+    chunk_size = max(1, file_size // n_chunks)
+    chunks = []
+    start = 0
+    with open(asm_file_path, "rb") as fp:
+        while start < file_size:
+            fp.seek(min(start + chunk_size, file_size))
+            # 行の途中で切らないよう、次の改行の直後まで進める
+            fp.readline()
+            end = min(fp.tell(), file_size)
+            chunks.append((start, end))
+            start = end
+    return chunks
+
+
+def _split_lines(text: str) -> list:
+    """
+    改行コード(CRLF/CR/LF)を揃えて、テキストを行のリストにする
+    """
+    text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return text.split("\n")
+
+
+def _read_chunk(asm_file_path: str, start: int, end: int) -> list:
+    """
+    入力ファイルの[start, end)のバイト範囲を行のリストとして返す
+    """
+    with open(asm_file_path, "rb") as fp:
+        fp.seek(start)
+        text = fp.read(end - start).decode()
+    return _split_lines(text)
+
+
+def _scan_lines(lines: Iterable[str]) -> tuple:
+    """
+    行の並びに含まれる命令数、ラベル(先頭からの行番号)、
+    数値でないA命令のシンボル(初出順)を集める
+    """
+    parser = Parser(lines=lines)
+    line_number = 0
+    labels = []
+    symbols = {}
+    while parser.has_more_lines():
+        parser.advance()
+        if parser.order is None:
+            continue
+        instruction_type = parser.instruction_type()
+        if instruction_type == Instruction.L:
+            labels.append((parser.symbol(), line_number))
+            continue
+        if instruction_type == Instruction.A:
+            symbol = parser.symbol()
+            if not symbol.isdigit():
+                symbols.setdefault(symbol, None)
+        line_number += 1
+    return line_number, labels, list(symbols)
+
+
+def _encode_lines(lines: Iterable[str], table: dict) -> array:
+    """
+    行の並びに含まれる命令を16bitの整数へ変換する
+    シンボルはすべてtableで解決済みであることを前提とする
+    """
+    parser = Parser(lines=lines)
+    words = array("H")
+    while parser.has_more_lines():
+        parser.advance()
+        if parser.order is None:
+            continue
+        instruction_type = parser.instruction_type()
+        if instruction_type == Instruction.A:
+            symbol = parser.symbol()
+            if symbol.isdigit():
+                words.append(Code.a_instruction(symbol))
+            else:
+                words.append(table[symbol])
+        elif instruction_type == Instruction.C:
+            words.append(Code.c_instruction(parser.order))
+    return words
+
+
+def _scan_chunk(asm_file_path: str, start: int, end: int) -> tuple:
+    """
+    チャンク内の命令数、ラベル、シンボルの初出順を集める
+    """
+    return _scan_lines(_read_chunk(asm_file_path=asm_file_path, start=start, end=end))
+
+
+# 符号化を行うワーカープロセスが共有する、解決済みのシンボルテーブル
+_worker_table = None
+
+
+def _init_encode_worker(table: dict) -> None:
+    global _worker_table
+    _worker_table = table
+
+
+def _encode_chunk(asm_file_path: str, start: int, end: int) -> array:
+    """
+    チャンク内の命令を16bitの整数へ変換する
+    """
+    return _encode_lines(_read_chunk(asm_file_path=asm_file_path, start=start, end=end), _worker_table)
+
+
+class AssemblyCache:
+    # キャッシュファイルを置くディレクトリ名(入力ファイルと同じ場所に作る)
+    CACHE_DIR_NAME = ".hack_cache"
+
+    def __init__(self, asm_file_path: str) -> None:
+        """
+        入力ファイルごとのキャッシュを読み込む
+        キャッシュには、アセンブラのソースのハッシュ、ファイル全体のハッシュ、解決済みのシンボルテーブル、
+        領域(ラベル宣言ごとに区切った行のまとまり)のハッシュごとの命令が保存される
+        アセンブラのソースが変わっていれば、キャッシュは空として扱う
+        """
+        asm_dir, asm_file_name = os.path.split(asm_file_path)
+        self.cache_file_path = os.path.join(asm_dir, self.CACHE_DIR_NAME, f"{asm_file_name}.json")
+        self.assembler_hash = self._assembler_hash()
+        self.source_hash = None
+        self.symbols = None
+        self.regions = {}
+        try:
+            with open(self.cache_file_path, "r") as fp:
+                data = json.load(fp)
+            if data["assembler_hash"] != self.assembler_hash:
+                return
+            self.source_hash = data["source_hash"]
+            self.symbols = data["symbols"]
+            self.regions = data["regions"]
+        except (OSError, ValueError, KeyError):
+            # キャッシュがない、または壊れている場合は空のキャッシュとして扱う
+            pass
+
+    @staticmethod
+    def _assembler_hash() -> str:
+        """
+        このアセンブラのソースのハッシュ。アセンブラを変更したら古い命令を使わない
+        """
+        with open(os.path.abspath(__file__), "rb") as fp:
+            return hashlib.sha256(fp.read()).hexdigest()
+
+    def get_words(self, region_hash: str) -> array:
+        """
+        領域のハッシュに対応する命令を返す。なければNoneを返す
+        """
+        if region_hash not in self.regions:
+            return None
+        words = array("H")
+        words.frombytes(bytes.fromhex(self.regions[region_hash]))
+        if sys.byteorder == "big":
+            words.byteswap()
+        return words
+
+    def save(self, source_hash: str, symbols: dict, regions: dict) -> None:
+        """
+        キャッシュを書き込む
+
+        Parameters
+        ----------
+        source_hash : str
+            入力ファイル全体のハッシュ
+        symbols : dict
+            解決済みのシンボルテーブル
+        regions : dict
+            領域のハッシュから命令(array)への対応
+        """
+        encoded_regions = {}
+        for region_hash, words in regions.items():
+            if sys.byteorder == "big":
+                words = array("H", words)
+                words.byteswap()
+            encoded_regions[region_hash] = words.tobytes().hex()
+        os.makedirs(os.path.dirname(self.cache_file_path), exist_ok=True)
+        with open(self.cache_file_path, "w") as fp:
+            json.dump(
+                {
+                    "assembler_hash": self.assembler_hash,
+                    "source_hash": source_hash,
+                    "symbols": symbols,
+                    "regions": encoded_regions,
+                },
+                fp,
+            )
+
+
+def _assemble_single_pass(parser: Parser, symbol_table: "SymbolTable") -> list:
+    """
+    parserの入力を1パスで16bitの整数のリストへ変換する
+    シンボルを参照するA命令は、その位置とシンボルを記録しておき(fixup)、
+    入力を読み終えた時点でラベルか変数かを判定してアドレスを埋める。
+    """
+    # ラベル宣言を格納するための行番号記録用
+    line_number = 0
+    # 出力する命令。fixup対象の位置はNoneにしておく
+    words = []
+    # (wordsのインデックス, シンボル)
+    fixups = []
+
+    while parser.has_more_lines():
+        parser.advance()
+        if parser.order is None:
+            continue
+
+        instruction_type = parser.instruction_type()
+        if instruction_type == Instruction.L:
+            symbol_table.addEntry(symbol=parser.symbol(), address=line_number)
+            continue
+        elif instruction_type == Instruction.A:
+            symbol = parser.symbol()
+            if symbol.isdigit():
+                words.append(Code.a_instruction(symbol))
+            else:
+                # ラベルは後から再定義されうるので(2パスでは最後の定義が使われる)、
+                # シンボルはすべて入力の最後で解決する
+                fixups.append((len(words), symbol))
+                words.append(None)
+        elif instruction_type == Instruction.C:
+            words.append(Code.c_instruction(parser.order))
+        line_number += 1
+
+    # fixupを解決する。この時点でテーブルにないシンボルは変数シンボル
+    for index, symbol in fixups:
+        words[index] = symbol_table.get_or_allocate(symbol=symbol)
+    return words
+
+
+def assemble(source: Union[str, Iterable[str]]) -> list:
+    """
+    アセンブリをファイルを介さずにメモリ上で変換し、16bitの整数のリストを返す
+    結果はHackで.hackファイルへ変換した場合と同一になる
+
+    Parameters
+    ----------
+    source : str | Iterable[str]
+        アセンブリのテキスト全体、または行の並び(末尾の改行はあってもよい)
+    """
+    if isinstance(source, str):
+        lines = _split_lines(source)
+    else:
+        lines = (line.rstrip("\r\n") for line in source)
+    return _assemble_single_pass(parser=Parser(lines=lines), symbol_table=SymbolTable())
+
+
+def _assemble_file(
+    asm_file_path: str, output_format: OutputFormat, single_pass: bool, use_cache: bool
+) -> tuple:
+    """
+    1つの.asmファイルを変換する(まとめて変換する場合にワーカープロセスから呼ばれる)
+    (出力ファイルのパス, キャッシュの集計)を返す
+    """
+    hack = Hack(asm_file_name=asm_file_path, output_format=output_format)
+    hack.do_binary_conversion(single_pass=single_pass, use_cache=use_cache)
+    return hack.hack_file_path, hack.cache_summary
+
+
+def assemble_files(
+    asm_file_paths: list,
+    jobs: int = None,
+    output_format: OutputFormat = OutputFormat.TEXT,
+    single_pass: bool = False,
+    use_cache: bool = False,
+) -> list:
+    """
+    複数の.asmファイルを1つのプロセスプールでまとめて変換する
+    ファイルごとにインタプリタを起動し直す必要がなくなる
+
+    Parameters
+    ----------
+    asm_file_paths : list
+        入力ファイルのパスのリスト
+    jobs : int
+        プロセス数 (Noneの場合はCPU数、1の場合は現在のプロセスで順に変換する)
+    """
+    tasks = [(asm_file_path, output_format, single_pass, use_cache) for asm_file_path in asm_file_paths]
+    if jobs == 1:
+        return [_assemble_file(*task) for task in tasks]
+    with Pool(processes=jobs) as pool:
+        return pool.starmap(_assemble_file, tasks)
+
+
+class PhaseProfiler:
+    def __init__(self) -> None:
+        """
+        処理の段階ごとに、経過時間とメモリ割り当て(tracemalloc)を計測する
+        """
+        self.phases = {}
+        tracemalloc.start()
+
+    @contextlib.contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """
+        withブロックの中を1つの段階として計測する
+        allocated_bytesは段階の終わりに残っている割り当て量の増分、
+        peak_bytesは段階の中での割り当て量の最大値(段階の開始時点からの増分)
+        """
+        tracemalloc.reset_peak()
+        start_bytes, _ = tracemalloc.get_traced_memory()
+        start = time.perf_counter()
+        yield
+        seconds = time.perf_counter() - start
+        end_bytes, peak_bytes = tracemalloc.get_traced_memory()
+        self.phases[name] = {
+            "seconds": seconds,
+            "allocated_bytes": end_bytes - start_bytes,
+            "peak_bytes": peak_bytes - start_bytes,
+        }
+
+    def stop(self) -> None:
+        tracemalloc.stop()
 
 
 class Hack:
-    def __init__(self, asm_file_name: str) -> None:
-        self.asm_file_path = f"./{asm_file_name}"
-        self.parser = Parser(asm_file_path=self.asm_file_path)
+    # キャッシュを使う場合に、ラベル宣言がなくても領域を区切る行数
+    REGION_MAX_LINES = 1024
+
+    def __init__(self, asm_file_name: str, output_format: OutputFormat = OutputFormat.TEXT) -> None:
+        """
+        Parameters
+        ----------
+        asm_file_name : str
+            入力ファイルのパス(相対パスでも絶対パスでもよい)
+        output_format : OutputFormat
+            出力形式
+        """
+        self.asm_file_path = asm_file_name
+        # 第2パスのParserは使うときに作る (キャッシュや並列の変換ではファイルを開いたままにしない)
+        self.parser = None
         self.symbol_table = SymbolTable()
-        # 出力ファイルのProg.hackを作成する
-        self.hack_file_path = f"./{asm_file_name.replace('asm', 'hack')}"
-        with open(self.hack_file_path, "w") as fp:
-            fp.write("")
+        # 出力ファイルのProg.hack(またはProg.hackbin)を入力と同じ場所に作成する
+        self.hack_file_path = f"{os.path.splitext(self.asm_file_path)[0]}.{output_format.value}"
+        self.writer = HackWriter(hack_file_path=self.hack_file_path, output_format=output_format)
+        # キャッシュを使った場合の集計 (convert_asm_to_hack_cachedで設定される)
+        self.cache_summary = None
+        # 命令の種類ごとの数 (create_symbol_tableで数える)
+        self.instruction_counts = {instruction: 0 for instruction in Instruction}
+        # --profileで実行した場合の計測結果 (convert_asm_to_hack_profiledで設定される)
+        self.profile = None
 
-    def do_binary_conversion(self) -> None:
+    def do_binary_conversion(
+        self,
+        single_pass: bool = False,
+        processes: int = None,
+        use_cache: bool = False,
+        profile: bool = False,
+    ) -> None:
         """
         第1パスでシンボルテーブルを作成
         第2パスでバイナリコードへ変換
+
+        Parameters
+        ----------
+        single_pass : bool
+            Trueの場合、入力を1回だけ読み、前方参照のラベルは最後にまとめて解決する
+        processes : int
+            指定した場合、入力をチャンクに分けてプロセスプールで並列に変換する
+            0ならCPU数だけプロセスを使う
+        use_cache : bool
+            Trueの場合、前回の結果のキャッシュを使い、変更された領域だけを変換する
+        profile : bool
+            Trueの場合、読み込み・ラベル収集・変換・書き込みの各段階を分けて実行し、
+            経過時間とメモリ割り当てをself.profileに記録する
+            計測するのは通常の2パスの変換なので、他のモードとは同時に指定できない
         """
+        if profile and (single_pass or processes is not None or use_cache):
+            raise Exception("profile cannot be combined with single_pass, processes or use_cache")
+        if profile:
+            self.convert_asm_to_hack_profiled()
+            return
+        if use_cache:
+            self.convert_asm_to_hack_cached()
+            return
+        if processes is not None:
+            self.convert_asm_to_hack_parallel(processes=processes or os.cpu_count())
+            return
+        if single_pass:
+            self.convert_asm_to_hack_single_pass()
+            return
         self.create_symbol_table()
         self.convert_asm_to_hack()
         
-    def create_symbol_table(self) -> None:
+    def create_symbol_table(self, lines: Iterable[str] = None) -> None:
         """
         第1パスで用いられる。ここでは、すべてのラベルシンボルがテーブルへ追加される。
         変数シンボルについては、第2パスで追加される。
+        命令の種類ごとの数もinstruction_countsに数えておく
+
+        Parameters
+        ----------
+        lines : Iterable[str]
+            指定した場合、入力ファイルの代わりにこの行の並びを読む
         """
         # ラベル宣言を格納するための行番号記録用
         line_number = 0
-        tmp_parser = Parser(asm_file_path=self.asm_file_path)
+        if lines is not None:
+            tmp_parser = Parser(lines=lines)
+        else:
+            tmp_parser = Parser(asm_file_path=self.asm_file_path)
         # tmp_parserを用いて、命令を一周し、シンボルテーブルを作成する
         while tmp_parser.has_more_lines():
             tmp_parser.advance()
             if tmp_parser.order is None:
                 continue
-            if tmp_parser.instruction_type() == Instruction.L:
+            instruction_type = tmp_parser.instruction_type()
+            self.instruction_counts[instruction_type] += 1
+            if instruction_type == Instruction.L:
                 symbol = tmp_parser.symbol()
                 self.symbol_table.addEntry(symbol=symbol, address=line_number)
                 continue
@@ -221,74 +809,287 @@ class Hack:
         del tmp_parser
 
     def convert_asm_to_hack(self) -> None:
+        for word in self.encode_instructions():
+            self.writer.write(word)
+        self.writer.close()
+
+    def encode_instructions(self) -> Iterator[int]:
+        """
+        第2パスで用いられる。self.parserの入力を16bitの整数へ変換して順に返す
+        self.parserがまだなければ、ここで入力ファイルを開く
+        """
+        if self.parser is None:
+            self.parser = Parser(asm_file_path=self.asm_file_path)
+
         # 各行(アセンブリ命令)を反復処理する
         # C命令については、各フィールドをバイナリーコードに変換して、連結する
         # A命令については、xxxをバイナリーコードに変換する
         # 変数シンボル参照をもつA命令については、シンボルテーブルでシンボルを検索し、なければ追加する。
-        # 変数シンボルを格納するためのRAM番号記録用(val_number>=16)
-        val_number = 16
-        
+        # 変数シンボルのアドレス(>=16)はシンボルテーブルが割り当てる
+
         while self.parser.has_more_lines():
             self.parser.advance()
             if self.parser.order is None:
                 continue
 
-            binary_code = ""
-            if self.parser.instruction_type() == Instruction.A:
+            instruction_type = self.parser.instruction_type()
+            if instruction_type == Instruction.A:
                 symbol = self.parser.symbol()
                 # A命令のxxxが整数かどうかで変数シンボルかを判定する
                 # symbol_is_intがFalseならば、変数シンボル
                 symbol_is_int = symbol.isdigit()
                 if symbol_is_int:
-                    symbol_int = int(symbol)
+                    word = Code.a_instruction(symbol)
                 else:
-                    # 変数シンボルの場合
-                    if self.symbol_table.contains(symbol=symbol):
-                        address = self.symbol_table.getAddress(symbol=symbol)
-                        symbol_int = int(address)
-                    else:
-                        self.symbol_table.addEntry(symbol=symbol, address=val_number)
-                        symbol_int = int(val_number)
-                        val_number += 1
-                # 0埋めの16bitバイナリへ変換
-                binary_16bit_str = f"{symbol_int:016b}"
-                binary_code += binary_16bit_str
-            elif self.parser.instruction_type() == Instruction.C:
-                dest_asm = self.parser.dest()
-                comp_asm = self.parser.comp()
-                jump_asm = self.parser.jump()
-                
-                dest_binary = Code.dest(dest_asm)
-                comp_binary = Code.comp(comp_asm)
-                jump_binary = Code.jump(jump_asm)
-                
-                binary_code += "111"
-                is_a = "1" if "M" in comp_asm else "0"
-                binary_code += is_a
-                binary_code += comp_binary
-                binary_code += dest_binary
-                binary_code += jump_binary
-            elif self.parser.instruction_type() == Instruction.L:
+                    # ラベルか定義済みシンボルならそのアドレス、なければ変数として割り当てる
+                    word = self.symbol_table.get_or_allocate(symbol=symbol)
+            elif instruction_type == Instruction.C:
+                word = Code.c_instruction(self.parser.order)
+            elif instruction_type == Instruction.L:
                 # 何もせず書き込まない
                 continue
 
-            with open(self.hack_file_path, "a") as fp:
-                fp.write(binary_code)
-                fp.write("\n")
+            yield word
+
+    def convert_asm_to_hack_profiled(self) -> None:
+        """
+        2パスの変換を、読み込み・ラベル収集・変換・書き込みの段階に分けて実行し、
+        段階ごとの経過時間とメモリ割り当てを計測してself.profileに記録する
+        メモリ割り当てはtracemallocで計測するので、経過時間にはその分の負荷が含まれる
+        readは通常の変換と同じく1行ずつ読むParserで入力を1周するだけの時間で、
+        labelとencodeもそれぞれ入力を1行ずつ読み直すので、その中にも読み込みの時間が含まれる
+        """
+        profiler = PhaseProfiler()
+        with profiler.phase("read"):
+            read_parser = Parser(asm_file_path=self.asm_file_path)
+            while read_parser.has_more_lines():
+                read_parser.advance()
+            del read_parser
+        with profiler.phase("label"):
+            self.create_symbol_table()
+        with profiler.phase("encode"):
+            words = array("H", self.encode_instructions())
+        with profiler.phase("write"):
+            self.writer.write_words(words)
+            self.writer.close()
+        profiler.stop()
+
+        self.profile = {
+            "asm_file_path": self.asm_file_path,
+            "hack_file_path": self.hack_file_path,
+            "phases": profiler.phases,
+            "total_seconds": sum(phase["seconds"] for phase in profiler.phases.values()),
+            "instructions": {
+                instruction.name: count for instruction, count in self.instruction_counts.items()
+            },
+            "symbol_table_size": len(self.symbol_table.table),
+            "words": len(words),
+        }
+
+    def convert_asm_to_hack_single_pass(self) -> None:
+        """
+        1パスでバイナリコードへ変換する
+        シンボルを参照するA命令は、その位置とシンボルを記録しておき(fixup)、
+        入力を読み終えた時点でラベルか変数かを判定してアドレスを埋める。
+        変数のアドレスはfixupの記録順(=初出順)に16から割り当てるので、
+        2パスの場合と同一の.hackファイルになる。
+        """
+        words = _assemble_single_pass(parser=Parser(asm_file_path=self.asm_file_path), symbol_table=self.symbol_table)
+        self.writer.write_words(words)
+        self.writer.close()
+
+    def _add_scanned_symbols(self, scan_results: list) -> None:
+        """
+        チャンク(領域)ごとのラベルとシンボルの初出順を、先頭から順にシンボルテーブルへ登録する
+        ラベルにはチャンクの先頭行番号を足し込み、ラベルでないシンボルは変数として16から割り当てる
+        """
+        line_number = 0
+        for n_instructions, labels, _ in scan_results:
+            for symbol, offset in labels:
+                self.symbol_table.addEntry(symbol=symbol, address=line_number + offset)
+            line_number += n_instructions
+        for _, _, symbols in scan_results:
+            for symbol in symbols:
+                self.symbol_table.get_or_allocate(symbol=symbol)
+
+    def convert_asm_to_hack_parallel(self, processes: int) -> None:
+        """
+        入力を行の境界でチャンクに分け、プロセスプールで並列にバイナリコードへ変換する
+        1. 各チャンクのラベルとシンボルの初出順を並列に集める
+        2. チャンクの先頭行番号を足し込んでラベルを登録し、
+           チャンク順にシンボルを見て変数を16から割り当てる(逐次版と同じ初出順になる)
+        3. 解決済みのシンボルテーブルで各チャンクを並列に変換し、順番に書き込む
+
+        Parameters
+        ----------
+        processes : int
+            プロセス数
+        """
+        # プロセス間で負荷が偏らないよう、プロセス数より細かく分割する
+        chunks = _split_into_chunks(asm_file_path=self.asm_file_path, n_chunks=processes * 4)
+        tasks = [(self.asm_file_path, start, end) for start, end in chunks]
+
+        with Pool(processes=processes) as pool:
+            scan_results = pool.starmap(_scan_chunk, tasks)
+
+        self._add_scanned_symbols(scan_results=scan_results)
+
+        with Pool(
+            processes=processes,
+            initializer=_init_encode_worker,
+            initargs=(self.symbol_table.table,),
+        ) as pool:
+            for words in pool.starmap(_encode_chunk, tasks):
+                self.writer.write_words(words)
+        self.writer.close()
+
+
+    def convert_asm_to_hack_cached(self) -> None:
+        """
+        前回の結果のキャッシュを使ってバイナリコードへ変換する
+        入力をラベル宣言ごと(長い場合はREGION_MAX_LINES行ごと)の領域に区切り、領域ごとにハッシュを取る。
+        ファイル全体が前回と同じならキャッシュの命令をそのまま使う。
+        そうでなければシンボルテーブルを作り直し、前回と同じであれば変更された領域だけを変換する。
+        ラベルの位置や変数の割り当てが変わった場合は、すべての領域を変換し直す。
+        """
+        with open(self.asm_file_path, "rb") as fp:
+            source = fp.read()
+        source_hash = hashlib.sha256(source).hexdigest()
+        regions = self._split_into_regions(lines=_split_lines(source.decode()))
+        region_hashes = [
+            hashlib.sha256("\n".join(region).encode()).hexdigest() for region in regions
+        ]
+
+        cache = AssemblyCache(asm_file_path=self.asm_file_path)
+        if source_hash == cache.source_hash:
+            status = "unchanged"
+            self.symbol_table.table = dict(cache.symbols)
+        else:
+            self._add_scanned_symbols(scan_results=[_scan_lines(region) for region in regions])
+            if self.symbol_table.table == cache.symbols:
+                status = "partial"
+            else:
+                # ラベルの位置か変数の割り当てが変わったので、キャッシュの命令は使えない
+                status = "symbols changed" if cache.symbols is not None else "no cache"
+                cache.regions = {}
+
+        region_words = {}
+        # キャッシュから読んだ命令の領域のハッシュ (同じ実行の中で変換した領域の繰り返しは含めない)
+        cached_hashes = set()
+        hits = 0
+        for region, region_hash in zip(regions, region_hashes):
+            if region_hash not in region_words:
+                words = cache.get_words(region_hash=region_hash)
+                if words is None:
+                    words = _encode_lines(region, self.symbol_table.table)
+                else:
+                    cached_hashes.add(region_hash)
+                region_words[region_hash] = words
+            if region_hash in cached_hashes:
+                hits += 1
+            self.writer.write_words(region_words[region_hash])
+        self.writer.close()
+
+        cache.save(source_hash=source_hash, symbols=self.symbol_table.table, regions=region_words)
+        self.cache_summary = {"status": status, "hits": hits, "regions": len(regions)}
+
+    @classmethod
+    def _split_into_regions(cls, lines: list) -> list:
+        """
+        行のリストを、ラベル宣言の行の直前(またはREGION_MAX_LINES行ごと)で区切る
+        行を挿入しても、影響はその行を含む領域にとどまる
+        """
+        regions = []
+        region = []
+        for line in lines:
+            order = line.replace(" ", "")
+            if region and (
+                (order.startswith("(") and order.endswith(")")) or len(region) >= cls.REGION_MAX_LINES
+            ):
+                regions.append(region)
+                region = []
+            region.append(line)
+        if region:
+            regions.append(region)
+        return regions
 
 
 def main():
     # コマンドライン引数で入力ファイルの名前を受け取る
-    args = sys.argv
-    if len(args) < 2:
+    arg_parser = argparse.ArgumentParser(description="Hackアセンブラ")
+    arg_parser.add_argument(
+        "asm_file_names",
+        nargs="*",
+        help="入力する.asmファイルの名前 (複数指定した場合はまとめて変換する)",
+    )
+    arg_parser.add_argument(
+        "--single-pass",
+        action="store_true",
+        help="入力を1回だけ読み、前方参照のラベルを最後に解決する",
+    )
+    arg_parser.add_argument(
+        "--format",
+        choices=[output_format.value for output_format in OutputFormat],
+        default=OutputFormat.TEXT.value,
+        help="出力形式 (hack: テキスト, hackbin: 16bitリトルエンディアンのROMイメージ)",
+    )
+    arg_parser.add_argument(
+        "--processes",
+        type=int,
+        default=None,
+        help="指定した数のプロセスでチャンクごとに並列に変換する (0ならCPU数)",
+    )
+    arg_parser.add_argument(
+        "--cache",
+        action="store_true",
+        help="前回の結果をキャッシュし、変更された部分だけを変換する",
+    )
+    arg_parser.add_argument(
+        "--jobs",
+        type=int,
+        default=None,
+        help="複数のファイルをまとめて変換するときのプロセス数 (デフォルトはCPU数)",
+    )
+    arg_parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="段階ごとの経過時間とメモリ割り当て、命令数、シンボルテーブルの大きさをJSONで出力する",
+    )
+    args = arg_parser.parse_args()
+    if not args.asm_file_names:
         print("ファイル名を入力してください。")
         return
-    asm_file_name = args[1]
+    output_format = OutputFormat(args.format)
 
-    hack = Hack(asm_file_name=asm_file_name)
-    # asmファイルをhackファイルへ (アセンブリ2バイナリ)
-    hack.do_binary_conversion()
+    if args.profile and (args.single_pass or args.processes is not None or args.cache):
+        arg_parser.error("--profileは--single-pass、--processes、--cacheと同時には指定できません")
+    if len(args.asm_file_names) > 1:
+        if args.processes is not None or args.profile:
+            arg_parser.error("--processesと--profileは複数のファイルをまとめて変換する場合には指定できません")
+        # 複数のファイルを1つのプロセスプールでまとめて変換する
+        results = assemble_files(
+            asm_file_paths=args.asm_file_names,
+            jobs=args.jobs,
+            output_format=output_format,
+            single_pass=args.single_pass,
+            use_cache=args.cache,
+        )
+    else:
+        hack = Hack(asm_file_name=args.asm_file_names[0], output_format=output_format)
+        # asmファイルをhackファイルへ (アセンブリ2バイナリ)
+        hack.do_binary_conversion(
+            single_pass=args.single_pass,
+            processes=args.processes,
+            use_cache=args.cache,
+            profile=args.profile,
+        )
+        if args.profile:
+            print(json.dumps(hack.profile, indent=2))
+        results = [(hack.hack_file_path, hack.cache_summary)]
 
+    for hack_file_path, summary in results:
+        if summary is not None:
+            print(f"{hack_file_path}: キャッシュ {summary['hits']}/{summary['regions']} 領域を再利用 ({summary['status']})")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
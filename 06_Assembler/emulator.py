@@ -0,0 +1,819 @@
+from array import array
+from typing import Iterable
+import argparse
+import hashlib
+import itertools
+import os
+import struct
+import sys
+import time
+import zlib
+
+import numpy as np
+
+from complete_version import COMP_MAP, PREDEFINED_SYMBOLS, OutputFormat, assemble
+
+
+# メモリマップ (アセンブラの定義済みシンボルと同じ)
+SCREEN = PREDEFINED_SYMBOLS["SCREEN"]
+KBD = PREDEFINED_SYMBOLS["KBD"]
+RAM_SIZE = 32768
+ROM_SIZE = 32768
+# 画面は1行32ワード(512ピクセル)で256行
+SCREEN_ROWS = 256
+SCREEN_ROW_WORDS = 32
+SCREEN_WIDTH = SCREEN_ROW_WORDS * 16
+# 画面を書き出す形式
+FRAME_FORMATS = ("ppm", "png")
+# 1回の実行で進めるサイクル数の上限
+MAX_CYCLES = 10 ** 7
+
+# 事前デコードした命令の種類
+OP_A = 0
+# yにAレジスタを使うC命令
+OP_C_A = 1
+# yにM(RAM[A])を使うC命令
+OP_C_M = 2
+
+# destのビット
+DEST_A = 0b100
+DEST_D = 0b010
+DEST_M = 0b001
+# jumpのビット
+JUMP_LT = 0b100
+JUMP_EQ = 0b010
+JUMP_GT = 0b001
+JUMP_ALWAYS = JUMP_LT | JUMP_EQ | JUMP_GT
+# jumpのビット -> 基本ブロックのコンパイルで使う分岐の条件式
+JUMP_CONDITIONS = {
+    JUMP_GT: "out > 0",
+    JUMP_EQ: "out == 0",
+    JUMP_EQ | JUMP_GT: "out >= 0",
+    JUMP_LT: "out < 0",
+    JUMP_LT | JUMP_GT: "out != 0",
+    JUMP_LT | JUMP_EQ: "out <= 0",
+}
+
+# ROMのハッシュ -> {ブロックの先頭アドレス: (コンパイルした関数, 命令数)}
+# 同じROMを読み込んだエミュレータの間で、コンパイル済みのブロックを共有する
+_BLOCK_CACHE = {}
+
+
+def _wrap(value: int) -> int:
+    """
+    16bitで桁あふれさせ、-32768~32767の値にする
+    """
+    return ((value + 0x8000) & 0xFFFF) - 0x8000
+
+
+# compのニーモニックごとのALUの計算式。xはDレジスタ、yはAレジスタまたはM
+# 値はすべて-32768~32767の符号付きで扱う
+# 1命令ずつの実行ではlambdaにし、基本ブロックのコンパイルでは式をそのまま埋め込む
+COMP_EXPRESSIONS = {
+    "0": "0",
+    "1": "1",
+    "-1": "-1",
+    "D": "{x}",
+    "A": "{y}",
+    "!D": "~{x}",
+    "!A": "~{y}",
+    "-D": "-{x} if {x} != -0x8000 else {x}",
+    "-A": "-{y} if {y} != -0x8000 else {y}",
+    "D+1": "{x} + 1 if {x} != 0x7FFF else -0x8000",
+    "A+1": "{y} + 1 if {y} != 0x7FFF else -0x8000",
+    "D-1": "{x} - 1 if {x} != -0x8000 else 0x7FFF",
+    "A-1": "{y} - 1 if {y} != -0x8000 else 0x7FFF",
+    "D+A": "(({x} + {y} + 0x8000) & 0xFFFF) - 0x8000",
+    "D-A": "(({x} - {y} + 0x8000) & 0xFFFF) - 0x8000",
+    "A-D": "(({y} - {x} + 0x8000) & 0xFFFF) - 0x8000",
+    "D&A": "{x} & {y}",
+    "D|A": "{x} | {y}",
+}
+
+
+def _alu_function(comp_bits: int):
+    """
+    ニーモニックのないcompのビット(zx nx zy ny f no)を、ALUの定義どおりに計算する関数にする
+    """
+    def alu(x: int, y: int) -> int:
+        if comp_bits & 0b100000:
+            x = 0
+        if comp_bits & 0b010000:
+            x = ~x
+        if comp_bits & 0b001000:
+            y = 0
+        if comp_bits & 0b000100:
+            y = ~y
+        out = _wrap(x + y) if comp_bits & 0b000010 else x & y
+        if comp_bits & 0b000001:
+            out = ~out
+        return out
+    return alu
+
+
+# compの6bit -> ALUの計算式 (ニーモニックのあるものだけ)
+COMP_EXPRESSIONS_BY_BITS = {
+    int(COMP_MAP[mnemonic], 2): expression for mnemonic, expression in COMP_EXPRESSIONS.items()
+}
+# compの6bit -> ALUの計算をする関数
+COMP_FUNCTIONS = {
+    comp_bits: eval(f"lambda x, y: {expression.format(x='x', y='y')}")
+    for comp_bits, expression in COMP_EXPRESSIONS_BY_BITS.items()
+}
+# ALUの計算をする関数 -> 計算式 (基本ブロックのコンパイルで使う)
+COMP_EXPRESSION_BY_FUNCTION = {
+    COMP_FUNCTIONS[comp_bits]: expression for comp_bits, expression in COMP_EXPRESSIONS_BY_BITS.items()
+}
+for _comp_bits in range(64):
+    COMP_FUNCTIONS.setdefault(_comp_bits, _alu_function(_comp_bits))
+
+
+def load_rom(hack_file_path: str) -> array:
+    """
+    .hack(テキスト)または.hackbin(16bitリトルエンディアンのROMイメージ)を読み込む
+    .asmの場合はメモリ上でアセンブルする
+    """
+    if hack_file_path.endswith(".asm"):
+        with open(hack_file_path, "r") as fp:
+            words = array("H", assemble(fp))
+    elif hack_file_path.endswith(f".{OutputFormat.BINARY.value}"):
+        words = array("H")
+        with open(hack_file_path, "rb") as fp:
+            words.frombytes(fp.read())
+        if sys.byteorder == "big":
+            words.byteswap()
+    else:
+        with open(hack_file_path, "r") as fp:
+            words = array("H", (int(line, 2) for line in fp if line.strip()))
+    if len(words) > ROM_SIZE:
+        raise Exception(f"ROM is too large: {len(words)} words")
+    return words
+
+
+def decode(words: Iterable[int]) -> list:
+    """
+    命令を(命令の種類, 値またはcompの関数, destのビット, jumpのビット)の表へ事前デコードする
+    A命令は値を、C命令はALUの計算をする関数を持つ
+    """
+    program = []
+    for word in words:
+        if not word & 0x8000:
+            program.append((OP_A, word, 0, 0))
+            continue
+        op = OP_C_M if word & 0x1000 else OP_C_A
+        program.append((op, COMP_FUNCTIONS[(word >> 6) & 0b111111], (word >> 3) & 0b111, word & 0b111))
+    return program
+
+
+def find_jump_targets(words: Iterable[int]) -> set:
+    """
+    @X の直後にjumpのあるC命令が続く箇所から、静的に分かるジャンプ先Xを集める
+    (Mから読んだ戻り先などへのジャンプは、実行時に初めて現れたアドレスからブロックを作る)
+    """
+    targets = set()
+    previous = None
+    for word in words:
+        if word & 0x8000 and word & 0b111 and previous is not None and not previous & 0x8000:
+            targets.add(previous)
+        previous = word
+    return targets
+
+
+def is_halt_loop(program: list, pc: int) -> bool:
+    """
+    pcの命令が、@X / 0;JMP のような末尾の無限ループのjumpか判断する
+    直前が自分自身のアドレスを指すA命令(@X, X=pc-1)で、pcがdestのない無条件のjumpである場合に限る
+    destがあると、飛ぶたびにRAMやレジスタが書き換わり続けるので停止とはみなさない
+
+    Parameters
+    ----------
+    program : list
+        (命令の種類, 値, destのビット, jumpのビット)の表
+    pc : int
+        jumpの命令のアドレス
+    """
+    if pc <= 0:
+        return False
+    op, _, dest, jump = program[pc]
+    return op != OP_A and not dest and jump == JUMP_ALWAYS and program[pc - 1] == (OP_A, pc - 1, 0, 0)
+
+
+def compile_block(program: list, start: int, leaders: set) -> tuple:
+    """
+    startから始まる基本ブロックを1つのPython関数にコンパイルし、(関数, 命令数)を返す
+    ブロックはjumpのある命令で終わるか、次のジャンプ先の直前かROMの末尾で終わる
+    関数はfunction(mem, a, d)で、(次のPC, a, d)を返す。A/Dレジスタは関数内のローカル変数に置く
+    """
+    body = []
+    namespace = {}
+    pc = start
+    next_pc = None
+    while pc < len(program):
+        if pc != start and pc in leaders:
+            break
+        op, arg, dest, jump = program[pc]
+        pc += 1
+        if op == OP_A:
+            body.append(f"a = {arg}")
+            continue
+        y = "a"
+        if op == OP_C_M and (dest or jump != JUMP_ALWAYS):
+            body.append("m = mem[a]")
+            y = "m"
+        body.extend(_compile_c_instruction(arg=arg, y=y, dest=dest, jump=jump, namespace=namespace))
+        if jump:
+            next_pc = pc
+            break
+    if next_pc is None:
+        next_pc = pc
+    body.append(f"return {next_pc}, a, d")
+    source = "def block(mem, a, d):\n" + "".join(f"    {line}\n" for line in body)
+    exec(compile(source, f"<block {start}>", "exec"), namespace)
+    return namespace["block"], pc - start
+
+
+def _compile_c_instruction(arg, y: str, dest: int, jump: int, namespace: dict) -> list:
+    """
+    C命令1つ分のPythonの文を返す
+    compの式はCOMP_EXPRESSIONSから埋め込み、ニーモニックのないcompだけ関数を呼ぶ
+    """
+    expression = COMP_EXPRESSION_BY_FUNCTION.get(arg)
+    if expression is None:
+        name = f"alu_{len(namespace)}"
+        namespace[name] = arg
+        expression = f"{name}(d, {y})"
+    else:
+        expression = expression.format(x="d", y=y)
+
+    lines = []
+    if not jump:
+        if dest == DEST_D:
+            return [f"d = {expression}"]
+        if dest == DEST_A:
+            return [f"a = {expression}"]
+        if dest == DEST_M:
+            return [f"mem[a] = {expression}"]
+    elif jump == JUMP_ALWAYS and not dest:
+        # 0;JMPなど。計算結果は使わない
+        # 末尾の無限ループでもジャンプ先を返すだけで、停止かどうかは実行側が判断する
+        return ["return a, a, d"]
+    if not dest and not jump:
+        return lines
+    # ジャンプ先は書き換え前のAレジスタ
+    target = "a"
+    if jump and dest & DEST_A:
+        lines.append("t = a")
+        target = "t"
+    lines.append(f"out = {expression}")
+    if dest & DEST_M:
+        lines.append("mem[a] = out")
+    if dest & DEST_D:
+        lines.append("d = out")
+    if dest & DEST_A:
+        lines.append("a = out")
+    if jump == JUMP_ALWAYS:
+        lines.append(f"return {target}, a, d")
+    elif jump:
+        lines.append(f"if {JUMP_CONDITIONS[jump]}:")
+        lines.append(f"    return {target}, a, d")
+    return lines
+
+
+class HackEmulator:
+    def __init__(self, words: Iterable[int], compile_blocks: bool = False, profile: bool = False) -> None:
+        """
+        HackのCPUをエミュレートする
+        ROMは事前デコードした表、RAMはint16のNumPy配列で、
+        SCREEN(16384~)とKBD(24576)はアセンブラのシンボルと同じアドレスに置く
+
+        Parameters
+        ----------
+        words : Iterable[int]
+            ROMに書き込む命令 (16bitの整数)
+        compile_blocks : bool
+            Trueの場合、基本ブロックを初めて実行するときにPython関数へコンパイルし、
+            ブロック単位で実行する。コンパイルしたブロックはROMのハッシュごとにキャッシュする
+        profile : bool
+            Trueの場合、ROMのアドレスごとの実行回数を数える (execution_counts()で取り出す)
+            ブロック単位で実行する場合はブロックの実行回数だけを数え、後から命令ごとに展開する
+        """
+        self.words = array("H", words)
+        self.program = decode(self.words)
+        self.compile_blocks = compile_blocks
+        self.leaders = find_jump_targets(self.words)
+        self.rom_hash = hashlib.sha256(self.words.tobytes()).hexdigest()
+        self.blocks = _BLOCK_CACHE.setdefault(self.rom_hash, {})
+        self.profile = profile
+        # 1命令ずつ実行したときの、アドレスごとの実行回数
+        self.instruction_counts = [0] * len(self.program)
+        # ブロック単位で実行したときの、ブロックの先頭アドレスごとの実行回数
+        self.block_counts = [0] * len(self.program)
+        self.ram = np.zeros(RAM_SIZE, dtype=np.int16)
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        レジスタとPCを0に戻す (RAMはそのまま)
+        """
+        self.a_register = 0
+        self.d_register = 0
+        self.pc = 0
+        self.cycles = 0
+        self.halted = False
+
+    def execution_counts(self) -> np.ndarray:
+        """
+        ROMのアドレスごとの実行回数を返す (profile=Trueの場合のみ数えている)
+        ブロックの実行回数は、ブロックに含まれるすべての命令へ足し込む
+        """
+        n_words = len(self.program)
+        counts = np.array(self.instruction_counts, dtype=np.int64)
+        block_counts = np.array(self.block_counts, dtype=np.int64)
+        starts = np.flatnonzero(block_counts)
+        if len(starts):
+            lengths = np.array([self.blocks[start][1] for start in starts], dtype=np.int64)
+            # ブロックの範囲[start, start+length)へ加算するため、差分を累積和にする
+            delta = np.zeros(n_words + 1, dtype=np.int64)
+            np.add.at(delta, starts, block_counts[starts])
+            np.add.at(delta, starts + lengths, -block_counts[starts])
+            counts += np.cumsum(delta)[:n_words]
+        return counts
+
+    @property
+    def screen(self) -> np.ndarray:
+        """
+        画面のメモリ (256行 x 32ワード) のビュー
+        """
+        return self.ram[SCREEN:KBD].reshape(SCREEN_ROWS, SCREEN_ROW_WORDS)
+
+    def set_key(self, key_code: int) -> None:
+        """
+        キーボードのメモリ (KBD) にキーコードを書き込む。0なら押されていない
+        """
+        self.ram[KBD] = key_code
+
+    def _is_halt_loop(self, pc: int, target: int) -> bool:
+        """
+        pcのjumpでtargetへ飛んだ場合に、末尾の無限ループ(is_halt_loop)に入ったか判断する
+        """
+        return target == pc - 1 and is_halt_loop(program=self.program, pc=pc)
+
+    def run(self, max_cycles: int = MAX_CYCLES) -> int:
+        """
+        ROMの外へ出るか、末尾の無限ループに入るか、max_cyclesサイクル実行するまで進める
+        実行したサイクル数を返す
+        """
+        if self.compile_blocks:
+            return self._run_blocks(max_cycles=max_cycles)
+        return self._run_instructions(max_cycles=max_cycles)
+
+    def _run_blocks(self, max_cycles: int) -> int:
+        """
+        コンパイルした基本ブロック単位で実行する
+        残りのサイクル数がブロックの命令数より少なくなったら、1命令ずつの実行に切り替える
+        """
+        blocks = self.blocks
+        block_counts = self.block_counts if self.profile else None
+        n_words = len(self.program)
+        mem = memoryview(self.ram)
+        a = self.a_register
+        d = self.d_register
+        pc = self.pc
+        cycles = 0
+        while True:
+            if not 0 <= pc < n_words:
+                self.halted = True
+                break
+            block = blocks.get(pc)
+            if block is None:
+                block = compile_block(program=self.program, start=pc, leaders=self.leaders)
+                blocks[pc] = block
+            function, length = block
+            if cycles + length > max_cycles:
+                break
+            if block_counts is not None:
+                block_counts[pc] += 1
+            next_pc, a, d = function(mem, a, d)
+            cycles += length
+            # 停止の判定はブロックのコンパイルでは行わず、1命令ずつの実行と同じis_halt_loopで判断する
+            # (@X / M=M-1;JMP のようにdestのある自己ループは止めずに実行を続ける)
+            # X+1も別のジャンプ先だと @X と jump が別のブロックになるので、ブロックの最後の命令で調べる
+            last = pc + length - 1
+            pc = next_pc
+            if next_pc == last - 1 and is_halt_loop(program=self.program, pc=last):
+                self.halted = True
+                break
+        self.a_register = a
+        self.d_register = d
+        self.pc = pc
+        self.cycles += cycles
+        if not self.halted and cycles < max_cycles:
+            cycles += self._run_instructions(max_cycles=max_cycles - cycles)
+        return cycles
+
+    def _run_instructions(self, max_cycles: int) -> int:
+        """
+        事前デコードした表を1命令ずつ実行する
+        """
+        program = self.program
+        n_words = len(program)
+        instruction_counts = self.instruction_counts if self.profile else None
+        # memoryviewを通すとNumPyの配列の要素をPythonのintとして速く読み書きできる
+        mem = memoryview(self.ram)
+        a = self.a_register
+        d = self.d_register
+        pc = self.pc
+        cycles = 0
+        while cycles < max_cycles:
+            if not 0 <= pc < n_words:
+                self.halted = True
+                break
+            op, arg, dest, jump = program[pc]
+            cycles += 1
+            if instruction_counts is not None:
+                instruction_counts[pc] += 1
+            if op == OP_A:
+                a = arg
+                pc += 1
+                continue
+            out = arg(d, mem[a]) if op == OP_C_M else arg(d, a)
+            address = a
+            if dest:
+                if dest & DEST_M:
+                    mem[address] = out
+                if dest & DEST_D:
+                    d = out
+                if dest & DEST_A:
+                    a = out
+            if jump and (
+                (jump & JUMP_LT and out < 0)
+                or (jump & JUMP_EQ and out == 0)
+                or (jump & JUMP_GT and out > 0)
+            ):
+                halted = self._is_halt_loop(pc=pc, target=address)
+                pc = address
+                if halted:
+                    self.halted = True
+                    break
+            else:
+                pc += 1
+        # 最後のサイクルでROMの外へ出た場合も、ブロック単位の実行と同じく停止とする
+        if not 0 <= pc < n_words:
+            self.halted = True
+        self.a_register = a
+        self.d_register = d
+        self.pc = pc
+        self.cycles += cycles
+        return cycles
+
+
+class ScreenRecorder:
+    def __init__(self, emulator: HackEmulator) -> None:
+        """
+        エミュレータの画面のメモリを512x256の画像にし、PPM/PNGのフレームとして書き出す
+        前回のupdate()から内容の変わった行(ダーティな行)だけをビット展開し直す
+
+        Parameters
+        ----------
+        emulator : HackEmulator
+            画面を記録するエミュレータ
+        """
+        self.emulator = emulator
+        # 最後に画像へ反映した画面のメモリ
+        self.rendered_screen = np.zeros((SCREEN_ROWS, SCREEN_ROW_WORDS), dtype=np.int16)
+        # 8bitのグレースケール画像。Hackの画面は1が黒
+        self.image = np.full((SCREEN_ROWS, SCREEN_WIDTH), 255, dtype=np.uint8)
+        self.frame_count = 0
+        # 各update()で描き直した行数の合計
+        self.dirty_rows = 0
+        self.update()
+
+    def update(self) -> int:
+        """
+        前回から書き換わった行だけを画像へ反映し、その行数を返す
+        ワードのbit0が左端のピクセルなので、リトルエンディアンのバイト列をbit順の下位から展開する
+        """
+        screen = self.emulator.screen
+        rows = np.flatnonzero((screen != self.rendered_screen).any(axis=1))
+        if len(rows):
+            words = screen[rows].astype("<u2")
+            pixels = np.unpackbits(words.view(np.uint8), axis=1, bitorder="little")
+            self.image[rows] = np.where(pixels, 0, 255)
+            self.rendered_screen[rows] = screen[rows]
+            self.dirty_rows += len(rows)
+        return len(rows)
+
+    def write_ppm(self, path: str) -> None:
+        """
+        画像をバイナリのPPM(P6)として書き出す
+        """
+        rgb = np.repeat(self.image[:, :, np.newaxis], 3, axis=2)
+        with open(path, "wb") as fp:
+            fp.write(f"P6\n{SCREEN_WIDTH} {SCREEN_ROWS}\n255\n".encode())
+            fp.write(rgb.tobytes())
+
+    def write_png(self, path: str) -> None:
+        """
+        画像を8bitグレースケールのPNGとして書き出す (標準ライブラリのzlibだけを使う)
+        """
+        def chunk(chunk_type: bytes, data: bytes) -> bytes:
+            body = chunk_type + data
+            return struct.pack(">I", len(data)) + body + struct.pack(">I", zlib.crc32(body))
+
+        # 各行の先頭にフィルタの種類(0: なし)を置く
+        raw = np.hstack([np.zeros((SCREEN_ROWS, 1), dtype=np.uint8), self.image])
+        header = struct.pack(">IIBBBBB", SCREEN_WIDTH, SCREEN_ROWS, 8, 0, 0, 0, 0)
+        with open(path, "wb") as fp:
+            fp.write(b"\x89PNG\r\n\x1a\n")
+            fp.write(chunk(b"IHDR", header))
+            fp.write(chunk(b"IDAT", zlib.compress(raw.tobytes())))
+            fp.write(chunk(b"IEND", b""))
+
+    def write_frame(self, frames_dir: str, frame_format: str = "ppm") -> str:
+        """
+        画面を更新し、frames_dir/frame_00000.ppm のような連番のファイルへ書き出す
+        書き出したファイルのパスを返す
+        """
+        self.update()
+        path = os.path.join(frames_dir, f"frame_{self.frame_count:05d}.{frame_format}")
+        if frame_format == "png":
+            self.write_png(path)
+        else:
+            self.write_ppm(path)
+        self.frame_count += 1
+        return path
+
+
+def vector_alu(comp_bits: int, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """
+    compのビット(zx nx zy ny f no)どおりに、int16の配列をまとめて計算する
+    int16の加算は16bitで桁あふれするので、Hackの加算と同じ結果になる
+    """
+    if comp_bits & 0b100000:
+        x = np.zeros_like(x)
+    if comp_bits & 0b010000:
+        x = ~x
+    if comp_bits & 0b001000:
+        y = np.zeros_like(y)
+    if comp_bits & 0b000100:
+        y = ~y
+    out = x + y if comp_bits & 0b000010 else x & y
+    if comp_bits & 0b000001:
+        out = ~out
+    return out
+
+
+class BatchHackEmulator:
+    def __init__(self, words: Iterable[int], n_instances: int) -> None:
+        """
+        同じROMをRAMの初期値だけ変えてn_instances個同時に実行する
+        RAMは(n_instances, 32768)、A/D/PCはインスタンスごとの配列で持ち、
+        1命令を、そのPCにいるインスタンスへまとめて配列演算で適用する
+        分岐でPCが分かれた場合は、PCが最も小さいインスタンスから進め、他は待たせる
+        (ループを抜けたインスタンスは、残りのインスタンスが追いつくと再び揃って進む)
+
+        Parameters
+        ----------
+        words : Iterable[int]
+            ROMに書き込む命令 (16bitの整数)
+        n_instances : int
+            同時に実行するインスタンスの数
+        """
+        self.words = array("H", words)
+        self.program = []
+        for word in self.words:
+            if not word & 0x8000:
+                self.program.append((OP_A, word, 0, 0))
+            else:
+                op = OP_C_M if word & 0x1000 else OP_C_A
+                self.program.append((op, (word >> 6) & 0b111111, (word >> 3) & 0b111, word & 0b111))
+        self.n_instances = n_instances
+        self.ram = np.zeros((n_instances, RAM_SIZE), dtype=np.int16)
+        self.a_register = np.zeros(n_instances, dtype=np.int16)
+        self.d_register = np.zeros(n_instances, dtype=np.int16)
+        self.pc = np.zeros(n_instances, dtype=np.int64)
+        self.cycles = np.zeros(n_instances, dtype=np.int64)
+        self.halted = np.zeros(n_instances, dtype=bool)
+        # 命令を実行した回数 (インスタンスをまとめて1回と数える)
+        self.steps = 0
+
+    def set_ram(self, address: int, values) -> None:
+        """
+        全インスタンスのRAM[address]に、インスタンスごとの値(または共通の値)を書き込む
+        """
+        values = np.asarray(values, dtype=np.int64)
+        self.ram[:, address] = (((values + 0x8000) & 0xFFFF) - 0x8000).astype(np.int16)
+
+    def run(self, max_cycles: int = MAX_CYCLES) -> int:
+        """
+        すべてのインスタンスが停止するか、max_cyclesサイクル実行するまで進める
+        実行した命令の回数 (インスタンスをまとめて1回と数える) を返す
+        """
+        program = self.program
+        n_words = len(program)
+        ram = self.ram
+        a = self.a_register
+        d = self.d_register
+        pc = self.pc
+        cycles = self.cycles
+        halted = self.halted
+        halted |= (pc < 0) | (pc >= n_words)
+        steps = 0
+        while True:
+            active = ~halted & (cycles < max_cycles)
+            if not active.any():
+                break
+            current = int(pc[active].min())
+            rows = np.flatnonzero(active & (pc == current))
+            op, arg, dest, jump = program[current]
+            steps += 1
+            cycles[rows] += 1
+            if op == OP_A:
+                a[rows] = arg
+                pc[rows] += 1
+                if current + 1 >= n_words:
+                    halted[rows] = True
+                continue
+            # ジャンプ先は書き換え前のAレジスタ、RAMのアドレスはその下位15bit
+            target = a[rows].astype(np.int64)
+            address = target & 0x7FFF
+            x = d[rows]
+            y = ram[rows, address] if op == OP_C_M else a[rows]
+            out = vector_alu(comp_bits=arg, x=x, y=y)
+            if dest & DEST_M:
+                ram[rows, address] = out
+            if dest & DEST_D:
+                d[rows] = out
+            if dest & DEST_A:
+                a[rows] = out
+            if not jump:
+                pc[rows] += 1
+                if current + 1 >= n_words:
+                    halted[rows] = True
+                continue
+            taken = np.zeros(len(rows), dtype=bool)
+            if jump & JUMP_LT:
+                taken |= out < 0
+            if jump & JUMP_EQ:
+                taken |= out == 0
+            if jump & JUMP_GT:
+                taken |= out > 0
+            next_pc = np.where(taken, target, current + 1)
+            pc[rows] = next_pc
+            # HackEmulatorと同じ判定 (destのない @X / 0;JMP だけを停止とみなす)
+            if is_halt_loop(program=program, pc=current):
+                halted[rows[taken & (target == current - 1)]] = True
+            halted[rows[(next_pc < 0) | (next_pc >= n_words)]] = True
+        self.steps += steps
+        return steps
+
+
+def parse_ram_assignment(text: str) -> tuple:
+    """
+    ADDRESS=VALUE の形式の文字列を(アドレス, 値)にする
+    """
+    address, separator, value = text.partition("=")
+    if not separator:
+        raise argparse.ArgumentTypeError(f"ADDRESS=VALUE の形式で指定してください: {text}")
+    return int(address), int(value)
+
+
+def parse_ram_range(text: str) -> tuple:
+    """
+    START:END の形式の文字列を(開始アドレス, 終了アドレス)にする
+    """
+    start, separator, end = text.partition(":")
+    if not separator:
+        raise argparse.ArgumentTypeError(f"START:END の形式で指定してください: {text}")
+    return int(start), int(end)
+
+
+def _parse_ram_sweep(text: str) -> tuple:
+    """
+    ADDRESS=START:END の形式の文字列を(アドレス, range(START, END))にする
+    """
+    address, separator, value_range = text.partition("=")
+    start, range_separator, end = value_range.partition(":")
+    if not separator or not range_separator:
+        raise argparse.ArgumentTypeError(f"ADDRESS=START:END の形式で指定してください: {text}")
+    return int(address), range(int(start), int(end))
+
+
+def run_sweep(words: array, sweeps: list, ram: list, dumps: list, max_cycles: int) -> None:
+    """
+    sweepsのアドレスごとの値のすべての組み合わせを、BatchHackEmulatorで一度に実行し、
+    インスタンスごとに初期値とdumpsの範囲のRAMを表示する
+    """
+    combinations = list(itertools.product(*(values for _, values in sweeps)))
+    emulator = BatchHackEmulator(words=words, n_instances=len(combinations))
+    for address, value in ram:
+        emulator.set_ram(address=address, values=value)
+    for column, (address, _) in enumerate(sweeps):
+        emulator.set_ram(address=address, values=[combination[column] for combination in combinations])
+    start = time.perf_counter()
+    steps = emulator.run(max_cycles=max_cycles)
+    seconds = time.perf_counter() - start
+
+    total_cycles = int(emulator.cycles.sum())
+    print(
+        f"{len(combinations)} インスタンス: {steps} ステップ, 合計 {total_cycles} サイクル, "
+        f"停止 {int(emulator.halted.sum())} 個"
+    )
+    print(f"{seconds:.3f} 秒, {total_cycles / max(seconds, 1e-9):,.0f} 命令/秒")
+    dump_addresses = [address for start_address, end_address in dumps for address in range(start_address, end_address)]
+    for instance, combination in enumerate(combinations):
+        inputs = " ".join(f"RAM[{address}]={value}" for (address, _), value in zip(sweeps, combination))
+        outputs = " ".join(f"RAM[{address}]={emulator.ram[instance, address]}" for address in dump_addresses)
+        print(f"{inputs} -> {outputs}")
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="HackのCPUエミュレータ")
+    arg_parser.add_argument("hack_file_name", help="実行する.hack、.hackbin、または.asmファイル")
+    arg_parser.add_argument("--max-cycles", type=int, default=MAX_CYCLES, help="実行するサイクル数の上限")
+    arg_parser.add_argument(
+        "--ram",
+        type=parse_ram_assignment,
+        action="append",
+        default=[],
+        metavar="ADDRESS=VALUE",
+        help="実行前のRAMの値 (複数指定できる)",
+    )
+    arg_parser.add_argument(
+        "--compile",
+        action="store_true",
+        help="基本ブロックごとにPython関数へコンパイルして実行する",
+    )
+    arg_parser.add_argument("--key", type=int, default=0, help="押し続けるキーのコード (KBDの値)")
+    arg_parser.add_argument(
+        "--dump",
+        type=parse_ram_range,
+        action="append",
+        default=[],
+        metavar="START:END",
+        help="実行後に表示するRAMの範囲 (複数指定できる)",
+    )
+    arg_parser.add_argument("--frames", default=None, help="画面のフレームを書き出すディレクトリ")
+    arg_parser.add_argument(
+        "--frame-interval",
+        type=int,
+        default=100000,
+        help="フレームを書き出す間隔 (サイクル数)",
+    )
+    arg_parser.add_argument(
+        "--frame-format",
+        choices=FRAME_FORMATS,
+        default="ppm",
+        help="フレームの形式",
+    )
+    arg_parser.add_argument(
+        "--sweep",
+        type=_parse_ram_sweep,
+        action="append",
+        default=[],
+        metavar="ADDRESS=START:END",
+        help="RAM[ADDRESS]をSTART~END-1に変えたすべての組み合わせを、まとめて並べて実行する (複数指定できる)",
+    )
+    args = arg_parser.parse_args()
+
+    if args.sweep:
+        if args.compile:
+            arg_parser.error("--sweepと--compileは同時に指定できません")
+        run_sweep(
+            words=load_rom(hack_file_path=args.hack_file_name),
+            sweeps=args.sweep,
+            ram=args.ram + [(KBD, args.key)],
+            dumps=args.dump,
+            max_cycles=args.max_cycles,
+        )
+        return
+
+    emulator = HackEmulator(words=load_rom(hack_file_path=args.hack_file_name), compile_blocks=args.compile)
+    for address, value in args.ram:
+        emulator.ram[address] = _wrap(value)
+    emulator.set_key(key_code=args.key)
+    start = time.perf_counter()
+    if args.frames is None:
+        cycles = emulator.run(max_cycles=args.max_cycles)
+    else:
+        # frame_intervalサイクルごとに止めて、画面を書き出す
+        os.makedirs(args.frames, exist_ok=True)
+        recorder = ScreenRecorder(emulator=emulator)
+        cycles = 0
+        while cycles < args.max_cycles and not emulator.halted:
+            cycles += emulator.run(max_cycles=min(args.frame_interval, args.max_cycles - cycles))
+            recorder.write_frame(frames_dir=args.frames, frame_format=args.frame_format)
+    seconds = time.perf_counter() - start
+
+    status = "停止" if emulator.halted else "上限に到達"
+    print(f"{os.path.basename(args.hack_file_name)}: {cycles} サイクル ({status})")
+    print(f"{seconds:.3f} 秒, {cycles / max(seconds, 1e-9):,.0f} 命令/秒")
+    if args.frames is not None:
+        print(f"{recorder.frame_count} フレームを書き出し ({recorder.dirty_rows} 行を描き直し)")
+    for start_address, end_address in args.dump:
+        for address in range(start_address, end_address):
+            print(f"RAM[{address}] = {emulator.ram[address]}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,258 @@
+from typing import Iterable
+import argparse
+import os
+import re
+import time
+
+import numpy as np
+
+from complete_version import Instruction, Parser, assemble
+from emulator import JUMP_ALWAYS, MAX_CYCLES, HackEmulator
+
+
+# ラベルをまとめるときに、連番の部分を置き換える正規表現 (RET_ADDRESS_CALL12 -> RET_ADDRESS_CALL*)
+LABEL_NUMBER_PATTERN = re.compile(r"\d+")
+# ループとみなす範囲の最大命令数
+# 共有ルーチン (call/returnの共通部分) への遠いジャンプも後ろ向きなので、大きすぎる範囲は除く
+MAX_LOOP_SIZE = 1000
+
+
+class SourceMap:
+    def __init__(self, lines: Iterable[str]) -> None:
+        """
+        ROMのアドレスから.asmの行・ラベル・直前のコメントへの対応を作る
+        アドレスの数え方はHack.create_symbol_tableと同じ
+        (L命令はアドレスを進めず、それ以外の命令ごとに1つ進める)
+
+        Parameters
+        ----------
+        lines : Iterable[str]
+            .asmファイルの行
+        """
+        self.source_lines = [line.rstrip("\r\n") for line in lines]
+        # アドレスごとの (.asmの行番号(1始まり), 命令, 直前のラベル, ラベルからのオフセット, 直前のコメント)
+        self.entries = []
+        # アドレス -> そのアドレスに置かれたラベルのリスト
+        self.labels = {}
+        parser = Parser(lines=self.source_lines)
+        line_index = 0
+        line_number = 0
+        label = None
+        label_address = 0
+        comment = None
+        while parser.has_more_lines():
+            parser.advance()
+            raw_line = self.source_lines[line_index].strip()
+            line_index += 1
+            if parser.order is None:
+                # VMトランスレータは各VMコマンドの前にコメントを書くので、命令の由来として覚えておく
+                # 空行で区切られたコメント (ファイル先頭の説明など) は後の命令に結びつけない
+                comment = raw_line[2:].strip() if raw_line.startswith("//") else None
+                continue
+            if parser.instruction_type() == Instruction.L:
+                label = parser.symbol()
+                label_address = line_number
+                self.labels.setdefault(line_number, []).append(label)
+                continue
+            self.entries.append((line_index, raw_line, label, line_number - label_address, comment))
+            line_number += 1
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def location(self, address: int) -> str:
+        """
+        アドレスを「ラベル+オフセット」で表す
+        """
+        _, _, label, offset, _ = self.entries[address]
+        if label is None:
+            return f"{address}"
+        return f"{label}+{offset}" if offset else label
+
+
+class ExecutionProfile:
+    def __init__(self, source_map: SourceMap, words: list, counts: np.ndarray) -> None:
+        """
+        ROMのアドレスごとの実行回数を.asmのソースに対応づけて集計する
+
+        Parameters
+        ----------
+        source_map : SourceMap
+            .asmのソースとの対応
+        words : list
+            ROMの命令 (ループの検出に使う)
+        counts : np.ndarray
+            アドレスごとの実行回数
+        """
+        if len(source_map) != len(counts):
+            raise Exception(f"ROM size mismatch: {len(source_map)} instructions in source, {len(counts)} in ROM")
+        self.source_map = source_map
+        self.words = words
+        self.counts = counts
+        self.total = int(counts.sum())
+
+    def _percent(self, count: int) -> str:
+        return f"{count / max(self.total, 1):6.1%}"
+
+    def hottest_instructions(self, top: int) -> list:
+        """
+        実行回数の多い命令 [(アドレス, 回数)]
+        """
+        addresses = np.argsort(-self.counts, kind="stable")[:top]
+        return [(int(address), int(self.counts[address])) for address in addresses if self.counts[address]]
+
+    def label_totals(self) -> dict:
+        """
+        ラベルごとの実行回数 (そのラベルから次のラベルまでの命令の合計)
+        """
+        totals = {}
+        for address, (_, _, label, _, _) in enumerate(self.source_map.entries):
+            count = int(self.counts[address])
+            if count:
+                totals[label] = totals.get(label, 0) + count
+        return totals
+
+    def label_template_totals(self) -> dict:
+        """
+        ラベルの連番を*に置き換えてまとめた実行回数
+        VMトランスレータが同じテンプレートから作ったコード (RET_ADDRESS_CALL*など) ごとの合計になる
+        """
+        totals = {}
+        for label, count in self.label_totals().items():
+            template = LABEL_NUMBER_PATTERN.sub("*", label) if label is not None else None
+            totals[template] = totals.get(template, 0) + count
+        return totals
+
+    def comment_totals(self) -> dict:
+        """
+        直前のコメント (このリポジトリのVMトランスレータではVMコマンド) ごとの実行回数
+        """
+        totals = {}
+        for address, (_, _, _, _, comment) in enumerate(self.source_map.entries):
+            count = int(self.counts[address])
+            if count and comment is not None:
+                totals[comment] = totals.get(comment, 0) + count
+        return totals
+
+    def loops(self, max_loop_size: int = MAX_LOOP_SIZE) -> list:
+        """
+        後ろ向きのジャンプ(@X の直後のjumpで、Xがそのjump以前)をループとみなし、
+        [(先頭アドレス, 最後のjumpのアドレス, ループ内の実行回数, 先頭の実行回数)]を返す
+        同じ先頭へ戻るジャンプが複数あれば、最も後ろのものまでを1つのループにまとめる
+        max_loop_size以上離れた場所からもジャンプしてくる先頭は、ループではなく共有ルーチンの入口とみなして除く
+
+        Parameters
+        ----------
+        max_loop_size : int
+            ループとみなす範囲の最大命令数
+        """
+        ends = {}
+        for address in range(1, len(self.words)):
+            word = self.words[address]
+            start = self.words[address - 1]
+            if not (word & 0x8000 and word & 0b111) or start & 0x8000:
+                continue
+            if start <= address:
+                ends[start] = max(ends.get(start, address), address)
+        loops = []
+        for start, end in ends.items():
+            if end - start >= max_loop_size:
+                continue
+            body_count = int(self.counts[start:end + 1].sum())
+            if body_count:
+                loops.append((start, end, body_count, int(self.counts[start])))
+        loops.sort(key=lambda loop: -loop[2])
+        return loops
+
+    def report(self, top: int, max_loop_size: int = MAX_LOOP_SIZE) -> str:
+        """
+        命令・ラベル・ループ・VMコマンドごとの上位top件をテキストにまとめる
+        """
+        lines = [f"合計 {self.total} 命令"]
+
+        lines.append("")
+        lines.append("== 命令")
+        for address, count in self.hottest_instructions(top=top):
+            line_number, text, _, _, comment = self.source_map.entries[address]
+            origin = f"  // {comment}" if comment is not None else ""
+            lines.append(
+                f"{count:12d} {self._percent(count)}  {address:5d} {self.source_map.location(address):32s} "
+                f"L{line_number:<6d} {text}{origin}"
+            )
+
+        sections = [
+            ("== ラベル", self.label_totals()),
+            ("== ラベル(連番をまとめたもの)", self.label_template_totals()),
+            ("== VMコマンド(コメント)", self.comment_totals()),
+        ]
+        for title, totals in sections:
+            if not totals:
+                continue
+            lines.append("")
+            lines.append(title)
+            for name, count in sorted(totals.items(), key=lambda item: -item[1])[:top]:
+                name = "(先頭)" if name is None else name
+                lines.append(f"{count:12d} {self._percent(count)}  {name}")
+
+        lines.append("")
+        lines.append("== ループ")
+        for start, end, body_count, start_count in self.loops(max_loop_size=max_loop_size)[:top]:
+            kind = "無条件" if self.words[end] & 0b111 == JUMP_ALWAYS else "条件付き"
+            lines.append(
+                f"{body_count:12d} {self._percent(body_count)}  {self.source_map.location(start)} "
+                f"({start}-{end}, {end - start + 1} 命令, {kind}, 先頭 {start_count} 回)"
+            )
+        return "\n".join(lines)
+
+
+def profile_asm(asm_file_path: str, max_cycles: int, compile_blocks: bool = True, key_code: int = 0) -> tuple:
+    """
+    .asmファイルをアセンブルして実行し、(ExecutionProfile, エミュレータ)を返す
+    """
+    with open(asm_file_path, "r") as fp:
+        source_lines = fp.readlines()
+    words = assemble(source_lines)
+    emulator = HackEmulator(words=words, compile_blocks=compile_blocks, profile=True)
+    emulator.set_key(key_code=key_code)
+    emulator.run(max_cycles=max_cycles)
+    profile = ExecutionProfile(
+        source_map=SourceMap(lines=source_lines),
+        words=words,
+        counts=emulator.execution_counts(),
+    )
+    return profile, emulator
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(
+        description=".asmファイルを実行し、命令ごとの実行回数を.asmの行・ラベル・ループに対応づけて表示する"
+    )
+    arg_parser.add_argument("asm_file_name", help="実行する.asmファイル")
+    arg_parser.add_argument("--max-cycles", type=int, default=MAX_CYCLES, help="実行するサイクル数の上限")
+    arg_parser.add_argument("--top", type=int, default=20, help="表示する件数")
+    arg_parser.add_argument(
+        "--max-loop-size", type=int, default=MAX_LOOP_SIZE, help="ループとみなす範囲の最大命令数"
+    )
+    arg_parser.add_argument("--key", type=int, default=0, help="押し続けるキーのコード (KBDの値)")
+    arg_parser.add_argument(
+        "--no-compile",
+        action="store_true",
+        help="基本ブロックにコンパイルせず、1命令ずつ実行して数える",
+    )
+    args = arg_parser.parse_args()
+
+    start = time.perf_counter()
+    profile, emulator = profile_asm(
+        asm_file_path=args.asm_file_name,
+        max_cycles=args.max_cycles,
+        compile_blocks=not args.no_compile,
+        key_code=args.key,
+    )
+    seconds = time.perf_counter() - start
+    status = "停止" if emulator.halted else "上限に到達"
+    print(f"{os.path.basename(args.asm_file_name)}: {emulator.cycles} サイクル ({status}, {seconds:.3f} 秒)")
+    print(profile.report(top=args.top, max_loop_size=args.max_loop_size))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,292 @@
+from datetime import datetime, timezone
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+from main import RoutineMode, create_translator
+
+
+# (モード名, create_translatorへ渡すオプション)
+MODES = [
+    ("baseline", {}),
+    ("cache-tos", {"cache_tos": True}),
+    ("optimize", {"optimize": True}),
+    ("optimize+cache-tos", {"optimize": True, "cache_tos": True}),
+    ("shared+cache-tos", {"routine_mode": RoutineMode.SHARED, "cache_tos": True}),
+]
+
+# 1回の実行で進めるサイクル数の上限
+MAX_CYCLES = 10 ** 7
+# 実行後に比較するRAMの範囲 (R13~R15は変換器の作業用なので除く)
+COMPARED_RAM_RANGES = [(0, 13), (16, 256)]
+# ブートストラップなしのプログラムで使うlocalセグメント (LCL=300) のうち比較する範囲
+COMPARED_LOCAL_RANGE = (300, 308)
+
+# 算術プログラムで使う命令
+ARITHMETIC_BINARY_COMMANDS = ["add", "sub", "and", "or", "eq", "gt", "lt"]
+ARITHMETIC_UNARY_COMMANDS = ["neg", "not"]
+
+LOOP_PROGRAM = """\
+// argument 0 から 1 までの和を local 0 に求める
+push constant 0
+pop local 0
+label LOOP_START
+push argument 0
+push local 0
+add
+pop local 0
+push argument 0
+push constant 1
+sub
+pop argument 0
+push argument 0
+if-goto LOOP_START
+push local 0
+"""
+
+FIBONACCI_MAIN = """\
+function Main.fibonacci 0
+push argument 0
+push constant 2
+lt
+if-goto IF_TRUE
+goto IF_FALSE
+label IF_TRUE
+push argument 0
+return
+label IF_FALSE
+push argument 0
+push constant 2
+sub
+call Main.fibonacci 1
+push argument 0
+push constant 1
+sub
+call Main.fibonacci 1
+add
+return
+"""
+
+FIBONACCI_SYS = """\
+function Sys.init 0
+push constant {n}
+call Main.fibonacci 1
+pop static 0
+label WHILE
+goto WHILE
+"""
+
+
+def generate_arithmetic(n_commands: int, seed: int = 0) -> str:
+    """
+    ラベルを含まない、算術とpush/popだけの直線的なVMプログラムを作る
+    スタックの深さは常に0~8に保つ
+    """
+    rng = random.Random(seed)
+    lines = []
+    depth = 0
+    for _ in range(n_commands):
+        choice = rng.random()
+        if depth < 2 or (depth < 8 and choice < 0.45):
+            segment = rng.choice(["constant", "constant", "temp", "static", "local"])
+            index = rng.randrange(100) if segment == "constant" else rng.randrange(8)
+            lines.append(f"push {segment} {index}")
+            depth += 1
+        elif choice < 0.75:
+            lines.append(rng.choice(ARITHMETIC_BINARY_COMMANDS))
+            depth -= 1
+        elif choice < 0.85:
+            lines.append(rng.choice(ARITHMETIC_UNARY_COMMANDS))
+        else:
+            segment = rng.choice(["temp", "static", "local"])
+            lines.append(f"pop {segment} {rng.randrange(8)}")
+            depth -= 1
+    return "\n".join(lines) + "\n"
+
+
+def build_programs(arithmetic_commands: int, loop_count: int, fibonacci_n: int) -> list:
+    """
+    計測に使うプログラムを返す
+    [(名前, {ファイル名: VMコード}, RAMの初期値, スタックとlocalセグメントも比較するか)]
+    ファイルが複数あるプログラムはディレクトリとして変換する(ブートストラップ付き)
+    ブートストラップ付きのプログラムは、スタックにROMのアドレス(戻り先)が残り、
+    SPより上にも呼び出しの跡が残るので、staticなどだけを比較する
+    """
+    segment_ram = {0: 256, 1: 300, 2: 400, 3: 3000, 4: 3010}
+    return [
+        ("arithmetic", {"Arithmetic.vm": generate_arithmetic(arithmetic_commands)}, segment_ram, True),
+        ("loop", {"BasicLoop.vm": LOOP_PROGRAM}, {**segment_ram, 400: loop_count}, True),
+        (
+            "fibonacci",
+            {"Main.vm": FIBONACCI_MAIN, "Sys.vm": FIBONACCI_SYS.format(n=fibonacci_n)},
+            {},
+            False,
+        ),
+    ]
+
+
+def _alu(comp: int, x: int, y: int) -> int:
+    """
+    HackのALU。compはa以外の6bit(zx nx zy ny f no)
+    """
+    if comp & 0b100000:
+        x = 0
+    if comp & 0b010000:
+        x = ~x & 0xFFFF
+    if comp & 0b001000:
+        y = 0
+    if comp & 0b000100:
+        y = ~y & 0xFFFF
+    out = (x + y) & 0xFFFF if comp & 0b000010 else x & y
+    if comp & 0b000001:
+        out = ~out & 0xFFFF
+    return out
+
+
+def run_rom(words: list, ram_init: dict, max_cycles: int = MAX_CYCLES) -> tuple:
+    """
+    命令列を実行し、(RAM, 実行サイクル数)を返す
+    destのない @X / 0;JMP の自分自身へのジャンプ(末尾の無限ループ)に入ったら止める
+    """
+    ram = [0] * 32768
+    for address, value in ram_init.items():
+        ram[address] = value & 0xFFFF
+    a_register = d_register = pc = cycles = 0
+    n_words = len(words)
+    while pc < n_words and cycles < max_cycles:
+        word = words[pc]
+        cycles += 1
+        if not word & 0x8000:
+            a_register = word
+            pc += 1
+            continue
+        y = ram[a_register] if word & 0x1000 else a_register
+        out = _alu((word >> 6) & 0b111111, d_register, y)
+        address = a_register
+        if word & 0b100000:
+            a_register = out
+        if word & 0b010000:
+            d_register = out
+        if word & 0b001000:
+            ram[address] = out
+        signed = out - 0x10000 if out & 0x8000 else out
+        jump = word & 0b111
+        if (jump & 0b100 and signed < 0) or (jump & 0b010 and signed == 0) or (jump & 0b001 and signed > 0):
+            # destのない無条件ジャンプ(@X / 0;JMP)だけを停止とみなす
+            if jump == 0b111 and not word & 0b111000 and address == pc - 1 and words[address] == address:
+                break
+            pc = address
+        else:
+            pc += 1
+    return ram, cycles
+
+
+def _ram_snapshot(ram: list, compare_stack: bool) -> list:
+    """
+    モード間で比較するRAMの内容 (ポインタ・temp・static、必要ならlocalとSPより下のスタック)
+    """
+    snapshot = []
+    for start, end in COMPARED_RAM_RANGES:
+        snapshot += ram[start:end]
+    if compare_stack:
+        start, end = COMPARED_LOCAL_RANGE
+        snapshot += ram[start:end] + ram[256:ram[0]]
+    return snapshot
+
+
+def bench_program(
+    work_dir: str, name: str, files: dict, ram_init: dict, compare_stack: bool
+) -> dict:
+    """
+    1つのプログラムを各モードで変換・実行し、ROMのワード数・実行サイクル数・変換時間を比べる
+    """
+    program_dir = os.path.join(work_dir, name)
+    os.makedirs(program_dir)
+    for file_name, vm_code in files.items():
+        with open(os.path.join(program_dir, file_name), "w") as fp:
+            fp.write(vm_code)
+    if len(files) == 1:
+        vm_path = os.path.join(program_dir, next(iter(files)))
+    else:
+        vm_path = program_dir
+
+    results = {}
+    baseline_snapshot = None
+    for mode, options in MODES:
+        start = time.perf_counter()
+        words = create_translator(vm_file_name=vm_path, processes=1, **options).encode().resolve()
+        translate_seconds = time.perf_counter() - start
+        ram, cycles = run_rom(words=words, ram_init=ram_init)
+        snapshot = _ram_snapshot(ram=ram, compare_stack=compare_stack)
+        if baseline_snapshot is None:
+            baseline_snapshot = snapshot
+        results[mode] = {
+            "rom_words": len(words),
+            "cycles": cycles,
+            "translate_seconds": round(translate_seconds, 6),
+            "same_result": snapshot == baseline_snapshot,
+        }
+
+    baseline = results["baseline"]
+    for result in results.values():
+        result["rom_ratio"] = round(result["rom_words"] / baseline["rom_words"], 4)
+        result["cycle_ratio"] = round(result["cycles"] / baseline["cycles"], 4)
+    return results
+
+
+def run_suite(arithmetic_commands: int, loop_count: int, fibonacci_n: int) -> dict:
+    """
+    すべてのプログラムを計測し、結果をまとめる
+    """
+    report = {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "programs": {},
+    }
+    with tempfile.TemporaryDirectory() as work_dir:
+        for name, files, ram_init, compare_stack in build_programs(
+            arithmetic_commands=arithmetic_commands,
+            loop_count=loop_count,
+            fibonacci_n=fibonacci_n,
+        ):
+            report["programs"][name] = bench_program(
+                work_dir=work_dir,
+                name=name,
+                files=files,
+                ram_init=ram_init,
+                compare_stack=compare_stack,
+            )
+    return report
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(
+        description="VMトランスレータのコード生成モードごとに、ROMのワード数と実行サイクル数を比べる"
+    )
+    arg_parser.add_argument("--arithmetic-commands", type=int, default=2000, help="算術プログラムのVMコマンド数")
+    arg_parser.add_argument("--loop-count", type=int, default=100, help="ループプログラムの繰り返し回数")
+    arg_parser.add_argument("--fibonacci", type=int, default=10, help="フィボナッチ数を求める引数")
+    arg_parser.add_argument("--output", default=None, help="結果のJSONの出力先 (デフォルトは標準出力)")
+    args = arg_parser.parse_args()
+
+    report = run_suite(
+        arithmetic_commands=args.arithmetic_commands,
+        loop_count=args.loop_count,
+        fibonacci_n=args.fibonacci,
+    )
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w") as fp:
+            json.dump(report, fp, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,398 @@
+from array import array
+from typing import Iterable
+import argparse
+import glob
+import os
+import time
+
+import numpy as np
+
+from main import (
+    ENTRY_FUNCTION,
+    STACK_BASE,
+    TEMP_BASE,
+    Command,
+    Parser,
+    _load_assembler,
+    read_vm_commands,
+)
+
+
+# 事前デコードした命令の種類
+# 頻度の高いものから順に並べ、実行ループの分岐もこの順に調べる
+OP_PUSH_CONSTANT = 0
+OP_PUSH_INDIRECT = 1
+OP_PUSH_DIRECT = 2
+OP_POP_INDIRECT = 3
+OP_POP_DIRECT = 4
+OP_ADD = 5
+OP_SUB = 6
+OP_IF_GOTO = 7
+OP_GOTO = 8
+OP_LT = 9
+OP_GT = 10
+OP_EQ = 11
+OP_AND = 12
+OP_OR = 13
+OP_NEG = 14
+OP_NOT = 15
+OP_CALL = 16
+OP_FUNCTION = 17
+OP_RETURN = 18
+
+ARITHMETIC_OPS = {
+    "add": OP_ADD,
+    "sub": OP_SUB,
+    "neg": OP_NEG,
+    "eq": OP_EQ,
+    "gt": OP_GT,
+    "lt": OP_LT,
+    "and": OP_AND,
+    "or": OP_OR,
+    "not": OP_NOT,
+}
+
+# ベースアドレスをRAMのポインタから読むセグメントと、そのポインタのアドレス
+POINTER_SEGMENTS = {
+    "local": 1,
+    "argument": 2,
+    "this": 3,
+    "that": 4,
+}
+# pointerセグメントのベースアドレス (THIS, THAT)
+POINTER_BASE = 3
+# staticセグメントを割り当て始めるアドレス (アセンブラの変数と同じ)
+STATIC_BASE = 16
+RAM_SIZE = 32768
+# 1回の実行で進めるVMコマンド数の上限
+MAX_STEPS = 10 ** 8
+
+
+class VMProgram:
+    def __init__(self, vm_file_paths: Iterable[str]) -> None:
+        """
+        .vmファイルを読み、実行用の命令列へ事前デコードする
+        命令はops(命令の種類), args1, args2の3つの配列に分けて持つ
+        ラベルは命令の番号に解決し、命令列には残さない
+
+        Parameters
+        ----------
+        vm_file_paths : Iterable[str]
+            連結して1つのプログラムにする.vmファイル (この順に並べる)
+        """
+        self.ops = array("B")
+        self.args1 = array("l")
+        self.args2 = array("l")
+        # 関数名とその番号 (呼び出し回数の集計に使う)
+        self.function_names = []
+        self.function_ids = {}
+        # 関数名 -> 命令の番号
+        self.function_addresses = {}
+        # staticの名前 (ファイル名.番号) -> RAMのアドレス
+        # VMTranslatorの出力をアセンブルした場合と同じく、最初に現れた順に16から割り当てる
+        self.static_addresses = {}
+        # 解決待ちのジャンプ: (命令の番号, ラベル)
+        labels = {}
+        jumps = []
+        calls = []
+        for vm_file_path in vm_file_paths:
+            file_name = os.path.splitext(os.path.basename(vm_file_path))[0]
+            current_function = None
+            for command in read_vm_commands(parser=Parser(vm_file_path=vm_file_path)):
+                command_type = command.command_type
+                scope = current_function if current_function is not None else file_name
+                if command_type == Command.LABEL:
+                    labels[(scope, command.arg1)] = len(self.ops)
+                elif command_type == Command.GOTO or command_type == Command.IF:
+                    jumps.append((len(self.ops), (scope, command.arg1)))
+                    self._append(OP_GOTO if command_type == Command.GOTO else OP_IF_GOTO)
+                elif command_type == Command.FUNCTION:
+                    current_function = command.arg1
+                    self.function_addresses[current_function] = len(self.ops)
+                    self._append(OP_FUNCTION, self._function_id(current_function), command.arg2)
+                elif command_type == Command.CALL:
+                    calls.append((len(self.ops), command.arg1))
+                    self._append(OP_CALL, 0, command.arg2)
+                elif command_type == Command.RETURN:
+                    self._append(OP_RETURN)
+                elif command_type == Command.ARITHMETIC:
+                    if command.arg1 not in ARITHMETIC_OPS:
+                        raise Exception(f"Invalid Arithmetic Command: {command.arg1}")
+                    self._append(ARITHMETIC_OPS[command.arg1])
+                else:
+                    self._append_push_pop(command=command, file_name=file_name)
+
+        for index, label in jumps:
+            if label not in labels:
+                raise Exception(f"Undefined label: {label[1]} in {label[0]}")
+            self.args1[index] = labels[label]
+        for index, function_name in calls:
+            if function_name not in self.function_addresses:
+                raise Exception(f"Undefined function: {function_name}")
+            self.args1[index] = self.function_addresses[function_name]
+
+    def _append(self, op: int, arg1: int = 0, arg2: int = 0) -> None:
+        self.ops.append(op)
+        self.args1.append(arg1)
+        self.args2.append(arg2)
+
+    def _function_id(self, function_name: str) -> int:
+        if function_name not in self.function_ids:
+            self.function_ids[function_name] = len(self.function_names)
+            self.function_names.append(function_name)
+        return self.function_ids[function_name]
+
+    def _append_push_pop(self, command, file_name: str) -> None:
+        """
+        push/popを、セグメントに応じてアドレスの求め方の違う命令にする
+        local/argument/this/thatはポインタ経由(INDIRECT)、temp/pointer/staticは固定のアドレス(DIRECT)
+        """
+        is_push = command.command_type == Command.PUSH
+        segment = command.arg1
+        index = command.arg2
+        if segment == "constant":
+            if not is_push:
+                raise Exception("Cannot pop to constant segment")
+            self._append(OP_PUSH_CONSTANT, index)
+        elif segment in POINTER_SEGMENTS:
+            self._append(OP_PUSH_INDIRECT if is_push else OP_POP_INDIRECT, POINTER_SEGMENTS[segment], index)
+        else:
+            if segment == "temp":
+                address = TEMP_BASE + index
+            elif segment == "pointer":
+                address = POINTER_BASE + index
+            elif segment == "static":
+                name = f"{file_name}.{index}"
+                if name not in self.static_addresses:
+                    self.static_addresses[name] = STATIC_BASE + len(self.static_addresses)
+                address = self.static_addresses[name]
+            else:
+                raise Exception(f"Invalid Segment: {segment}")
+            self._append(OP_PUSH_DIRECT if is_push else OP_POP_DIRECT, address)
+
+    def __len__(self) -> int:
+        return len(self.ops)
+
+
+class VMInterpreter:
+    def __init__(self, program: VMProgram, ram_init: dict = None, bootstrap: bool = False) -> None:
+        """
+        事前デコードしたVMプログラムを直接実行する
+        RAMはHackと同じ配置のint16の配列で、SP/LCL/ARG/THIS/THATも同じアドレスに置く
+        戻り先は命令の番号で、int16に収まらない大きなプログラムもあるので、
+        RAMのフレームとは別にPythonのintのスタック(return_stack)に積んで、returnではそちらを使う
+        (RAMのフレームの戻り先の位置には、配置を合わせるためにint16に丸めた命令の番号を書く)
+
+        Parameters
+        ----------
+        program : VMProgram
+            実行するプログラム
+        ram_init : dict
+            RAMの初期値 {アドレス: 値}
+        bootstrap : bool
+            Trueの場合、VMTranslatorのブートストラップと同じくSP=256にしてSys.initを呼ぶ
+        """
+        self.program = program
+        self.ram = np.zeros(RAM_SIZE, dtype=np.int16)
+        for address, value in (ram_init or {}).items():
+            self.ram[address] = _to_int16(value)
+        # 関数の番号 -> functionコマンドを実行した回数
+        self.call_counts = [0] * len(program.function_names)
+        # callで積んだ戻り先の命令の番号
+        self.return_stack = []
+        self.steps = 0
+        self.pc = 0
+        if bootstrap:
+            if ENTRY_FUNCTION not in program.function_addresses:
+                raise Exception(f"{ENTRY_FUNCTION} is not defined")
+            # call Sys.init 0 と同じフレームを積む (戻り先はプログラムの外)
+            self.ram[0] = STACK_BASE
+            self.return_stack.append(len(program))
+            frame = [_to_int16(len(program))] + [int(value) for value in self.ram[1:5]]
+            self.ram[STACK_BASE:STACK_BASE + 5] = frame
+            self.ram[0] = STACK_BASE + 5
+            self.ram[2] = STACK_BASE
+            self.ram[1] = STACK_BASE + 5
+            self.pc = program.function_addresses[ENTRY_FUNCTION]
+
+    def run(self, max_steps: int = MAX_STEPS) -> int:
+        """
+        プログラムの外へ出るか、goto/if-gotoで自分自身へ飛ぶ無限ループに入るか、
+        max_steps個のコマンドを実行するまで進める。実行したコマンド数を返す
+        """
+        ops = self.program.ops.tolist()
+        args1 = self.program.args1.tolist()
+        args2 = self.program.args2.tolist()
+        n_ops = len(ops)
+        # memoryviewを通すとNumPyの配列の要素をPythonのintとして速く読み書きできる
+        mem = memoryview(self.ram)
+        call_counts = self.call_counts
+        return_stack = self.return_stack
+        sp = mem[0]
+        pc = self.pc
+        steps = 0
+        while 0 <= pc < n_ops and steps < max_steps:
+            op = ops[pc]
+            steps += 1
+            if op == OP_PUSH_CONSTANT:
+                mem[sp] = args1[pc]
+                sp += 1
+            elif op == OP_PUSH_INDIRECT:
+                mem[sp] = mem[mem[args1[pc]] + args2[pc]]
+                sp += 1
+            elif op == OP_PUSH_DIRECT:
+                mem[sp] = mem[args1[pc]]
+                sp += 1
+            elif op == OP_POP_INDIRECT:
+                sp -= 1
+                mem[mem[args1[pc]] + args2[pc]] = mem[sp]
+            elif op == OP_POP_DIRECT:
+                sp -= 1
+                mem[args1[pc]] = mem[sp]
+            elif op == OP_ADD:
+                sp -= 1
+                mem[sp - 1] = ((mem[sp - 1] + mem[sp] + 0x8000) & 0xFFFF) - 0x8000
+            elif op == OP_SUB:
+                sp -= 1
+                mem[sp - 1] = ((mem[sp - 1] - mem[sp] + 0x8000) & 0xFFFF) - 0x8000
+            elif op == OP_IF_GOTO:
+                sp -= 1
+                if mem[sp]:
+                    if args1[pc] == pc:
+                        break
+                    pc = args1[pc]
+                    continue
+            elif op == OP_GOTO:
+                if args1[pc] == pc:
+                    break
+                pc = args1[pc]
+                continue
+            elif op == OP_LT:
+                sp -= 1
+                mem[sp - 1] = -1 if mem[sp - 1] < mem[sp] else 0
+            elif op == OP_GT:
+                sp -= 1
+                mem[sp - 1] = -1 if mem[sp - 1] > mem[sp] else 0
+            elif op == OP_EQ:
+                sp -= 1
+                mem[sp - 1] = -1 if mem[sp - 1] == mem[sp] else 0
+            elif op == OP_AND:
+                sp -= 1
+                mem[sp - 1] &= mem[sp]
+            elif op == OP_OR:
+                sp -= 1
+                mem[sp - 1] |= mem[sp]
+            elif op == OP_NEG:
+                mem[sp - 1] = ((0x8000 - mem[sp - 1]) & 0xFFFF) - 0x8000
+            elif op == OP_NOT:
+                mem[sp - 1] = ~mem[sp - 1]
+            elif op == OP_CALL:
+                # 戻り先, LCL, ARG, THIS, THATを積み、ARGとLCLを付け替える
+                return_stack.append(pc + 1)
+                mem[sp] = ((pc + 1 + 0x8000) & 0xFFFF) - 0x8000
+                mem[sp + 1] = mem[1]
+                mem[sp + 2] = mem[2]
+                mem[sp + 3] = mem[3]
+                mem[sp + 4] = mem[4]
+                mem[2] = sp - args2[pc]
+                sp += 5
+                mem[1] = sp
+                pc = args1[pc]
+                continue
+            elif op == OP_FUNCTION:
+                call_counts[args1[pc]] += 1
+                for _ in range(args2[pc]):
+                    mem[sp] = 0
+                    sp += 1
+            elif op == OP_RETURN:
+                frame = mem[1]
+                # このインタプリタのcallで積んだフレームでなければ(RAMの初期値で作ったフレームなど)、RAMから読む
+                return_address = return_stack.pop() if return_stack else mem[frame - 5]
+                argument = mem[2]
+                mem[argument] = mem[sp - 1]
+                sp = argument + 1
+                mem[4] = mem[frame - 1]
+                mem[3] = mem[frame - 2]
+                mem[2] = mem[frame - 3]
+                mem[1] = mem[frame - 4]
+                pc = return_address
+                continue
+            pc += 1
+
+        mem[0] = sp
+        self.pc = pc
+        self.steps += steps
+        return steps
+
+    def function_call_counts(self) -> dict:
+        """
+        関数ごとの呼び出し回数 (functionコマンドを実行した回数)
+        """
+        return {
+            name: count
+            for name, count in zip(self.program.function_names, self.call_counts)
+        }
+
+
+def _to_int16(value: int) -> int:
+    """
+    16bitに丸めて、int16の範囲の値にする
+    """
+    return ((value + 0x8000) & 0xFFFF) - 0x8000
+
+
+def load_program(vm_file_name: str) -> tuple:
+    """
+    .vmファイルまたはディレクトリを読み、(VMProgram, ブートストラップが必要か)を返す
+    ディレクトリはDirectoryTranslatorと同じくファイル名順に連結し、Sys.initから実行する
+    """
+    if os.path.isdir(vm_file_name):
+        vm_file_paths = sorted(glob.glob(os.path.join(vm_file_name, "*.vm")))
+        if not vm_file_paths:
+            raise Exception(f"No .vm files in directory: {vm_file_name}")
+        return VMProgram(vm_file_paths=vm_file_paths), True
+    return VMProgram(vm_file_paths=[vm_file_name]), False
+
+
+def main():
+    # --ramと--dumpの形式はHackのエミュレータと同じにするため、その解析関数を使う
+    emulator = _load_assembler(module_name="emulator")
+    arg_parser = argparse.ArgumentParser(
+        description=".vmファイル(またはディレクトリ)を変換せずに直接実行し、関数ごとの呼び出し回数を表示する"
+    )
+    arg_parser.add_argument("vm_file_name", help=".vmファイル、または.vmファイルを含むディレクトリ")
+    arg_parser.add_argument(
+        "--ram",
+        type=emulator.parse_ram_assignment,
+        action="append",
+        default=[],
+        metavar="ADDRESS=VALUE",
+        help="実行前のRAMの値 (複数指定できる)",
+    )
+    arg_parser.add_argument("--max-steps", type=int, default=MAX_STEPS, help="実行するVMコマンド数の上限")
+    arg_parser.add_argument(
+        "--dump",
+        type=emulator.parse_ram_range,
+        action="append",
+        default=[],
+        metavar="START:END",
+        help="実行後に表示するRAMの範囲 (複数指定できる)",
+    )
+    args = arg_parser.parse_args()
+
+    program, bootstrap = load_program(vm_file_name=args.vm_file_name)
+    interpreter = VMInterpreter(program=program, ram_init=dict(args.ram), bootstrap=bootstrap)
+    start = time.perf_counter()
+    steps = interpreter.run(max_steps=args.max_steps)
+    seconds = time.perf_counter() - start
+
+    print(f"実行したVMコマンド: {steps} ({seconds:.3f} 秒, {steps / max(seconds, 1e-9):,.0f} コマンド/秒)")
+    for name, count in sorted(interpreter.function_call_counts().items(), key=lambda item: -item[1]):
+        print(f"{name}: {count} 回")
+    for start_address, end_address in args.dump:
+        for address in range(start_address, end_address):
+            print(f"RAM[{address}] = {interpreter.ram[address]}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,13 @@
+from array import array
 from enum import Enum
+from multiprocessing import Pool
+from typing import Iterable, Iterator
+import argparse
+import glob
+import hashlib
+import importlib
+import io
+import json
 import os
 import sys
 
@@ -24,6 +33,47 @@ SEGMENT_MAP = {
 }
 
 
+# tempセグメントのベースアドレス (R5~R12)
+TEMP_BASE = 5
+
+
+class RoutineMode(Enum):
+    # 比較命令とreturnを呼び出し箇所ごとに展開する
+    INLINE = "inline"
+    # プログラムの先頭に共有ルーチンを一度だけ置き、呼び出し箇所からジャンプする
+    SHARED = "shared"
+
+
+# 共有ルーチンの戻り先アドレスを保持するレジスタ
+RETURN_ADDRESS_REGISTER = "R15"
+# 共有ルーチンのラベル
+SHARED_COMPARE_LABELS = {
+    "eq": "__VM_EQ",
+    "gt": "__VM_GT",
+    "lt": "__VM_LT",
+}
+SHARED_RETURN_LABEL = "__VM_RETURN"
+# ブートストラップで設定するスタックポインタの初期値
+STACK_BASE = 256
+# スタックの先頭をDレジスタに置いたままの場合の、2項演算と単項演算のC命令
+CACHED_BINARY_OPERATIONS = {
+    "add": "D=D+M",
+    "sub": "D=M-D",
+    "and": "D=D&M",
+    "or": "D=D|M",
+}
+CACHED_UNARY_OPERATIONS = {
+    "neg": "D=-D",
+    "not": "D=!D",
+}
+# Dレジスタの値をセグメントへpopするとき、A=A+1を並べてアドレスを作るインデックスの上限
+CACHED_POP_MAX_INCREMENTS = 7
+# 変換結果をそのまま.hackへ変換するときに使うアセンブラの場所
+ASSEMBLER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "06_Assembler")
+# 変換キャッシュのファイル形式の版。形式を変えたら上げる
+TRANSLATION_CACHE_VERSION = 2
+
+
 class Parser:
     def __init__(self, vm_file_path: str) -> None:
         """
@@ -81,6 +131,8 @@ class Parser:
                 return Command.POP
             elif "function" in command_list:
                 return Command.FUNCTION
+            elif "call" in command_list:
+                return Command.CALL
             else:
                 raise Exception(f"Invalid Command Type: {self.order}")
         else:
@@ -100,60 +152,300 @@ class Parser:
         """
         return int(self.order.split()[2])
 
+    def command(self) -> "VMCommand":
+        """
+        現在のコマンドを中間表現に変換して返す
+        """
+        command_type = self.commnad_type()
+        words = self.order.split()
+        if command_type in (Command.ARITHMETIC, Command.RETURN):
+            return VMCommand(command_type=command_type, arg1=words[0])
+        if len(words) == 2:
+            return VMCommand(command_type=command_type, arg1=words[1])
+        return VMCommand(command_type=command_type, arg1=words[1], arg2=int(words[2]))
+
+
+class VMCommand:
+    def __init__(self, command_type: Command, arg1: str, arg2: int = None) -> None:
+        """
+        VMコマンド1つ分の中間表現
+
+        Parameters
+        ----------
+        command_type : Command
+            コマンドの種類
+        arg1 : str
+            最初の引数。C_ARITHMETICとC_RETURNではコマンド自体(add, returnなど)
+        arg2 : int
+            2番目の引数。C_PUSH, C_POP, C_FUNCTION, C_CALLのみ
+        """
+        self.command_type = command_type
+        self.arg1 = arg1
+        self.arg2 = arg2
+
+    def text(self) -> str:
+        """
+        VMコードの1行として表す
+        """
+        if self.command_type in (Command.ARITHMETIC, Command.RETURN):
+            return self.arg1
+        keyword = {
+            Command.PUSH: "push",
+            Command.POP: "pop",
+            Command.LABEL: "label",
+            Command.GOTO: "goto",
+            Command.IF: "if-goto",
+            Command.FUNCTION: "function",
+            Command.CALL: "call",
+        }[self.command_type]
+        if self.arg2 is None:
+            return f"{keyword} {self.arg1}"
+        return f"{keyword} {self.arg1} {self.arg2}"
+
+    def is_constant_push(self) -> bool:
+        return self.command_type == Command.PUSH and self.arg1 == "constant"
+
+    def __repr__(self) -> str:
+        return f"VMCommand({self.text()!r})"
+
+
+# 呼び出しグラフをたどる起点の関数 (ブートストラップから呼ばれる)
+ENTRY_FUNCTION = "Sys.init"
+
+
+def read_vm_commands(parser: Parser) -> list:
+    """
+    parserの入力をすべて読み、VMコマンドの中間表現のリストにする
+    """
+    commands = []
+    while parser.has_more_lines():
+        parser.advance()
+        if parser.order is None:
+            continue
+        commands.append(parser.command())
+    return commands
+
+
+def build_call_graph(commands: list) -> dict:
+    """
+    関数名から、その関数が呼び出している関数名の集合への対応を作る
+    """
+    call_graph = {}
+    current_function = None
+    for command in commands:
+        if command.command_type == Command.FUNCTION:
+            current_function = command.arg1
+            call_graph.setdefault(current_function, set())
+        elif command.command_type == Command.CALL and current_function is not None:
+            call_graph[current_function].add(command.arg1)
+    return call_graph
+
+
+def find_reachable_functions(call_graph: dict, roots: Iterable[str]) -> set:
+    """
+    rootsから呼び出しをたどって到達できる関数の集合を返す
+    """
+    reachable = set()
+    stack = list(roots)
+    while stack:
+        function_name = stack.pop()
+        if function_name in reachable:
+            continue
+        reachable.add(function_name)
+        stack.extend(call_graph.get(function_name, ()))
+    return reachable
+
+
+def split_functions(commands: list, removed_functions: Iterable[str]) -> tuple:
+    """
+    removed_functionsに含まれる関数の本体(functionから次のfunctionの前まで)を取り除く
+    (残したコマンドのリスト, {取り除いた関数名: その関数のコマンドのリスト})を返す
+    """
+    removed_functions = set(removed_functions)
+    kept = []
+    removed = {}
+    current = kept
+    for command in commands:
+        if command.command_type == Command.FUNCTION:
+            if command.arg1 in removed_functions:
+                current = removed.setdefault(command.arg1, [])
+            else:
+                current = kept
+        current.append(command)
+    return kept, removed
+
+
+def _scan_call_graph(vm_file_path: str) -> dict:
+    """
+    ワーカー: 1つの.vmファイルの呼び出しグラフを作る
+    """
+    return build_call_graph(read_vm_commands(parser=Parser(vm_file_path=vm_file_path)))
+
 
 class CodeWriter:
-    def __init__(self, file_path: str) -> None:
+    # 呼び出し側へ1つのチャンクとして渡すまでに溜める行数
+    CHUNK_LINES = 4096
+
+    def __init__(
+        self,
+        file_path: str,
+        optimize: bool = False,
+        routine_mode: RoutineMode = RoutineMode.INLINE,
+        output: io.TextIOBase = None,
+        standalone: bool = True,
+        asm_file_path: str = None,
+        cache_tos: bool = False,
+    ) -> None:
+        """
+        1つのCodeWriterは1つの.vmファイルだけを変換する
+        staticセグメントの名前とラベルの連番はfile_pathのファイル名で決まるので、
+        ディレクトリ変換ではファイルごとに別のCodeWriterを作る(各ワーカーで並列に変換できる)
+
+        Parameters
+        ----------
+        file_path : str
+            入力の.vmファイル(またはディレクトリ)のパス
+        optimize : bool
+            Trueの場合、全体を溜めてから、のぞき穴最適化をかけて渡す
+        routine_mode : RoutineMode
+            比較命令とreturnを展開するか、共有ルーチンを呼び出すか
+        output : io.TextIOBase
+            write_chunks()の出力先のストリーム。指定しない場合は.asmファイルへ書き込む
+            (指定したストリームは閉じない)
+        standalone : bool
+            Falseの場合、共有ルーチンと末尾の無限ループを書かない
+            (ディレクトリ変換で、1ファイル分の断片を作るときに使う)
+        asm_file_path : str
+            出力する.asmファイルのパス。指定しない場合はfile_pathから決める
+        cache_tos : bool
+            Trueの場合、スタックの先頭をDレジスタに置いたまま次のVMコマンドへ渡す
+            ラベル・関数呼び出し・分岐の前でだけメモリへ書き出す
+        """
         self.file_name = os.path.basename(file_path).split(".")[0]
         # 出力ファイルのProg.hackを作成する
-        self.asm_file_path = f"{file_path.replace('vm', 'asm')}"
-        self.fp = open(self.asm_file_path, "w")
+        if asm_file_path is None:
+            asm_file_path = os.path.splitext(file_path)[0] + ".asm"
+        self.asm_file_path = asm_file_path
+        self.output = output
+        self.optimizer = PeepholeOptimizer() if optimize else None
+        # 出力する行のバッファ。ファイルへは書かず、take_lines()で呼び出し側へ渡す
+        self.lines = []
 
         self.jump_number = 0
+        self.call_number = 0
+        self.current_function = None
+        self.routine_mode = routine_mode
+        self.standalone = standalone
+        self.cache_tos = cache_tos
+        # スタックの先頭がDレジスタにあり、まだメモリへ書かれていないか
+        # (このときSPは先頭の値を書くべき位置を指している)
+        self.tos_in_d = False
+        if self.standalone and self.routine_mode == RoutineMode.SHARED:
+            self._write_shared_routines()
         
-    def set_file_name(file_name: str) -> None:
+    def write_bootstrap(self) -> None:
         """
-        新しいVMファイルの変換が開始されたことを知らせる
-        VMTranslatorによって呼び出される
-        ----------
-        file_name : str
-            ファイル名
+        SPを初期化し、Sys.initを呼び出すブートストラップコードを書く
+        """
+        self._write(f"  @{STACK_BASE}")
+        self._write("  D=A")
+        self._write("  @SP")
+        self._write("  M=D")
+        self.write_call(function_name="Sys.init", n_args=0)
+
+    def _write(self, line: str) -> None:
+        """
+        アセンブリを1行バッファへ追加する
+        """
+        self.lines.append(line)
+
+    def write_comment(self, comment: str) -> None:
+        self._write(f"  // {comment}")
+
+    def has_chunk(self) -> bool:
+        """
+        1チャンク分の行が溜まったか判断する
+        のぞき穴最適化をかける場合は全体が揃うまで渡さない
+        """
+        return self.optimizer is None and len(self.lines) >= self.CHUNK_LINES
+
+    def take_lines(self) -> list:
+        """
+        バッファに溜まった行を取り出し、バッファを空にする
         """
-        pass
+        lines = self.lines
+        self.lines = []
+        return lines
+
+    def finish(self) -> list:
+        """
+        末尾の無限ループを書き、残りの行を取り出す
+        のぞき穴最適化をかける場合は、ここで全体を最適化する
+        """
+        self._spill_tos()
+        if self.standalone:
+            self._create_infinite_loop()
+        lines = self.take_lines()
+        if self.optimizer is not None:
+            lines = self.optimizer.optimize(lines)
+        return lines
+
+    def write_chunks(self, chunks: Iterable[list]) -> None:
+        """
+        行のチャンクを出力ファイル/ストリームへまとめて書き込む
+        """
+        fp = self.output if self.output is not None else open(self.asm_file_path, "w")
+        try:
+            for chunk in chunks:
+                if chunk:
+                    fp.write("\n".join(chunk))
+                    fp.write("\n")
+        finally:
+            if fp is not self.output:
+                fp.close()
+    
+    def _scoped_label(self, label: str) -> str:
+        """
+        VMのラベルを関数内のラベル (関数名$ラベル) にする
+        """
+        if self.current_function is None:
+            return label
+        return f"{self.current_function}${label}"
     
     def _create_infinite_loop(self) -> None:
-        self.fp.write("(END)\n")
-        self.fp.write("  @END\n")
-        self.fp.write("  0;JMP\n")
+        self._write("(END)")
+        self._write("  @END")
+        self._write("  0;JMP")
 
     def _store_data_in_stack(self) -> None:
         """
         スタックへデータを格納するヘルパー関数
         """
-        self.fp.write("  @SP\n")
-        self.fp.write("  A=M\n")
-        self.fp.write("  M=D\n")
+        self._write("  @SP")
+        self._write("  A=M")
+        self._write("  M=D")
     
     def _get_data_from_stack(self) -> None:
         """
         スタックからデータを取得するヘルパー関数
         """
-        self.fp.write("  @SP\n")
-        self.fp.write("  A=M\n")
-        self.fp.write("  D=M\n")
+        self._write("  @SP")
+        self._write("  A=M")
+        self._write("  D=M")
 
     def _increase_stack_pointer(self) -> None:
         """
         スタックポインタを1増やすヘルパー関数
         """
-        self.fp.write("  @SP\n")
-        self.fp.write("  M=M+1\n")
+        self._write("  @SP")
+        self._write("  M=M+1")
 
     def _decrease_stack_pointer(self) -> None:
         """
         スタックポインタを1減らすヘルパー関数
         """
-        self.fp.write("  @SP\n")
-        self.fp.write("  M=M-1\n")
+        self._write("  @SP")
+        self._write("  M=M-1")
         
     def _store_one_data_in_stack(self) -> None:
         """
@@ -174,8 +466,68 @@ class CodeWriter:
         スタックへ一つデータを格納するヘルパー関数 (スタックポインタは考慮不要)
         """
         self._get_one_arg_from_stack()
-        self.fp.write("  @SP\n")
-        self.fp.write("  AM=M-1\n")
+        self._write("  @SP")
+        self._write("  AM=M-1")
+
+    def _spill_tos(self) -> None:
+        """
+        Dレジスタに置いたままのスタックの先頭をメモリへ書き出す
+        """
+        if self.tos_in_d:
+            self._store_one_data_in_stack()
+            self.tos_in_d = False
+
+    def _load_tos(self) -> None:
+        """
+        スタックの先頭をDレジスタへ読み込み、Dに置いたままの状態にする
+        """
+        if not self.tos_in_d:
+            self._write("  @SP")
+            self._write("  AM=M-1")
+            self._write("  D=M")
+            self.tos_in_d = True
+
+    def _push_d(self) -> None:
+        """
+        Dレジスタの値をスタックへpushする
+        cache_tosの場合はメモリへ書かず、Dに置いたままにする
+        """
+        if self.cache_tos:
+            self.tos_in_d = True
+        else:
+            self._store_one_data_in_stack()
+
+    def _pop_to_d(self) -> None:
+        """
+        スタックから一つ取り出してDレジスタへ入れる
+        """
+        if self.cache_tos:
+            self._load_tos()
+            self.tos_in_d = False
+        else:
+            self._get_one_arg_from_stack()
+
+    def _store_cached_tos_in_segment(self, segment: str, index: int) -> None:
+        """
+        Dレジスタに置いたままのスタックの先頭を、セグメントへ格納する
+        インデックスが小さければA=A+1を並べ、大きければR13/R14を使ってアドレスを作る
+        """
+        if index <= CACHED_POP_MAX_INCREMENTS:
+            self._write(f"  @{segment}")
+            self._write("  A=M")
+            for _ in range(index):
+                self._write("  A=A+1")
+            self._write("  M=D")
+        else:
+            self._write("  @R14")
+            self._write("  M=D")
+            self._calculate_segment_address(segment=segment, index=index)
+            self._write("  @R14")
+            self._write("  D=M")
+            self._write("  @R13")
+            self._write("  A=M")
+            self._write("  M=D")
+        self.tos_in_d = False
 
     def _calculate_segment_address(self, segment: str, index: int) -> None:
         """
@@ -189,19 +541,20 @@ class CodeWriter:
             インデックス
         """
         # セグメントのベースアドレスを取得
-        self.fp.write(f"  @{segment}\n")
-        self.fp.write("  D=M\n")
+        self._write(f"  @{segment}")
+        self._write("  D=M")
         # idx分ずらす
-        self.fp.write(f"  @{index}\n")
-        self.fp.write("  D=D+A\n")
-        # 一時的にTEMPへsegment+idxを保存
-        self.fp.write("  @5\n")
-        self.fp.write("  M=D\n")
+        self._write(f"  @{index}")
+        self._write("  D=D+A")
+        # 一時的にR13へsegment+idxを保存 (R5~R12はtempセグメントなので使わない)
+        self._write("  @R13")
+        self._write("  M=D")
         
-    def _store_data_in_segment(self, segment: str, index: int, data: int = None) -> None:
+    def _store_data_in_segment(self, segment: str, index: int) -> None:
         """
-        セグメントからデータを取得し、データレジスタへ格納する関数
+        スタックからデータを取り出し、セグメントへ格納する関数
         インデックスにも対応
+        アドレスを先にR13へ計算してから取り出すので、データレジスタの値は壊れない
 
         Parameters
         ----------
@@ -209,52 +562,133 @@ class CodeWriter:
             LCL, ARG, THIS, THATの4種類
         index : int
             インデックス
-        data : int
-            格納するデータ
-            指定されない場合(=None)はデータレジスタの値を格納する
         """
         self._calculate_segment_address(
             segment=segment, index=index
         )
-        # データを格納
-        # データの指定がある場合、直前でデータレジスタにその値を格納する
-        if data is not None:
-            self.fp.write(f"  @{data}\n")
-            self.fp.write("  D=A\n")
-        self.fp.write("  @5\n")
-        self.fp.write("  A=M\n")
-        self.fp.write("  M=D\n")
-        self._increase_stack_pointer()
+        self._get_one_arg_from_stack()
+        self._write("  @R13")
+        self._write("  A=M")
+        self._write("  M=D")
         
     def _get_data_from_segment(self, segment: str, index: int) -> None:
-        self._calculate_segment_address(
-            segment=segment, index=index
-        )
-        self.fp.write("  @5\n")
-        self.fp.write("  A=M\n")
-        self.fp.write("  D=M\n")
+        """
+        セグメントからデータを取得し、データレジスタへ格納する関数
+        """
+        self._write(f"  @{segment}")
+        self._write("  D=M")
+        self._write(f"  @{index}")
+        self._write("  A=D+A")
+        self._write("  D=M")
+
+    def _write_shared_routines(self) -> None:
+        """
+        共有の比較ルーチンとreturnルーチンを書く
+        プログラムの先頭に置くので、最初にルーチンを飛び越える
+        比較ルーチンは戻り先アドレスをRETURN_ADDRESS_REGISTERから受け取る
+        """
+        self._write("  @__VM_START")
+        self._write("  0;JMP")
+        # 比較ルーチン: 結果を仮に真(-1)として書き、条件を満たさなければ偽(0)に直す
+        for command, label in SHARED_COMPARE_LABELS.items():
+            self._write(f"({label})")
+            self._write("  @SP")
+            self._write("  AM=M-1")
+            self._write("  D=M")
+            self._write("  A=A-1")
+            self._write("  D=M-D")
+            self._write("  M=-1")
+            self._write("  @__VM_COMPARE_END")
+            self._write(f"  D;J{command.upper()}")
+            self._write("  @__VM_COMPARE_FALSE")
+            self._write("  0;JMP")
+        self._write("(__VM_COMPARE_FALSE)")
+        self._write("  @SP")
+        self._write("  A=M-1")
+        self._write("  M=0")
+        self._write("(__VM_COMPARE_END)")
+        self._write(f"  @{RETURN_ADDRESS_REGISTER}")
+        self._write("  A=M")
+        self._write("  0;JMP")
+        # returnルーチン: 戻り先は呼び出し側のフレームから取り出す
+        self._write(f"({SHARED_RETURN_LABEL})")
+        self._write_return_body()
+        self._write("(__VM_START)")
+
+    def _write_shared_compare_call(self, command: str) -> None:
+        """
+        戻り先アドレスをRETURN_ADDRESS_REGISTERに入れて、共有の比較ルーチンへジャンプする
+        """
+        return_label = f"{self.file_name}$compare_return_{self.jump_number}"
+        self._write(f"  @{return_label}")
+        self._write("  D=A")
+        self._write(f"  @{RETURN_ADDRESS_REGISTER}")
+        self._write("  M=D")
+        self._write(f"  @{SHARED_COMPARE_LABELS[command]}")
+        self._write("  0;JMP")
+        self._write(f"({return_label})")
+        self.jump_number += 1
+
+    def _write_cached_arithmetic(self, command: str) -> None:
+        """
+        スタックの先頭をDレジスタに置いたまま、算術論理コマンドを書く
+        結果もDレジスタに置いたままにする
+        """
+        if command in SHARED_COMPARE_LABELS and self.routine_mode == RoutineMode.SHARED:
+            # 共有ルーチンはメモリ上のスタックを読む
+            self._spill_tos()
+            self._write_shared_compare_call(command=command)
+            return
+        self._load_tos()
+        if command in CACHED_UNARY_OPERATIONS:
+            self._write(f"  {CACHED_UNARY_OPERATIONS[command]}")
+        elif command in CACHED_BINARY_OPERATIONS:
+            self._write("  @SP")
+            self._write("  AM=M-1")
+            self._write(f"  {CACHED_BINARY_OPERATIONS[command]}")
+        elif command in SHARED_COMPARE_LABELS:
+            self._write("  @SP")
+            self._write("  AM=M-1")
+            self._write("  D=M-D")
+            self._write(f"  @{self.file_name}$true_{self.jump_number}")
+            self._write(f"  D;J{command.upper()}")
+            self._write("  D=0")
+            self._write(f"  @{self.file_name}$end_{self.jump_number}")
+            self._write("  0;JMP")
+            self._write(f"({self.file_name}$true_{self.jump_number})")
+            self._write("  D=-1")
+            self._write(f"({self.file_name}$end_{self.jump_number})")
+            self.jump_number += 1
+        else:
+            raise Exception(f"Invalid Command: {command}")
 
     def write_arithmetic(self, command: str) -> None:
         """
         算術論理コマンドに対応するアセンブリコードを書く
         """
+        if self.cache_tos:
+            self._write_cached_arithmetic(command=command)
+            return
+
         if command == "add":
             self._get_two_args_from_stack()
-            self.fp.write("  M=D+M\n")
+            self._write("  M=D+M")
             self._increase_stack_pointer()
         elif command == "sub":
             self._get_two_args_from_stack()
-            self.fp.write("  M=M-D\n")
+            self._write("  M=M-D")
             self._increase_stack_pointer()
         elif command == "neg":
-            self.fp.write("  @SP\n")
-            self.fp.write("  AM=M-1\n")
-            self.fp.write("  M=-M\n")
+            self._write("  @SP")
+            self._write("  AM=M-1")
+            self._write("  M=-M")
             self._increase_stack_pointer()
+        elif command in ("eq", "gt", "lt") and self.routine_mode == RoutineMode.SHARED:
+            self._write_shared_compare_call(command=command)
         elif command in ("eq", "gt", "lt"):
             self._get_two_args_from_stack()
-            self.fp.write("  D=M-D\n")
-            self.fp.write(f"  @true_{self.jump_number}\n")
+            self._write("  D=M-D")
+            self._write(f"  @{self.file_name}$true_{self.jump_number}")
             jump = ""
             if command == "eq":
                 jump = "JEQ"
@@ -262,31 +696,31 @@ class CodeWriter:
                 jump = "JGT"
             elif command == "lt":
                 jump = "JLT"
-            self.fp.write(f"  D;{jump}\n")
-            self.fp.write("  @SP\n")
-            self.fp.write("  A=M\n")
-            self.fp.write("  M=0\n")
-            self.fp.write(f"  @end_{self.jump_number}\n")
-            self.fp.write("  0;JMP\n")
-            self.fp.write(f"(true_{self.jump_number})\n")
-            self.fp.write("  @SP\n")
-            self.fp.write("  A=M\n")
-            self.fp.write("  M=-1\n")
-            self.fp.write(f"(end_{self.jump_number})\n")
+            self._write(f"  D;{jump}")
+            self._write("  @SP")
+            self._write("  A=M")
+            self._write("  M=0")
+            self._write(f"  @{self.file_name}$end_{self.jump_number}")
+            self._write("  0;JMP")
+            self._write(f"({self.file_name}$true_{self.jump_number})")
+            self._write("  @SP")
+            self._write("  A=M")
+            self._write("  M=-1")
+            self._write(f"({self.file_name}$end_{self.jump_number})")
             self._increase_stack_pointer()
             self.jump_number += 1
         elif command == "and":
             self._get_two_args_from_stack()
-            self.fp.write("  M=D&M\n")
+            self._write("  M=D&M")
             self._increase_stack_pointer()
         elif command == "or":
             self._get_two_args_from_stack()
-            self.fp.write("  M=D|M\n")
+            self._write("  M=D|M")
             self._increase_stack_pointer()
         elif command == "not":
-            self.fp.write("  @SP\n")
-            self.fp.write("  AM=M-1\n")
-            self.fp.write("  M=!M\n")
+            self._write("  @SP")
+            self._write("  AM=M-1")
+            self._write("  M=!M")
             self._increase_stack_pointer()
         else:
             raise Exception(f"Invalid Command: {command}")
@@ -295,80 +729,88 @@ class CodeWriter:
         """
         PUSH, POPコマンドに対応するアセンブリコードを書く
         """
-        if segment == "constant":
-            self.fp.write(f"  @{index}\n")
-            self.fp.write("  D=A\n")
-            self._store_one_data_in_stack()
-        elif segment in ("local", "argument", "this", "that", "temp"):
+        if command == Command.PUSH:
+            self._spill_tos()
+        if segment == "constant" and index < 0:
+            # 定数畳み込みで生じた負の定数。!(-index-1) == index を使う
+            self._write(f"  @{-index - 1}")
+            self._write("  D=!A")
+            self._push_d()
+        elif segment == "constant":
+            self._write(f"  @{index}")
+            self._write("  D=A")
+            self._push_d()
+        elif segment in ("local", "argument", "this", "that"):
             if command == Command.PUSH:
                 self._get_data_from_segment(
-                    # segment_base=self.pointer_map[segment]["base"],
                     segment=SEGMENT_MAP[segment],
                     index=index
                 )
-                self._store_one_data_in_stack()
+                self._push_d()
+            elif command == Command.POP and self.cache_tos:
+                self._load_tos()
+                self._store_cached_tos_in_segment(
+                    segment=SEGMENT_MAP[segment],
+                    index=index
+                )
             elif command == Command.POP:
-                self._get_one_arg_from_stack()
-                # self._store_data_in_segment(
-                #     segment_base=self.pointer_map[segment]["base"], index=index                    
-                # )
                 self._store_data_in_segment(
                     segment=SEGMENT_MAP[segment],
                     index=index
                 )
-        # elif segment in ("this", "that"):
-            # self.fp.write(f"  @{SEGMENT_MAP[segment]}\n")
-            # self.fp.write(f"  @{self.pointer_map[segment]['symbol']}\n")
-            # self.fp.write("  D=M\n")
-            # self.fp.write(f"  @{index}\n")
-            # self.fp.write("  D=D+A\n")
-            # 5をAレジスタへ、一時的な保存
-            # self.fp.write("  @5\n")
-            # self.fp.write("  M=D\n")
-            # if command == Command.PUSH:
-                # 5をAレジスタへ、一時的な保存
-                # self.fp.write("  @5\n")
-                # self.fp.write("  A=M\n")
-                # self.fp.write("  D=M\n")
-                # self._store_one_data_in_stack()
-            # elif command == Command.POP:
-                # self._get_one_arg_from_stack()
-                # 5をAレジスタへ、一時的な保存
-                # self.fp.write("  @5\n")
-                # self.fp.write("  A=M\n")
-                # self.fp.write("  M=D\n")
+        elif segment == "temp":
+            # tempセグメントはR5~R12に固定されている
+            if command == Command.PUSH:
+                self._write(f"  @R{TEMP_BASE + index}")
+                self._write("  D=M")
+                self._push_d()
+            elif command == Command.POP:
+                self._pop_to_d()
+                self._write(f"  @R{TEMP_BASE + index}")
+                self._write("  M=D")
         elif segment == "pointer":
             seg = "THIS" if index == 0 else "THAT"
             if command == Command.PUSH:
-                self.fp.write(f"  @{seg}\n")
-                self.fp.write("  D=M\n")
-                self._store_one_data_in_stack()
+                self._write(f"  @{seg}")
+                self._write("  D=M")
+                self._push_d()
             elif command == Command.POP:
-                self._get_one_arg_from_stack()
-                self.fp.write(f"  @{seg}\n")
-                self.fp.write("  M=D\n")
+                self._pop_to_d()
+                self._write(f"  @{seg}")
+                self._write("  M=D")
         elif segment == "static":
             if command == Command.PUSH:
-                self.fp.write(f"  @{self.file_name}.{index}\n")
-                self.fp.write("  D=M\n")
-                self._store_one_data_in_stack()
+                self._write(f"  @{self.file_name}.{index}")
+                self._write("  D=M")
+                self._push_d()
             elif command == Command.POP:
-                self._get_one_arg_from_stack()
-                self.fp.write(f"  @{self.file_name}.{index}\n")
-                self.fp.write("  M=D\n")
+                self._pop_to_d()
+                self._write(f"  @{self.file_name}.{index}")
+                self._write("  M=D")
 
     def write_label(self, label: str) -> None:
-        self.fp.write(f"({label})\n")
+        self._spill_tos()
+        self._write(f"({self._scoped_label(label)})")
     
     def write_goto(self, label: str) -> None:
-        self.fp.write(f"  @{label}\n")
-        self.fp.write("  0;JMP\n")
+        self._spill_tos()
+        self._write(f"  @{self._scoped_label(label)}")
+        self._write("  0;JMP")
     
     def write_if(self, label: str) -> None:
-        self._get_one_arg_from_stack()
-        self.fp.write(f"  @{label}\n")
-        self.fp.write("  D;JGT\n")
-    
+        # 偽(0)以外ならジャンプする (真は-1なのでJGTでは飛ばない)
+        self._pop_to_d()
+        self._write(f"  @{self._scoped_label(label)}")
+        self._write("  D;JNE")
+
+    def _push_register(self, register: str) -> None:
+        """
+        レジスタ(LCL, ARGなど)の値をスタックへpushする
+        """
+        self._write(f"  @{register}")
+        self._write("  D=M")
+        self._store_one_data_in_stack()
+
     def write_function(self, function_name: str, n_vars: int) -> None:
         """
         関数fを宣言し、関数がn_vars個のローカル変数を持つことを知らせる
@@ -381,24 +823,50 @@ class CodeWriter:
             ローカル変数の数
             この数だけスタックを0で初期化する
         """
-        for i in range(n_vars):
-            self._store_data_in_segment(
-                segment=SEGMENT_MAP["local"],
-                index=i,
-                data=0
-            )
+        self._spill_tos()
+        self.current_function = function_name
+        self._write(f"({function_name})")
+        for _ in range(n_vars):
+            self.write_push_pop(command=Command.PUSH, segment="constant", index=0)
     
     def write_call(self, function_name: str, n_args: int) -> None:
-        """_summary_
+        """
+        関数fを呼び出す。呼び出し側のフレームを保存してからfへジャンプする
 
         Parameters
         ----------
         function_name : str
-            _description_
+            呼び出す関数名
         n_args : int
-            _description_
+            スタックに積まれた引数の数
         """
-        pass
+        self._spill_tos()
+        caller = self.current_function if self.current_function is not None else self.file_name
+        return_label = f"{caller}$ret.{self.call_number}"
+        self.call_number += 1
+        # push retAddr
+        self._write(f"  @{return_label}")
+        self._write("  D=A")
+        self._store_one_data_in_stack()
+        # push LCL, ARG, THIS, THAT
+        for register in ("LCL", "ARG", "THIS", "THAT"):
+            self._push_register(register=register)
+        # ARG = SP - 5 - n_args
+        self._write("  @SP")
+        self._write("  D=M")
+        self._write(f"  @{5 + n_args}")
+        self._write("  D=D-A")
+        self._write("  @ARG")
+        self._write("  M=D")
+        # LCL = SP
+        self._write("  @SP")
+        self._write("  D=M")
+        self._write("  @LCL")
+        self._write("  M=D")
+        # goto f
+        self._write(f"  @{function_name}")
+        self._write("  0;JMP")
+        self._write(f"({return_label})")
     
     def write_return(self, function_name: str) -> None:
         """
@@ -409,133 +877,1314 @@ class CodeWriter:
         function_name : str
             関数名
         """
+        self._spill_tos()
+        if self.routine_mode == RoutineMode.SHARED:
+            self._write(f"  @{SHARED_RETURN_LABEL}")
+            self._write("  0;JMP")
+        else:
+            self._write_return_body()
+
+    def _write_return_body(self) -> None:
+        """
+        returnの本体。展開する場合と共有ルーチンの両方で使う
+        """
         # fname = LCL
-        self.fp.write("  @LCL\n")
-        self.fp.write("  D=M\n")
-        # self.fp.write("  D=M\n")
-        self.fp.write("  @13\n")
-        self.fp.write("  M=D\n")
+        self._write("  @LCL")
+        self._write("  D=M")
+        # self._write("  D=M")
+        self._write("  @13")
+        self._write("  M=D")
         # retAddr = *(fname-5)
-        self.fp.write("  @LCL\n")
-        self.fp.write("  D=M\n")
-        self.fp.write("  @5\n")
-        self.fp.write("  D=D-A\n")
-        self.fp.write("  A=D\n")
-        self.fp.write("  D=M\n")
-        self.fp.write("  @14\n")
-        self.fp.write("  M=D\n")
+        self._write("  @LCL")
+        self._write("  D=M")
+        self._write("  @5")
+        self._write("  D=D-A")
+        self._write("  A=D")
+        self._write("  D=M")
+        self._write("  @14")
+        self._write("  M=D")
         # *ARG = pop()
         self._get_one_arg_from_stack()
-        self.fp.write("  @ARG\n")
-        self.fp.write("  A=M\n")
-        self.fp.write("  M=D\n")
+        self._write("  @ARG")
+        self._write("  A=M")
+        self._write("  M=D")
         # SP = ARG + 1
-        self.fp.write("  @ARG\n")
-        self.fp.write("  D=M+1\n")
-        self.fp.write("  @SP\n")
-        self.fp.write("  M=D\n")
+        self._write("  @ARG")
+        self._write("  D=M+1")
+        self._write("  @SP")
+        self._write("  M=D")
         # THAT = *(fname-1)
-        self.fp.write("  @13\n")
-        self.fp.write("  D=M\n")
-        self.fp.write("  @1\n")
-        self.fp.write("  A=D-A\n")
-        self.fp.write("  D=M\n")
-        self.fp.write("  @THAT\n")
-        self.fp.write("  M=D\n")
+        self._write("  @13")
+        self._write("  D=M")
+        self._write("  @1")
+        self._write("  A=D-A")
+        self._write("  D=M")
+        self._write("  @THAT")
+        self._write("  M=D")
         # THIS = *(fname-2)
-        self.fp.write("  @13\n")
-        self.fp.write("  D=M\n")
-        self.fp.write("  @2\n")
-        self.fp.write("  A=D-A\n")
-        self.fp.write("  D=M\n")
-        self.fp.write("  @THIS\n")
-        self.fp.write("  M=D\n")
+        self._write("  @13")
+        self._write("  D=M")
+        self._write("  @2")
+        self._write("  A=D-A")
+        self._write("  D=M")
+        self._write("  @THIS")
+        self._write("  M=D")
         # ARG = *(fname-3)
-        self.fp.write("  @13\n")
-        self.fp.write("  D=M\n")
-        self.fp.write("  @3\n")
-        self.fp.write("  A=D-A\n")
-        self.fp.write("  D=M\n")
-        self.fp.write("  @ARG\n")
-        self.fp.write("  M=D\n")
+        self._write("  @13")
+        self._write("  D=M")
+        self._write("  @3")
+        self._write("  A=D-A")
+        self._write("  D=M")
+        self._write("  @ARG")
+        self._write("  M=D")
         # LCL = *(fname-4)
-        self.fp.write("  @13\n")
-        self.fp.write("  D=M\n")
-        self.fp.write("  @4\n")
-        self.fp.write("  A=D-A\n")
-        self.fp.write("  D=M\n")
-        self.fp.write("  @LCL\n")
-        self.fp.write("  M=D\n")
+        self._write("  @13")
+        self._write("  D=M")
+        self._write("  @4")
+        self._write("  A=D-A")
+        self._write("  D=M")
+        self._write("  @LCL")
+        self._write("  M=D")
         # goto retAddr
-        self.fp.write("  @14\n")
-        self.fp.write("  A=M\n")
-        self.fp.write("  0;JMP\n")
+        self._write("  @14")
+        self._write("  A=M")
+        self._write("  0;JMP")
+
+
+
+class PeepholeOptimizer:
+    # 規則の適用順。すべての規則で変化がなくなるまで繰り返す
+    RULES = ("push_pop", "sp_inc_dec", "a_reload", "store_reload")
+    # スタックへのpushの末尾 (_store_one_data_in_stack)
+    PUSH_TAIL = ("@SP", "A=M", "M=D", "@SP", "M=M+1")
+    # スタックからのpopの先頭 (_get_one_arg_from_stack)
+    POP_HEAD = ("@SP", "M=M-1", "@SP", "A=M", "D=M")
+    # push/popの間に挟めるアドレス計算の最大命令数
+    MAX_GAP = 8
+
+    def __init__(self) -> None:
+        """
+        CodeWriterが出力したアセンブリに、のぞき穴最適化をかける
+        規則ごとに削減した命令数をsavedに記録する
+        """
+        self.saved = {rule: 0 for rule in self.RULES}
 
-    def close(self) -> None:
+    def optimize(self, lines: list) -> list:
         """
-        出力ファイル/ストリームを閉じる
+        アセンブリの行のリストを最適化して返す
+        コメント行は次の命令(またはラベル)に付けて扱い、命令が消えても出力に残す
+        ラベルをまたぐ変換は行わない(ジャンプで合流するため)
         """
-        self._create_infinite_loop()
-        self.fp.close()
+        # [命令またはラベル, 直前のコメント行のリスト]
+        code = []
+        comments = []
+        for line in lines:
+            text = line.strip()
+            if text == "":
+                continue
+            if text.startswith("//"):
+                comments.append(line)
+                continue
+            code.append([text, comments])
+            comments = []
+
+        changed = True
+        while changed:
+            changed = False
+            for rule in self.RULES:
+                code, saved = getattr(self, f"_rule_{rule}")(code)
+                if saved:
+                    self.saved[rule] += saved
+                    changed = True
+
+        optimized = []
+        for text, entry_comments in code:
+            optimized += entry_comments
+            optimized.append(text if text.startswith("(") else f"  {text}")
+        return optimized + comments
+
+    @staticmethod
+    def _texts(code: list, start: int, length: int) -> tuple:
+        return tuple(entry[0] for entry in code[start:start + length])
+
+    @staticmethod
+    def _starts_with_a_instruction(code: list, index: int) -> bool:
+        """
+        index番目が@xxxか判定する(Aレジスタの値に依存しないことの確認に使う)
+        """
+        return index < len(code) and code[index][0].startswith("@")
+
+    @staticmethod
+    def _replace(code: list, start: int, end: int, texts: list) -> list:
+        """
+        code[start:end]をtextsの命令で置き換える。消えた命令のコメントは先頭に集める
+        """
+        comments = []
+        for _, entry_comments in code[start:end]:
+            comments += entry_comments
+        entries = [[text, []] for text in texts]
+        if entries:
+            entries[0][1] = comments
+        elif end < len(code):
+            code[end][1] = comments + code[end][1]
+        return entries
+
+    def _is_movable_gap(self, code: list, start: int, end: int) -> bool:
+        """
+        code[start:end]が、スタックとR14に触れない直線的なアドレス計算か判定する
+        メモリへのアクセスは、直前の@xxxがシンボル(SP以外)の場合だけ許す
+        """
+        if start == end or not code[start][0].startswith("@"):
+            return False
+        symbol_address = False
+        for text, _ in code[start:end]:
+            if text.startswith("("):
+                return False
+            if text.startswith("@"):
+                symbol = text[1:]
+                if symbol in ("SP", "R0", "R14") or symbol in ("0", "14"):
+                    return False
+                symbol_address = not symbol.isdigit()
+                continue
+            if ";" in text:
+                return False
+            dest, _, comp = text.partition("=")
+            if "M" in comp or "M" in dest:
+                if not symbol_address:
+                    return False
+            if "A" in dest:
+                symbol_address = False
+        return True
+
+    def _match_push_pop(self, code: list, start: int) -> tuple:
+        """
+        code[start]から始まるpushの末尾と、それに続くpopの先頭を探す
+        見つかれば(間の開始位置, 間の終了位置, popの終了位置)を、なければNoneを返す
+        """
+        if self._texts(code, start, len(self.PUSH_TAIL)) != self.PUSH_TAIL:
+            return None
+        gap_start = start + len(self.PUSH_TAIL)
+        for gap_end in range(gap_start, min(gap_start + self.MAX_GAP, len(code)) + 1):
+            if self._texts(code, gap_end, len(self.POP_HEAD)) == self.POP_HEAD:
+                break
+        else:
+            return None
+        pop_end = gap_end + len(self.POP_HEAD)
+        # popの後ろがAレジスタの値に依存していないこと
+        if not self._starts_with_a_instruction(code, pop_end):
+            return None
+        if gap_end > gap_start and not self._is_movable_gap(code, gap_start, gap_end):
+            return None
+        return gap_start, gap_end, pop_end
+
+    def _rule_push_pop(self, code: list) -> tuple:
+        """
+        pushの直後のpopを直接の移動にする
+        間に何もなければpushの末尾とpopの先頭をどちらも消す(値はDレジスタに残っている)
+        間にアドレス計算があれば、値をスタックの代わりにR14へ退避する
+        """
+        result = []
+        saved = 0
+        i = 0
+        while i < len(code):
+            match = self._match_push_pop(code, i)
+            if match is None:
+                result.append(code[i])
+                i += 1
+                continue
+            gap_start, gap_end, pop_end = match
+            if gap_start == gap_end:
+                result += self._replace(code, i, pop_end, [])
+                saved += len(self.PUSH_TAIL) + len(self.POP_HEAD)
+            else:
+                result += self._replace(code, i, gap_start, ["@R14", "M=D"])
+                result += code[gap_start:gap_end]
+                result += self._replace(code, gap_end, pop_end, ["@R14", "D=M"])
+                saved += len(self.PUSH_TAIL) + len(self.POP_HEAD) - 4
+            i = pop_end
+        return result, saved
+
+    def _rule_sp_inc_dec(self, code: list) -> tuple:
+        """
+        隣り合ったスタックポインタの増加と減少を打ち消す
+        """
+        result = []
+        saved = 0
+        i = 0
+        while i < len(code):
+            texts = self._texts(code, i, 4)
+            if texts == ("@SP", "M=M+1", "@SP", "M=M-1") and self._starts_with_a_instruction(code, i + 4):
+                result += self._replace(code, i, i + 4, [])
+                saved += 4
+                i += 4
+                continue
+            result.append(code[i])
+            i += 1
+        return result, saved
+
+    def _rule_a_reload(self, code: list) -> tuple:
+        """
+        Aレジスタに既に入っている値を読み込み直す命令を消す
+        @xxxの直後でAが変わっていなければ同じ@xxxを、
+        @SP/A=M(またはAM=M±1)の後でAが変わっていなければ@SP/A=Mを消す
+        """
+        result = []
+        saved = 0
+        # Aレジスタの中身: ("const", xxx) / ("sp_top", None) / None(不明)
+        state = None
+        i = 0
+        while i < len(code):
+            text = code[i][0]
+            if text.startswith("("):
+                state = None
+            elif text.startswith("@"):
+                if state == ("const", text[1:]):
+                    result += self._replace(code, i, i + 1, [])
+                    saved += 1
+                    i += 1
+                    continue
+                if text == "@SP" and state == ("sp_top", None) and self._texts(code, i + 1, 1) == ("A=M",):
+                    result += self._replace(code, i, i + 2, [])
+                    saved += 2
+                    i += 2
+                    continue
+                state = ("const", text[1:])
+            else:
+                dest = text.split(";")[0].partition("=")[0] if "=" in text else ""
+                if "A" in dest:
+                    comp = text.split(";")[0].partition("=")[2]
+                    if state == ("const", "SP") and comp in ("M", "M-1", "M+1"):
+                        state = ("sp_top", None)
+                    else:
+                        state = None
+            result.append(code[i])
+            i += 1
+        return result, saved
+
+    def _rule_store_reload(self, code: list) -> tuple:
+        """
+        メモリへ書いた値をすぐにDへ読み直す場合、1つのC命令にまとめる
+        M=D, D=M は M=D に、M=comp, D=M は MD=comp にする
+        """
+        result = []
+        saved = 0
+        i = 0
+        while i < len(code):
+            text = code[i][0]
+            if text.startswith("M=") and ";" not in text and self._texts(code, i + 1, 1) == ("D=M",):
+                comp = text[2:]
+                merged = "M=D" if comp == "D" else f"MD={comp}"
+                result += self._replace(code, i, i + 2, [merged])
+                saved += 1
+                i += 2
+                continue
+            result.append(code[i])
+            i += 1
+        return result, saved
+
+
+def _to_signed16(value: int) -> int:
+    """
+    16bitで桁あふれさせ、-32768~32767の値にする
+    """
+    value &= 0xFFFF
+    return value - 0x10000 if value & 0x8000 else value
+
+
+class VMOptimizer:
+    # パスの適用順
+    PASSES = ("constant_folding", "dead_push")
+    # 定数同士を畳み込める2項演算
+    FOLDABLE_BINARY = {
+        "add": lambda x, y: x + y,
+        "sub": lambda x, y: x - y,
+        "and": lambda x, y: x & y,
+        "or": lambda x, y: x | y,
+    }
+    # 定数を畳み込める単項演算
+    FOLDABLE_UNARY = {
+        "neg": lambda x: -x,
+        "not": lambda x: ~x,
+    }
+    # 書き込まれた値が読まれずに上書きされたか調べるのを打ち切るコマンド
+    # (ジャンプ先や呼び出し先で読まれるかもしれない)
+    BLOCK_END_COMMANDS = (
+        Command.LABEL,
+        Command.GOTO,
+        Command.IF,
+        Command.FUNCTION,
+        Command.CALL,
+        Command.RETURN,
+    )
+
+    def __init__(self, passes: Iterable[str] = PASSES) -> None:
+        """
+        CodeWriterへ渡す前のVMコマンドのリストに最適化をかける
+        パスごとに書き換えた箇所の数と、減ったVMコマンドの数を記録する
+
+        Parameters
+        ----------
+        passes : Iterable[str]
+            有効にするパスの名前 (PASSESのうちのいくつか)
+        """
+        self.passes = [name for name in self.PASSES if name in set(passes)]
+        self.changes = {name: 0 for name in self.passes}
+        self.removed = {name: 0 for name in self.passes}
+
+    def optimize(self, commands: list) -> list:
+        for name in self.passes:
+            before = len(commands)
+            commands, changes = getattr(self, f"_pass_{name}")(commands)
+            self.changes[name] += changes
+            self.removed[name] += before - len(commands)
+        return commands
+
+    def _pass_constant_folding(self, commands: list) -> tuple:
+        """
+        push constant a; push constant b; add/sub/and/or と
+        push constant a; neg/not を、結果の定数のpushにまとめる
+        結果はHackと同じく16bitで桁あふれさせる(負の定数になることもある)
+        """
+        result = []
+        changes = 0
+        for command in commands:
+            if command.command_type == Command.ARITHMETIC:
+                operation = command.arg1
+                if (
+                    operation in self.FOLDABLE_BINARY
+                    and len(result) >= 2
+                    and result[-2].is_constant_push()
+                    and result[-1].is_constant_push()
+                ):
+                    y = result.pop().arg2
+                    x = result.pop().arg2
+                    value = _to_signed16(self.FOLDABLE_BINARY[operation](x, y))
+                    result.append(VMCommand(Command.PUSH, "constant", value))
+                    changes += 1
+                    continue
+                if operation in self.FOLDABLE_UNARY and result and result[-1].is_constant_push():
+                    x = result.pop().arg2
+                    value = _to_signed16(self.FOLDABLE_UNARY[operation](x))
+                    result.append(VMCommand(Command.PUSH, "constant", value))
+                    changes += 1
+                    continue
+            result.append(command)
+        return result, changes
+
+    def _is_dead_pop(self, commands: list, index: int) -> bool:
+        """
+        commands[index]のpopが、読まれない場所への書き込みか判断する
+        同じ場所へのpush直後のpop(自分自身への代入)か、
+        tempへのpopで、同じブロック内で読まれる前に上書きされる場合
+        """
+        pop = commands[index]
+        push = commands[index - 1]
+        if push.arg1 == pop.arg1 and push.arg2 == pop.arg2 and pop.arg1 != "pointer":
+            return True
+        if pop.arg1 != "temp":
+            return False
+        for command in commands[index + 1:]:
+            if command.command_type in self.BLOCK_END_COMMANDS:
+                return False
+            if command.arg1 == "temp" and command.arg2 == pop.arg2:
+                return command.command_type == Command.POP
+        return False
+
+    def _pass_dead_push(self, commands: list) -> tuple:
+        """
+        pushした値を、読まれない場所へすぐにpopしている組を取り除く
+        (push local 0; pop local 0 や、使われないまま上書きされるtempへの退避)
+        """
+        result = []
+        changes = 0
+        i = 0
+        while i < len(commands):
+            command = commands[i]
+            if (
+                command.command_type == Command.PUSH
+                and i + 1 < len(commands)
+                and commands[i + 1].command_type == Command.POP
+                and self._is_dead_pop(commands, i + 1)
+            ):
+                changes += 1
+                i += 2
+                continue
+            result.append(command)
+            i += 1
+        return result, changes
+
+
+class HackEncoder:
+    def __init__(self) -> None:
+        """
+        CodeWriterが出力する行を、アセンブラを通さずに16bitの機械語へ変換する
+        ラベルとシンボル(File.iなど)の参照は記録しておき、resolve()でまとめて解決する
+        C命令の対応表と定義済みシンボルはアセンブラのものを使う
+        """
+        assembler = _load_assembler()
+        self.c_instruction_table = assembler.C_INSTRUCTION_TABLE
+        self.predefined_symbols = assembler.PREDEFINED_SYMBOLS
+        self.symbol_table_class = assembler.SymbolTable
+        self.words = array("H")
+        # ラベル -> 命令のインデックス
+        self.labels = {}
+        # (命令のインデックス, シンボル)
+        self.fixups = []
+        # 行 -> 変換結果 (整数の命令 / 未解決のシンボル / None)
+        self.line_cache = {}
+
+    def _compile_line(self, line: str):
+        """
+        ラベル以外の1行を、整数の命令か未解決のシンボル(str)に変換する
+        コメントと空行はNoneになる
+        """
+        if line in self.line_cache:
+            return self.line_cache[line]
+        text = line.strip()
+        if text == "" or text.startswith("//"):
+            entry = None
+        elif text.startswith("@"):
+            symbol = text[1:]
+            if symbol.isdigit():
+                entry = int(symbol)
+            elif symbol in self.predefined_symbols:
+                entry = self.predefined_symbols[symbol]
+            else:
+                entry = sys.intern(symbol)
+        else:
+            entry = self.c_instruction_table[text]
+        self.line_cache[line] = entry
+        return entry
+
+    def compile(self, lines: list) -> tuple:
+        """
+        ラベルを含まない行の並びを、機械語のテンプレートにする
+        """
+        template = []
+        for line in lines:
+            entry = self._compile_line(line)
+            if entry is not None:
+                template.append(entry)
+        return tuple(template)
+
+    def extend(self, template: tuple) -> None:
+        """
+        テンプレートの命令を追加する。シンボルの位置はfixupとして記録する
+        """
+        for entry in template:
+            if entry.__class__ is str:
+                self.fixups.append((len(self.words), entry))
+                self.words.append(0)
+            else:
+                self.words.append(entry)
+
+    def encode_lines(self, lines: Iterable[str]) -> None:
+        """
+        ラベルを含む行の並びを変換する
+        """
+        for line in lines:
+            if line.startswith("("):
+                self.labels[line.strip()[1:-1]] = len(self.words)
+                continue
+            entry = self._compile_line(line)
+            if entry is None:
+                continue
+            if entry.__class__ is str:
+                self.fixups.append((len(self.words), entry))
+                self.words.append(0)
+            else:
+                self.words.append(entry)
+
+    def merge(self, words: array, labels: dict, fixups: list) -> None:
+        """
+        別のHackEncoderが変換した断片を末尾へ連結する
+        """
+        offset = len(self.words)
+        self.words.extend(words)
+        for label, index in labels.items():
+            self.labels[label] = index + offset
+        self.fixups.extend((index + offset, symbol) for index, symbol in fixups)
+
+    def resolve(self) -> array:
+        """
+        ラベルとシンボルを解決した命令列を返す
+        アセンブラと同じく、ラベル以外のシンボルは最初に参照された順に16番地から割り当てる
+        """
+        symbol_table = self.symbol_table_class()
+        for label, index in self.labels.items():
+            symbol_table.addEntry(label, index)
+        words = array("H", self.words)
+        for index, symbol in self.fixups:
+            words[index] = symbol_table.get_or_allocate(symbol)
+        return words
+
+
+class TranslationCache:
+    def __init__(self, cache_dir: str) -> None:
+        """
+        .vmファイル1つ分の変換結果をディスクに保存し、次回の変換で再利用する
+        キーは.vmファイルの内容・ファイル名・変換のオプション・この変換器自身のハッシュ
+        エントリはキーの名前のJSONファイルで、次を持つ
+        lines: 変換結果のアセンブリの行
+        counts: 最適化の集計 (VMTranslator.optimization_counts())
+        ラベルの連番はファイルごとに0から始まるので保存しない
+
+        Parameters
+        ----------
+        cache_dir : str
+            キャッシュを置くディレクトリ (なければ作る)
+        """
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def _translator_hash() -> str:
+        """
+        この変換器のソースのハッシュ。変換器を変更したら古いエントリを使わない
+        """
+        with open(os.path.abspath(__file__), "rb") as fp:
+            return hashlib.sha256(fp.read()).hexdigest()
+
+    def key(self, vm_file_path: str, options: dict) -> str:
+        """
+        .vmファイルと変換のオプションからキャッシュのキーを作る
+        ラベルとstaticの名前はファイル名から作るので、ファイル名もキーに含める
+        """
+        digest = hashlib.sha256()
+        header = {
+            "version": TRANSLATION_CACHE_VERSION,
+            "translator": self._translator_hash(),
+            "file_name": os.path.basename(vm_file_path),
+            "options": options,
+        }
+        digest.update(json.dumps(header, sort_keys=True).encode())
+        with open(vm_file_path, "rb") as fp:
+            digest.update(fp.read())
+        return digest.hexdigest()
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def load(self, key: str) -> dict:
+        """
+        エントリを読む。ない場合、または壊れている場合はNoneを返す
+        """
+        try:
+            with open(self._entry_path(key), "r") as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return None
+
+    def store(self, key: str, entry: dict) -> None:
+        """
+        エントリを書く。並列に変換するワーカーと競合しないよう、一時ファイルから置き換える
+        """
+        entry_path = self._entry_path(key)
+        temp_path = f"{entry_path}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as fp:
+            json.dump(entry, fp)
+        os.replace(temp_path, entry_path)
 
 
 class VMTranslator:
-    def __init__(self, vm_file_name: str) -> None:
-        self.vm_file_path = f"./{vm_file_name}"
-        self.parser = Parser(vm_file_path=self.vm_file_path)
-        self.code_writer = CodeWriter(file_path=self.vm_file_path)
+    def __init__(
+        self,
+        vm_file_name: str,
+        optimize: bool = False,
+        routine_mode: RoutineMode = RoutineMode.INLINE,
+        output: io.TextIOBase = None,
+        standalone: bool = True,
+        cache_tos: bool = False,
+        vm_passes: Iterable[str] = (),
+        removed_functions: Iterable[str] = (),
+        cache_dir: str = None,
+    ) -> None:
+        """
+        Parameters
+        ----------
+        cache_dir : str
+            指定した場合、変換結果をこのディレクトリにキャッシュし、
+            .vmファイルとオプションが同じなら変換せずにキャッシュの行を使う
+        """
+        self.vm_file_path = os.path.join(".", vm_file_name)
+        self.function_name = None
+        removed_functions = frozenset(removed_functions)
+        self.cache = TranslationCache(cache_dir=cache_dir) if cache_dir is not None else None
+        self.cache_key = None
+        self.cached_entry = None
+        if self.cache is not None:
+            self.cache_key = self.cache.key(
+                vm_file_path=self.vm_file_path,
+                options={
+                    "optimize": optimize,
+                    "routine_mode": routine_mode.value,
+                    "standalone": standalone,
+                    "cache_tos": cache_tos,
+                    "vm_passes": list(vm_passes),
+                    "removed_functions": sorted(removed_functions),
+                },
+            )
+            self.cached_entry = self.cache.load(key=self.cache_key)
+        # キャッシュを使ったファイル数 (0か1)
+        self.cache_hits = 0 if self.cached_entry is None else 1
+
+        # VMコマンドの中間表現。到達しない関数を取り除き、
+        # 有効なパスがあれば、CodeWriterへ渡す前に最適化する
+        # キャッシュを使う場合は変換しないので、.vmファイルを解析しない
+        self.parser = None
+        self.commands, self.removed_commands = [], {}
+        if self.cached_entry is None:
+            self.parser = Parser(vm_file_path=self.vm_file_path)
+            self.commands, self.removed_commands = split_functions(
+                commands=read_vm_commands(parser=self.parser),
+                removed_functions=removed_functions,
+            )
+        self.vm_optimizer = VMOptimizer(passes=vm_passes) if vm_passes else None
+        if self.vm_optimizer is not None:
+            self.commands = self.vm_optimizer.optimize(self.commands)
+        self.code_writer = CodeWriter(
+            file_path=self.vm_file_path,
+            optimize=optimize,
+            routine_mode=routine_mode,
+            output=output,
+            standalone=standalone,
+            cache_tos=cache_tos,
+        )
+        self.optimizer = self.code_writer.optimizer
+        self.options = {
+            "optimize": optimize,
+            "routine_mode": routine_mode,
+            "cache_tos": cache_tos,
+        }
+        if self.cached_entry is not None:
+            self._restore_counts(counts=self.cached_entry["counts"])
 
     def translate(self) -> None:
-        while self.parser.has_more_lines():
-            self.parser.advance()
-            if self.parser.order is None:
-                continue
+        """
+        変換結果を.asmファイル(または出力ストリーム)へチャンクごとにまとめて書き込む
+        """
+        self.code_writer.write_chunks(self.iter_chunks())
 
-            self.code_writer.fp.write(f"  // {self.parser.order}\n")
-            command_type = self.parser.commnad_type()
-            if command_type == Command.ARITHMETIC:
-                self.code_writer.write_arithmetic(command=self.parser.order)
-            elif command_type == Command.PUSH or command_type == Command.POP:
-                self.code_writer.write_push_pop(
-                    command=self.parser.commnad_type(),
-                    segment=self.parser.arg1(),
-                    index=self.parser.arg2()
-                )
-            elif command_type == Command.LABEL:
-                self.code_writer.write_label(label=self.parser.order.split()[-1])
-            elif command_type == Command.GOTO:
-                self.code_writer.write_goto(label=self.parser.order.split()[-1])
-            elif command_type == Command.IF:
-                self.code_writer.write_if(label=self.parser.order.split()[-1])
-            elif command_type == Command.FUNCTION:
-                self.function_name = self.parser.arg1()
-                self.n_args = self.parser.arg2()
-                self.n_vars = self.parser.arg2()
-                self.code_writer.write_function(
-                    function_name=self.function_name,
-                    n_vars=self.parser.arg2()
-                )
-            elif command_type == Command.RETURN:
-                self.code_writer.write_return(function_name=self.function_name)
-            elif command_type == Command.CALL:
-                self.code_writer.write_call(
-                    function_name=self.function_name,
-                    n_vars=self.n_vars
-                )
+    def optimization_counts(self) -> dict:
+        """
+        最適化の集計を返す
+        saved: のぞき穴最適化の規則ごとの削減数
+        changes / removed: VMのパスごとの書き換え数 / 減ったコマンド数
+        dead_functions: 取り除いた関数ごとのROMのワード数
+        cache_hits: キャッシュを使ったファイル数
+        """
+        if self.cached_entry is not None:
+            counts = dict(self.cached_entry["counts"])
+        else:
+            counts = {
+                "saved": self.optimizer.saved if self.optimizer is not None else {},
+                "changes": {},
+                "removed": {},
+                "dead_functions": self.dead_function_sizes(),
+            }
+            if self.vm_optimizer is not None:
+                counts["changes"] = self.vm_optimizer.changes
+                counts["removed"] = self.vm_optimizer.removed
+        counts["cache_hits"] = self.cache_hits
+        return counts
+
+    def _restore_counts(self, counts: dict) -> None:
+        """
+        キャッシュに保存した最適化の集計を、このVMTranslatorの集計へ戻す
+        """
+        if self.optimizer is not None:
+            self.optimizer.saved.update(counts["saved"])
+        if self.vm_optimizer is not None:
+            self.vm_optimizer.changes.update(counts["changes"])
+            self.vm_optimizer.removed.update(counts["removed"])
+
+    def _store_cache(self, lines: list) -> None:
+        """
+        変換結果の行と最適化の集計をキャッシュへ保存する
+        ラベルはファイル名(または関数名)で名前空間が分かれているので、
+        連番はファイルごとに0から始まり、キャッシュの行を他のファイルと並べても重ならない
+        """
+        counts = self.optimization_counts()
+        del counts["cache_hits"]
+        self.cache.store(
+            key=self.cache_key,
+            entry={"lines": lines, "counts": counts},
+        )
+
+    def dead_function_sizes(self) -> dict:
+        """
+        取り除いた関数ごとに、残していた場合のROMのワード数を求める
+        (レポート用。同じ設定の別のCodeWriterで変換して数える)
+        """
+        sizes = {}
+        for function_name, commands in self.removed_commands.items():
+            code_writer = CodeWriter(file_path=self.vm_file_path, standalone=False, **self.options)
+            for command in commands:
+                self._write_command(command=command, code_writer=code_writer)
+            sizes[function_name] = count_instructions(code_writer.finish())
+        return sizes
+
+    def _write_command(self, command: VMCommand, code_writer: CodeWriter = None) -> None:
+        """
+        VMコマンドをCodeWriterへ渡す
+        """
+        if code_writer is None:
+            code_writer = self.code_writer
+        command_type = command.command_type
+        if command_type == Command.ARITHMETIC:
+            code_writer.write_arithmetic(command=command.arg1)
+        elif command_type == Command.PUSH or command_type == Command.POP:
+            code_writer.write_push_pop(
+                command=command_type,
+                segment=command.arg1,
+                index=command.arg2
+            )
+        elif command_type == Command.LABEL:
+            code_writer.write_label(label=command.arg1)
+        elif command_type == Command.GOTO:
+            code_writer.write_goto(label=command.arg1)
+        elif command_type == Command.IF:
+            code_writer.write_if(label=command.arg1)
+        elif command_type == Command.FUNCTION:
+            self.function_name = command.arg1
+            code_writer.write_function(
+                function_name=self.function_name,
+                n_vars=command.arg2
+            )
+        elif command_type == Command.RETURN:
+            code_writer.write_return(function_name=self.function_name)
+        elif command_type == Command.CALL:
+            code_writer.write_call(
+                function_name=command.arg1,
+                n_args=command.arg2
+            )
+        else:
+            raise Exception(f"Invalid Command: {command.text()}")
+
+    def _is_template_command(self, command: VMCommand) -> bool:
+        """
+        VMコマンドの命令列が毎回同じ(ラベルや連番を含まない)か判断する
+        """
+        if command.command_type == Command.ARITHMETIC:
+            return command.arg1 not in SHARED_COMPARE_LABELS
+        return command.command_type in (Command.PUSH, Command.POP, Command.RETURN)
+
+    def encode(self) -> "HackEncoder":
+        """
+        アセンブリのテキストを経由せず、機械語へ直接変換する
+        毎回同じ命令列になるVMコマンドは、最初に現れたときに機械語のテンプレートにしておき、
+        2回目以降はCodeWriterを通さずにテンプレートをそのまま並べる
+        のぞき穴最適化をかける場合は全体の行が必要なので、行の並びから変換する
+        """
+        encoder = HackEncoder()
+        if self.optimizer is not None or self.cache is not None:
+            # キャッシュにはアセンブリの行を保存するので、キャッシュを使う場合も行から変換する
+            encoder.encode_lines(self.iter_lines())
+            return encoder
+
+        # 共有ルーチンなど、コマンドより前に書かれた行
+        encoder.encode_lines(self.code_writer.take_lines())
+        templates = {}
+        for command in self.commands:
+            if self._is_template_command(command=command):
+                # スタックの先頭がDにあるかどうかで命令列が変わるので、キーに含める
+                key = (command.text(), self.code_writer.tos_in_d)
+                entry = templates.get(key)
+                if entry is None:
+                    self._write_command(command=command)
+                    template = encoder.compile(self.code_writer.take_lines())
+                    entry = (template, self.code_writer.tos_in_d)
+                    templates[key] = entry
+                template, self.code_writer.tos_in_d = entry
+                encoder.extend(template)
             else:
-                print(self.parser.order, command_type)
-        self.code_writer.close()
-            
+                self._write_command(command=command)
+                encoder.encode_lines(self.code_writer.take_lines())
+        encoder.encode_lines(self.code_writer.finish())
+        return encoder
+
+    def iter_lines(self) -> Iterator[str]:
+        """
+        変換結果のアセンブリを1行ずつ返すジェネレータ
+        ファイルを介さずに、同じプロセス内のアセンブラなどへそのまま渡せる
+        """
+        for chunk in self.iter_chunks():
+            yield from chunk
+
+    def iter_chunks(self) -> Iterator[list]:
+        """
+        変換結果のアセンブリを、行のリスト(チャンク)ごとに返すジェネレータ
+        キャッシュを使う場合は、キャッシュの行を返すか、変換した行をまとめてキャッシュへ保存する
+        """
+        if self.cached_entry is not None:
+            # CodeWriterが先に書いた共有ルーチンなどもキャッシュの行に含まれている
+            self.code_writer.take_lines()
+            yield self.cached_entry["lines"]
+            return
+        if self.cache is not None:
+            lines = []
+            for chunk in self._translate_chunks():
+                lines.extend(chunk)
+                yield chunk
+            self._store_cache(lines=lines)
+            return
+        yield from self._translate_chunks()
+
+    def _translate_chunks(self) -> Iterator[list]:
+        """
+        VMコマンドを変換し、行のリスト(チャンク)ごとに返すジェネレータ
+        """
+        for command in self.commands:
+            self.code_writer.write_comment(comment=command.text())
+            self._write_command(command=command)
+            if self.code_writer.has_chunk():
+                yield self.code_writer.take_lines()
+        yield self.code_writer.finish()
+
+
+def _encode_vm_file(
+    vm_file_path: str,
+    optimize: bool,
+    routine_mode: RoutineMode,
+    cache_tos: bool,
+    vm_passes: tuple,
+    removed_functions: frozenset,
+    cache_dir: str,
+) -> tuple:
+    """
+    ワーカー: 1つの.vmファイルをブートストラップなしの機械語の断片に変換する
+    (命令, ラベル, fixup, 最適化の集計)を返す
+    """
+    translator = VMTranslator(
+        vm_file_name=vm_file_path,
+        optimize=optimize,
+        routine_mode=routine_mode,
+        standalone=False,
+        cache_tos=cache_tos,
+        vm_passes=vm_passes,
+        removed_functions=removed_functions,
+        cache_dir=cache_dir,
+    )
+    encoder = translator.encode()
+    return encoder.words, encoder.labels, encoder.fixups, translator.optimization_counts()
+
+
+def _translate_vm_file(
+    vm_file_path: str,
+    optimize: bool,
+    routine_mode: RoutineMode,
+    cache_tos: bool,
+    vm_passes: tuple,
+    removed_functions: frozenset,
+    cache_dir: str,
+) -> tuple:
+    """
+    ワーカー: 1つの.vmファイルをブートストラップなしの断片に変換する
+    (アセンブリの行のリスト, 最適化の集計)を返す
+    """
+    translator = VMTranslator(
+        vm_file_name=vm_file_path,
+        optimize=optimize,
+        routine_mode=routine_mode,
+        standalone=False,
+        cache_tos=cache_tos,
+        vm_passes=vm_passes,
+        removed_functions=removed_functions,
+        cache_dir=cache_dir,
+    )
+    lines = list(translator.iter_lines())
+    return lines, translator.optimization_counts()
+
+
+class DirectoryTranslator:
+    def __init__(
+        self,
+        vm_dir_name: str,
+        optimize: bool = False,
+        routine_mode: RoutineMode = RoutineMode.INLINE,
+        output: io.TextIOBase = None,
+        processes: int = None,
+        cache_tos: bool = False,
+        vm_passes: Iterable[str] = (),
+        eliminate_dead_functions: bool = False,
+        cache_dir: str = None,
+    ) -> None:
+        """
+        ディレクトリ内のすべての.vmファイルを1つのプログラムとして変換する
+        出力はディレクトリ内の<ディレクトリ名>.asm
+
+        Parameters
+        ----------
+        vm_dir_name : str
+            .vmファイルを含むディレクトリ
+        processes : int
+            変換に使うプロセス数。Noneの場合はCPUのコア数
+        eliminate_dead_functions : bool
+            Trueの場合、全ファイルの呼び出しグラフを作り、Sys.initから到達しない関数を取り除く
+        cache_dir : str
+            指定した場合、ファイルごとの変換結果をキャッシュし、変更のないファイルは変換しない
+        """
+        self.vm_dir_path = os.path.normpath(vm_dir_name)
+        # ファイル名順に並べ、連結の順序を毎回同じにする
+        self.vm_file_paths = sorted(glob.glob(os.path.join(self.vm_dir_path, "*.vm")))
+        if not self.vm_file_paths:
+            raise Exception(f"No .vm files in directory: {vm_dir_name}")
+        self.optimize = optimize
+        self.routine_mode = routine_mode
+        self.processes = processes
+        self.cache_tos = cache_tos
+        self.vm_passes = tuple(vm_passes)
+        self.eliminate_dead_functions = eliminate_dead_functions
+        self.cache_dir = cache_dir
+        # キャッシュを使ったファイル数
+        self.cache_hits = 0
+        # 取り除いた関数名 -> 残していた場合のROMのワード数
+        self.dead_functions = {}
+        self.optimizer = PeepholeOptimizer() if optimize else None
+        # 各ファイルのVMの最適化の集計をまとめる
+        self.vm_optimizer = VMOptimizer(passes=vm_passes) if vm_passes else None
+        program_name = os.path.basename(os.path.abspath(self.vm_dir_path))
+        self.code_writer = CodeWriter(
+            file_path=self.vm_dir_path,
+            routine_mode=routine_mode,
+            output=output,
+            asm_file_path=os.path.join(self.vm_dir_path, f"{program_name}.asm"),
+        )
+
+    def translate(self) -> None:
+        """
+        変換結果を<ディレクトリ名>.asm(または出力ストリーム)へまとめて書き込む
+        """
+        self.code_writer.write_chunks(self.iter_chunks())
+
+    def _add_optimization_counts(self, counts: dict) -> None:
+        """
+        ワーカーから返された1ファイル分の最適化の集計を足し合わせる
+        """
+        for rule, count in counts["saved"].items():
+            self.optimizer.saved[rule] += count
+        for name, count in counts["changes"].items():
+            self.vm_optimizer.changes[name] += count
+        for name, count in counts["removed"].items():
+            self.vm_optimizer.removed[name] += count
+        self.dead_functions.update(counts["dead_functions"])
+        self.cache_hits += counts["cache_hits"]
+
+    def _find_dead_functions(self, pool: Pool) -> list:
+        """
+        各ファイルの呼び出しグラフを並列に作ってまとめ、Sys.initから到達しない関数を求める
+        ファイルごとに、そのファイルで定義された関数のうち到達しないものの集合を返す
+        (キャッシュのキーが、他のファイルの関数の増減に左右されないようにする)
+        """
+        file_call_graphs = pool.map(_scan_call_graph, self.vm_file_paths)
+        call_graph = {}
+        for file_call_graph in file_call_graphs:
+            call_graph.update(file_call_graph)
+        if ENTRY_FUNCTION not in call_graph:
+            raise Exception(f"{ENTRY_FUNCTION} is not defined in {self.vm_dir_path}")
+        reachable = find_reachable_functions(call_graph=call_graph, roots=[ENTRY_FUNCTION])
+        return [frozenset(file_call_graph.keys() - reachable) for file_call_graph in file_call_graphs]
+
+    def _run_workers(self, worker) -> list:
+        """
+        各ファイルをプロセスプールで変換し、ファイル名順の結果のリストを返す
+        """
+        with Pool(processes=self.processes) as pool:
+            if self.eliminate_dead_functions:
+                removed_functions = self._find_dead_functions(pool=pool)
+            else:
+                removed_functions = [frozenset()] * len(self.vm_file_paths)
+            tasks = [
+                (
+                    vm_file_path,
+                    self.optimize,
+                    self.routine_mode,
+                    self.cache_tos,
+                    self.vm_passes,
+                    file_removed_functions,
+                    self.cache_dir,
+                )
+                for vm_file_path, file_removed_functions in zip(self.vm_file_paths, removed_functions)
+            ]
+            return pool.starmap(worker, tasks)
+
+    def iter_lines(self) -> Iterator[str]:
+        """
+        変換結果のアセンブリを1行ずつ返すジェネレータ
+        """
+        for chunk in self.iter_chunks():
+            yield from chunk
+
+    def encode(self) -> HackEncoder:
+        """
+        各ファイルをプロセスプールで並列に機械語へ変換し、ブートストラップの後ろへファイル名順に連結する
+        """
+        encoder = HackEncoder()
+        self.code_writer.write_bootstrap()
+        encoder.encode_lines(self.code_writer.take_lines())
+        fragments = self._run_workers(worker=_encode_vm_file)
+
+        for words, labels, fixups, counts in fragments:
+            encoder.merge(words=words, labels=labels, fixups=fixups)
+            self._add_optimization_counts(counts=counts)
+        encoder.encode_lines(self.code_writer.finish())
+        return encoder
+
+    def iter_chunks(self) -> Iterator[list]:
+        """
+        各ファイルをプロセスプールで並列に変換し、ブートストラップの後ろへファイル名順に連結する
+        ファイルごとにstaticの名前空間とラベルの連番が分かれているので、断片は独立に変換できる
+        """
+        self.code_writer.write_bootstrap()
+        yield self.code_writer.take_lines()
+        fragments = self._run_workers(worker=_translate_vm_file)
+
+        for lines, counts in fragments:
+            self._add_optimization_counts(counts=counts)
+            yield lines
+        yield self.code_writer.finish()
+
+
+def create_translator(
+    vm_file_name: str,
+    optimize: bool = False,
+    routine_mode: RoutineMode = RoutineMode.INLINE,
+    output: io.TextIOBase = None,
+    processes: int = None,
+    cache_tos: bool = False,
+    vm_passes: Iterable[str] = (),
+    eliminate_dead_functions: bool = False,
+    cache_dir: str = None,
+):
+    """
+    入力がディレクトリならDirectoryTranslatorを、ファイルならVMTranslatorを作る
+    到達しない関数の除去は、Sys.initから始まるディレクトリの場合だけ行う
+    """
+    if os.path.isdir(vm_file_name):
+        return DirectoryTranslator(
+            vm_dir_name=vm_file_name,
+            optimize=optimize,
+            routine_mode=routine_mode,
+            output=output,
+            processes=processes,
+            cache_tos=cache_tos,
+            vm_passes=vm_passes,
+            eliminate_dead_functions=eliminate_dead_functions,
+            cache_dir=cache_dir,
+        )
+    return VMTranslator(
+        vm_file_name=vm_file_name,
+        optimize=optimize,
+        routine_mode=routine_mode,
+        output=output,
+        cache_tos=cache_tos,
+        vm_passes=vm_passes,
+        cache_dir=cache_dir,
+    )
+
+
+def count_instructions(asm_lines: Iterable[str]) -> int:
+    """
+    アセンブリの行のうち、ROMを占める命令(ラベル・コメント以外)の数を数える
+    """
+    count = 0
+    for line in asm_lines:
+        text = line.strip()
+        if text and not text.startswith(("//", "(")):
+            count += 1
+    return count
+
+
+def compare_routine_modes(
+    vm_file_name: str,
+    optimize: bool = False,
+    processes: int = None,
+    cache_tos: bool = False,
+    vm_passes: Iterable[str] = (),
+    eliminate_dead_functions: bool = False,
+    cache_dir: str = None,
+) -> dict:
+    """
+    比較命令とreturnの展開方式ごとに変換し、命令数(ROMのワード数)を返す
+    変換結果はメモリ上に書き出すだけで、.asmファイルは作らない
+    """
+    sizes = {}
+    for mode in RoutineMode:
+        translator = create_translator(
+            vm_file_name=vm_file_name,
+            optimize=optimize,
+            routine_mode=mode,
+            processes=processes,
+            cache_tos=cache_tos,
+            vm_passes=vm_passes,
+            eliminate_dead_functions=eliminate_dead_functions,
+            cache_dir=cache_dir,
+        )
+        sizes[mode] = count_instructions(translator.iter_lines())
+    return sizes
+
+
+def _load_assembler(module_name: str = "complete_version"):
+    """
+    06_Assemblerのモジュールを読み込む (デフォルトはアセンブラのcomplete_version)
+    """
+    if ASSEMBLER_DIR not in sys.path:
+        sys.path.insert(0, ASSEMBLER_DIR)
+    return importlib.import_module(module_name)
+
+
+def assemble_translation(translator) -> str:
+    """
+    変換結果の行をファイルを介さずにそのままアセンブラへ渡し、.hackファイルを書き出す
+    書き出した.hackファイルのパスを返す
+    """
+    words = _load_assembler().assemble(translator.iter_lines())
+    return _write_hack_file(translator=translator, words=words)
+
+
+def encode_translation(translator) -> str:
+    """
+    アセンブリのテキストを経由せず、VMから機械語を直接生成して.hackファイルを書き出す
+    書き出した.hackファイルのパスを返す
+    """
+    words = translator.encode().resolve()
+    return _write_hack_file(translator=translator, words=words)
+
+
+def _write_hack_file(translator, words: Iterable[int]) -> str:
+    """
+    命令列を.asmファイルと同じ場所の.hackファイルへ書き出す
+    """
+    assembler = _load_assembler()
+    hack_file_path = os.path.splitext(translator.code_writer.asm_file_path)[0] + ".hack"
+    writer = assembler.HackWriter(hack_file_path=hack_file_path)
+    writer.write_words(words)
+    writer.close()
+    return hack_file_path
+
+
 def main():
     # コマンドライン引数で入力ファイルの名前を受け取る
-    args = sys.argv
-    if len(args) < 2:
+    arg_parser = argparse.ArgumentParser(description="VMトランスレータ")
+    arg_parser.add_argument(
+        "vm_file_name", nargs="?", help="入力する.vmファイル、または.vmファイルを含むディレクトリ"
+    )
+    arg_parser.add_argument(
+        "--optimize",
+        action="store_true",
+        help="のぞき穴最適化をかけ、規則ごとに削減した命令数を表示する",
+    )
+    arg_parser.add_argument(
+        "--routines",
+        choices=[mode.value for mode in RoutineMode],
+        default=RoutineMode.INLINE.value,
+        help="比較命令とreturnを展開する(inline)か、共有ルーチンを呼び出す(shared)か",
+    )
+    arg_parser.add_argument(
+        "--size-report",
+        action="store_true",
+        help="inline/sharedそれぞれの命令数を表示する",
+    )
+    arg_parser.add_argument(
+        "--processes",
+        type=int,
+        default=None,
+        help="ディレクトリを変換するときのプロセス数 (省略時はCPUのコア数)",
+    )
+    arg_parser.add_argument(
+        "--cache-tos",
+        action="store_true",
+        help="スタックの先頭をDレジスタに置いたままにし、ラベル・呼び出し・分岐の前でだけメモリへ書き出す",
+    )
+    arg_parser.add_argument(
+        "--vm-pass",
+        dest="vm_passes",
+        action="append",
+        choices=VMOptimizer.PASSES,
+        default=[],
+        help="CodeWriterの前にVMコマンドへかける最適化 (複数指定可)",
+    )
+    arg_parser.add_argument(
+        "--eliminate-dead-functions",
+        action="store_true",
+        help="Sys.initから呼ばれない関数を取り除き、取り除いた関数と削減したワード数を表示する (ディレクトリのみ)",
+    )
+    arg_parser.add_argument(
+        "--cache-dir",
+        default=None,
+        help="ファイルごとの変換結果をキャッシュするディレクトリ。内容とオプションが同じファイルは変換しない",
+    )
+    output_group = arg_parser.add_mutually_exclusive_group()
+    output_group.add_argument(
+        "--hack",
+        action="store_true",
+        help=".asmファイルを作らず、同じプロセス内でアセンブルして.hackファイルを書き出す",
+    )
+    output_group.add_argument(
+        "--binary",
+        action="store_true",
+        help="アセンブリのテキストを経由せず、VMから直接.hackファイルを書き出す",
+    )
+    args = arg_parser.parse_args()
+    if args.vm_file_name is None:
         print("ファイル名を入力してください。")
         return
-    vm_file_name = args[1]
+    vm_file_name = args.vm_file_name
+    if args.eliminate_dead_functions and not os.path.isdir(vm_file_name):
+        arg_parser.error("--eliminate-dead-functions はディレクトリを入力したときだけ使えます")
+
+    routine_mode = RoutineMode(args.routines)
+    vmtranslator = create_translator(
+        vm_file_name=vm_file_name,
+        optimize=args.optimize,
+        routine_mode=routine_mode,
+        processes=args.processes,
+        cache_tos=args.cache_tos,
+        vm_passes=args.vm_passes,
+        eliminate_dead_functions=args.eliminate_dead_functions,
+        cache_dir=args.cache_dir,
+    )
+    if args.hack:
+        assemble_translation(translator=vmtranslator)
+    elif args.binary:
+        encode_translation(translator=vmtranslator)
+    else:
+        vmtranslator.translate()
+    if args.cache_dir is not None:
+        print(f"キャッシュから再利用: {vmtranslator.cache_hits} ファイル")
+    if args.eliminate_dead_functions:
+        dead_functions = vmtranslator.dead_functions
+        for function_name in sorted(dead_functions):
+            print(f"削除: {function_name} ({dead_functions[function_name]} ワード)")
+        print(f"到達しない関数 {len(dead_functions)} 個、{sum(dead_functions.values())} ワードを削減")
+    vm_optimizer = vmtranslator.vm_optimizer
+    if vm_optimizer is not None:
+        for name in vm_optimizer.passes:
+            print(
+                f"{name}: {vm_optimizer.changes[name]} 箇所を書き換え、"
+                f"VMコマンドを {vm_optimizer.removed[name]} 個削減"
+            )
+    optimizer = vmtranslator.optimizer
+    if optimizer is not None:
+        for rule, saved in optimizer.saved.items():
+            print(f"{rule}: {saved} 命令を削減")
+        print(f"合計: {sum(optimizer.saved.values())} 命令を削減")
+    if args.size_report:
+        sizes = compare_routine_modes(
+            vm_file_name=vm_file_name,
+            optimize=args.optimize,
+            processes=args.processes,
+            cache_tos=args.cache_tos,
+            vm_passes=args.vm_passes,
+            eliminate_dead_functions=args.eliminate_dead_functions,
+            cache_dir=args.cache_dir,
+        )
+        inline_size = sizes[RoutineMode.INLINE]
+        shared_size = sizes[RoutineMode.SHARED]
+        print(f"inline: {inline_size} 命令")
+        print(f"shared: {shared_size} 命令")
+        print(f"差分: {shared_size - inline_size:+d} 命令 ({shared_size / inline_size:.1%})")
 
-    vmtranslator = VMTranslator(vm_file_name=vm_file_name)
-    vmtranslator.translate()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file